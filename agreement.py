@@ -0,0 +1,24 @@
+import re
+import string
+from collections import Counter
+from typing import List
+
+
+def normalize_answer(text: str) -> str:
+    """
+    Normalizes a short answer for comparison, as in the SQuAD and HotpotQA evaluations:
+    first line only, lower case, without punctuation, articles and extra whitespace.
+    """
+    lines = text.strip().splitlines()
+    text = lines[0].lower() if lines else ''
+    text = ''.join(ch for ch in text if ch not in set(string.punctuation))
+    text = re.sub(r'\b(a|an|the)\b', ' ', text)
+    return ' '.join(text.split())
+
+
+def answer_agreement(responses: List[str]) -> float:
+    """Share of the responses that give the most common normalized answer."""
+    if not responses:
+        return 0.0
+    counts = Counter(normalize_answer(response) for response in responses)
+    return counts.most_common(1)[0][1] / len(responses)
@@ -0,0 +1,312 @@
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+from metrics import Metrics, peak_memory
+from generation_cache import GenerationCache
+
+
+def record_step(metrics: Metrics, step):
+    """
+    Records a step of a continuous batching engine (its `last_step`) like a batch, split between the
+    stages (request tags) of its rows. The rows are the sequences decoded at that step and the
+    prompt tokens those prefilled by the requests it admitted.
+    """
+    tags = step['tags']
+    total_rows = sum(stats.get('rows', 0) for stats in tags.values())
+    peak_gpu_memory, peak_host_memory = peak_memory()
+    for stage, stats in tags.items():
+        rows = stats.get('rows', 0)
+        # a step that only prefilled has no rows, and no slots to fill
+        share = rows / total_rows if total_rows else 0.0
+        metrics.record(
+            'generate',
+            stage,
+            wall_time=step['wall_time'] * (share if total_rows else 1 / len(tags)),
+            batch_wall_time=step['wall_time'],
+            rows=rows,
+            batch_rows=total_rows,
+            max_batch_size=step['max_batch_size'] * share,
+            prompt_tokens=stats.get('prompt_tokens', 0),
+            generated_tokens=stats.get('generated_tokens', 0),
+            padding_tokens=0,
+            decode_steps_saved=stats.get('decode_steps_saved', 0),
+            peak_gpu_memory=peak_gpu_memory,
+            peak_host_memory=peak_host_memory,
+        )
+
+
+class BatchScheduler:
+    """
+    Packs dialogs coming from many questions into full `chat_completion` batches.
+
+    Each question adds its dialogs together with a callback. Dialogs are queued and
+    sent to the generator `max_batch_size` at a time, so a batch can mix dialogs of
+    several questions. Once every dialog of a question has been generated, its
+    callback is called with the generations in the order the dialogs were added.
+
+    A dialog added with `n > 1` takes `n` rows of a batch. If the generator has a
+    `sample_n` method, the samples of a dialog that land in the same batch share a
+    single prefill of its prompt.
+
+    With a `count_tokens` function, batches are only formed on `flush`: the queued
+    dialogs are sorted by prompt length first, so that each batch holds prompts of
+    similar length and little of it is padding.
+
+    With `metrics`, every batch is recorded (wall time, tokens, fill, padding and
+    peak memory), split between the stages of its rows as given by `stage_of(key)`.
+    Each record also holds the wall time of the whole batch, `batch_wall_time`.
+
+    With a `cache`, the samples already in the generation cache are filled in by `add`
+    and only the others are queued; every generated sample is added to the cache.
+
+    If the generator has a `submit` method (see `engine.ContinuousBatchingEngine`), the
+    engine forms the batches itself: `add` submits the dialogs to it right away and `flush`
+    runs it until every submitted dialog is done. With `metrics`, every engine step is then
+    recorded like a batch, see `record_step`.
+
+    `stop` and `stop_patterns` are passed to the generator, which ends a sample at the first
+    of them (see `stop_conditions`). The generator may report the decode steps a batch skipped by
+    ending before its budget as `decode_steps_saved` in `last_stats`, split between the stages of
+    the batch like its time, or, for the engine, per prediction; `steps_saved` sums them per stage.
+    With `store_prefix` off, a generator with a prefix cache does not add the prompts to it.
+    The counts of speculative decoding (see `speculative`) are summed per stage in `speculative`.
+    """
+
+    def __init__(
+        self,
+        generator,
+        max_batch_size: int,
+        max_gen_len: Optional[int] = None,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        count_tokens: Optional[Callable] = None,
+        metrics: Optional[Metrics] = None,
+        stage_of: Optional[Callable] = None,
+        cache: Optional[GenerationCache] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+        store_prefix: bool = True,
+    ):
+        self.generator = generator
+        self.max_batch_size = max_batch_size
+        self.max_gen_len = max_gen_len
+        self.temperature = temperature
+        self.top_p = top_p
+        self.count_tokens = count_tokens
+        self.metrics = metrics
+        self.stage_of = stage_of
+        self.cache = cache
+        self.cache_keys = {}
+        self.continuous = hasattr(generator, 'submit')
+        # only given to the generator when set, so that a plain `Llama` still works
+        self.stop_kwargs = {}
+        if stop:
+            self.stop_kwargs['stop'] = stop
+        if stop_patterns:
+            self.stop_kwargs['stop_patterns'] = stop_patterns
+        self.generate_kwargs = dict(self.stop_kwargs)
+        if not store_prefix and getattr(generator, 'prefix_cache', None) is not None:
+            self.generate_kwargs['store_prefix'] = False
+        self.steps_saved = defaultdict(int)
+        self.speculative = defaultdict(lambda: defaultdict(int))
+
+        self.pending = []
+        self.outputs: Dict[int, List[Optional[str]]] = {}
+        self.callbacks: Dict[int, Callable] = {}
+        self.num_batches = 0
+        self.num_dialogs = 0
+        self.prompt_tokens = 0
+        self.padding_tokens = 0
+
+    def add(self, key, dialogs, on_done: Callable, n: int = 1):
+        """
+        Queue the dialogs of one question.
+
+        Args:
+            key: Identifier of the question (usually `q_idx`), unique among the pending questions.
+            dialogs (List[Dialog]): Dialogs to generate for this question.
+            on_done (Callable): Called as `on_done(key, generations)` once all dialogs are done.
+            n (int, optional): Number of samples to generate for each dialog. The generations
+                of dialog `i` are at positions `i * n` to `(i + 1) * n - 1`. Defaults to 1.
+        """
+        assert key not in self.callbacks, f"{key} is already scheduled"
+        self.outputs[key] = [None] * (len(dialogs) * n)
+        self.callbacks[key] = on_done
+        for i, dialog in enumerate(dialogs):
+            length = self.count_tokens(dialog) if self.count_tokens is not None else None
+            cache_keys, cached = [None] * n, {}
+            if self.cache is not None:
+                cache_keys = self.cache.keys(dialog, n, self.temperature, self.top_p, self.max_gen_len, **self.stop_kwargs)
+                cached = self.cache.get_many(cache_keys)
+            missing = []
+            for s in range(n):
+                if cache_keys[s] in cached:
+                    self.outputs[key][i * n + s] = cached[cache_keys[s]]
+                    continue
+                if self.cache is not None:
+                    self.cache_keys[(key, i * n + s)] = cache_keys[s]
+                missing.append(i * n + s)
+            if self.continuous and missing:
+                self.generator.submit(
+                    dialog,
+                    lambda results, key=key, missing=missing: self._store_results(key, missing, results),
+                    n=len(missing),
+                    max_gen_len=self.max_gen_len,
+                    temperature=self.temperature,
+                    top_p=self.top_p,
+                    tag=self.stage_of(key) if self.stage_of is not None else None,
+                    **self.generate_kwargs,
+                )
+            elif missing:
+                self.pending.extend((key, pos, dialog, length) for pos in missing)
+
+        if all(out is not None for out in self.outputs[key]):
+            self.callbacks.pop(key)(key, self.outputs.pop(key))
+        elif self.count_tokens is None:
+            while len(self.pending) >= self.max_batch_size:
+                self._run_batch()
+
+    def flush(self):
+        """Generate whatever is still queued, even if it does not fill a batch."""
+        if self.continuous:
+            self.generator.run(on_step=(lambda step: record_step(self.metrics, step)) if self.metrics is not None else None)
+            return
+        if self.count_tokens is not None:
+            # stable sort, so the samples of a dialog stay next to each other
+            self.pending.sort(key=lambda row: row[3])
+        while self.pending:
+            self._run_batch()
+
+    def _run_batch(self):
+        batch = self.pending[:self.max_batch_size]
+        self.pending = self.pending[self.max_batch_size:]
+
+        # consecutive rows holding the same dialog object are samples of one prompt
+        groups = []
+        for _, _, dialog, _ in batch:
+            if groups and groups[-1][0] is dialog:
+                groups[-1][1] += 1
+            else:
+                groups.append([dialog, 1])
+
+        start = time.perf_counter()
+        if len(groups) < len(batch) and hasattr(self.generator, 'sample_n'):
+            grouped_results = self.generator.sample_n(
+                [dialog for dialog, _ in groups],  # type: ignore
+                n=[count for _, count in groups],
+                max_gen_len=self.max_gen_len,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                **self.generate_kwargs,
+            )
+            results = [result for group in grouped_results for result in group]
+        else:
+            results = self.generator.chat_completion(
+                [dialog for _, _, dialog, _ in batch],  # type: ignore
+                max_gen_len=self.max_gen_len,
+                temperature=self.temperature,
+                top_p=self.top_p,
+                **self.generate_kwargs,
+            )
+        wall_time = time.perf_counter() - start
+        self.num_batches += 1
+        self.num_dialogs += len(batch)
+        if self.metrics is not None:
+            self._record(batch, results, wall_time)
+        if self.count_tokens is not None:
+            lengths = [length for _, _, _, length in batch]
+            self.prompt_tokens += sum(lengths)
+            self.padding_tokens += sum(max(lengths) - length for length in lengths)
+
+        for (key, i, _, _), result in zip(batch, results):
+            self.outputs[key][i] = result['generation']['content']
+            self._count_stats(key, result)
+        for stage, steps in self._batch_steps_saved(batch).items():
+            self.steps_saved[stage] += steps
+        self._cache_results([(key, i) for key, i, _, _ in batch], results)
+
+        finished = []
+        for key, _, _, _ in batch:
+            if key not in finished and all(out is not None for out in self.outputs[key]):
+                finished.append(key)
+
+        for key in finished:
+            generations = self.outputs.pop(key)
+            on_done = self.callbacks.pop(key)
+            on_done(key, generations)
+
+    def _count_stats(self, key, result):
+        stage = self.stage_of(key) if self.stage_of is not None else None
+        self.steps_saved[stage] += result.get('decode_steps_saved', 0)
+        for name, value in result.get('speculative', {}).items():
+            self.speculative[stage][name] += value
+
+    def _batch_steps_saved(self, batch):
+        """Splits the `decode_steps_saved` of the last batch of the generator between the stages of its rows."""
+        stats = getattr(self.generator, 'last_stats', None) or {}
+        if 'decode_steps_saved' not in stats:
+            return {}
+        stages = [self.stage_of(key) if self.stage_of is not None else None for key, _, _, _ in batch]
+        return {stage: stats['decode_steps_saved'] * stages.count(stage) / len(batch) for stage in dict.fromkeys(stages)}
+
+    def _cache_results(self, positions, results):
+        if self.cache is not None:
+            self.cache.put_many({
+                self.cache_keys.pop(position): result['generation']['content']
+                for position, result in zip(positions, results)
+            })
+
+    def _store_results(self, key, positions, results):
+        """Callback of the continuous batching engine for the samples of one dialog."""
+        self.num_dialogs += len(results)
+        for i, result in zip(positions, results):
+            self.outputs[key][i] = result['generation']['content']
+            self._count_stats(key, result)
+        self._cache_results([(key, i) for i in positions], results)
+        if all(out is not None for out in self.outputs[key]):
+            self.callbacks.pop(key)(key, self.outputs.pop(key))
+
+    def _record(self, batch, results, wall_time):
+        stats = getattr(self.generator, 'last_stats', None)
+        if stats is not None:
+            prompt_tokens = stats['prompt_tokens']
+            generated_tokens = stats['generated_tokens']
+        else:
+            prompt_tokens = [length or 0 for _, _, _, length in batch]
+            generated_tokens = [len(result['generation']['content'].split()) for result in results]
+        padding_tokens = [max(prompt_tokens) - length for length in prompt_tokens]
+        peak_gpu_memory, peak_host_memory = peak_memory()
+
+        stages = [self.stage_of(key) if self.stage_of is not None else None for key, _, _, _ in batch]
+        batch_steps_saved = self._batch_steps_saved(batch)
+        for stage in dict.fromkeys(stages):
+            rows = [i for i, s in enumerate(stages) if s == stage]
+            share = len(rows) / len(batch)
+            self.metrics.record(
+                'generate',
+                stage,
+                wall_time=wall_time * share,
+                batch_wall_time=wall_time,
+                rows=len(rows),
+                batch_rows=len(batch),
+                max_batch_size=self.max_batch_size * share,
+                prompt_tokens=sum(prompt_tokens[i] for i in rows),
+                generated_tokens=sum(generated_tokens[i] for i in rows),
+                padding_tokens=sum(padding_tokens[i] for i in rows),
+                decode_steps_saved=batch_steps_saved.get(stage, sum(results[i].get('decode_steps_saved', 0) for i in rows)),
+                peak_gpu_memory=peak_gpu_memory,
+                peak_host_memory=peak_host_memory,
+            )
+
+    @property
+    def fill_ratio(self):
+        if self.num_batches == 0:
+            return 0.0
+        return self.num_dialogs / (self.num_batches * self.max_batch_size)
+
+    @property
+    def padding_fraction(self):
+        """Share of the padded prompt tokens of all batches that is padding."""
+        if self.prompt_tokens + self.padding_tokens == 0:
+            return 0.0
+        return self.padding_tokens / (self.prompt_tokens + self.padding_tokens)
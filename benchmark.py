@@ -0,0 +1,225 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import subprocess
+from typing import List, Optional
+import fire
+from fake_llama import FakeLlama
+from metrics import peak_memory
+
+
+WORDS = ['river', 'album', 'film', 'city', 'band', 'player', 'novel', 'league', 'county', 'station', 'series', 'company']
+
+
+class SyntheticTable:
+    """
+    TruthfulQA- or HotpotQA-shaped split of `num_questions` rows, generated from the row index.
+
+    It has what `QuestionSource` uses of a `datasets.Dataset` (`len`, slicing into a dict of
+    columns, `select` and `select_columns`), holds no rows in memory and can be pickled.
+    HotpotQA contexts have 10 paragraphs of 2 to 6 sentences, about 5000 characters, and one in
+    twenty has up to 12 sentences per paragraph, so that some pass the 8000 characters limit of
+    `pipeline.skip_long_context`.
+    """
+
+    def __init__(self, dataset: str, num_questions: int, q_idxs: Optional[List[int]] = None, columns=None):
+        self.dataset = dataset
+        self.num_questions = num_questions
+        self.q_idxs = q_idxs
+        self.columns = columns
+        self._fingerprint = f'synthetic-{dataset}-{num_questions}'
+
+    def __len__(self):
+        return len(self.q_idxs) if self.q_idxs is not None else self.num_questions
+
+    def row(self, q_idx):
+        rng = random.Random(q_idx)
+        if self.dataset == 'truthfulqa':
+            return {
+                'Question': f"What happens if you {' '.join(rng.choices(WORDS, k=rng.randint(3, 12)))} ({q_idx})?",
+                'Best Answer': ' '.join(rng.choices(WORDS, k=rng.randint(3, 20))),
+            }
+        titles = [f"{rng.choice(WORDS).title()} {q_idx}-{p}" for p in range(10)]
+        max_sentences = 12 if rng.random() < 0.05 else 6
+        sentences = [
+            [' '.join(rng.choices(WORDS, k=rng.randint(10, 30))) + '.' for _ in range(rng.randint(2, max_sentences))]
+            for _ in titles
+        ]
+        return {
+            'id': f'synthetic-{q_idx}',
+            'question': f"Which {rng.choice(WORDS)} of the {' '.join(rng.choices(WORDS, k=rng.randint(4, 10)))} ({q_idx})?",
+            'answer': rng.choice(WORDS),
+            'type': rng.choice(['comparison', 'bridge']),
+            'level': rng.choice(['easy', 'medium', 'hard']),
+            'context': {'title': titles, 'sentences': sentences},
+        }
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self[0:len(self)][key]
+        q_idxs = range(self.num_questions) if self.q_idxs is None else self.q_idxs
+        rows = [self.row(q_idx) for q_idx in q_idxs[key]]
+        columns = self.columns or (list(rows[0]) if rows else [])
+        return {column: [row[column] for row in rows] for column in columns}
+
+    def select(self, indices):
+        q_idxs = range(self.num_questions) if self.q_idxs is None else self.q_idxs
+        return SyntheticTable(self.dataset, self.num_questions, [q_idxs[i] for i in indices], self.columns)
+
+    def select_columns(self, columns):
+        return SyntheticTable(self.dataset, self.num_questions, self.q_idxs, list(columns))
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+    dataset: str = 'truthfulqa',
+    num_questions: int = 1000,
+    token_latency: float = 0.0,
+    output_tokens=(2, 2),
+    max_batch_size: int = 8,
+    chunk_size: int = 200,
+    num_readers: int = 1,
+    output: Optional[str] = None,
+    work_dir: Optional[str] = None,
+    keep: bool = False,
+):
+    """
+    Runs one synthetic workload through `run_llama.main` and `combine_data.combine` and reports its speed.
+
+    The generator is a `FakeLlama` with `token_latency` seconds per decode step and `output_tokens`
+    (min, max) words per generation, so the time left is that of the pipeline itself: building
+    dialogs, batching, result store reads and writes and resume scanning. The run goes through
+    the work queue in chunks of `chunk_size` questions, then runs again over the finished store
+    to time the resume scan, then merges the results.
+
+    Args:
+        output (str, optional): Json lines file the result is appended to.
+        work_dir (str, optional): Directory of the outputs. Defaults to a temporary directory.
+        keep (bool, optional): Keep `work_dir` afterwards. Defaults to False.
+
+    The result is printed as a json line: run, resume and combine seconds, questions/sec, batch
+    fill, result store read and write seconds, peak RSS, and the workload with the git commit.
+    """
+    import run_llama
+    import combine_data
+    from metrics import summarize
+    from question_source import QuestionSource
+
+    work_dir = work_dir or tempfile.mkdtemp(prefix=f'benchmark-{dataset}-')
+    table = SyntheticTable(dataset, num_questions)
+    generator = FakeLlama(max_batch_size=max_batch_size, token_latency=token_latency, output_tokens=tuple(output_tokens))
+
+    def run_pipeline():
+        source = QuestionSource(dataset, work_dir, table=table, num_questions=num_questions)
+        start = time.perf_counter()
+        run_llama.main(
+            'fake', 'fake', dataset=dataset, max_batch_size=max_batch_size, use_queue=True, chunk_size=chunk_size,
+            compute_speed=True, cache_dir=work_dir, generator=generator, source=source,
+        )
+        return time.perf_counter() - start
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        run_seconds = run_pipeline()
+        summary = summarize(dataset, cache_dir=work_dir)
+        # a second pass over an emptied queue finds every result done
+        os.remove(f'{work_dir}/{dataset}/queue.sqlite')
+        shutil.rmtree(f'{work_dir}/{dataset}/metrics')
+        resume_seconds = run_pipeline()
+        start = time.perf_counter()
+        combine_data.combine(dataset, work_dir, output_dir=f'{work_dir}/combined', num_readers=num_readers, table=table)
+        combine_seconds = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    stages = [s for s in summary.values() if s['batches']]
+    rows = sum(s['rows'] for s in stages)
+    slots = sum(s['rows'] / s['batch_fill'] for s in stages if s['batch_fill'])
+    result = {
+        'commit': git_commit(),
+        'dataset': dataset,
+        'num_questions': num_questions,
+        'token_latency': token_latency,
+        'output_tokens': list(output_tokens),
+        'max_batch_size': max_batch_size,
+        'chunk_size': chunk_size,
+        'run_seconds': run_seconds,
+        'questions_per_sec': num_questions / run_seconds,
+        'generate_seconds': sum(s['wall_time'] for s in stages),
+        'batch_fill': rows / slots if slots else 0.0,
+        'store_read_seconds': sum(s.get('store_read_time', 0.0) for s in summary.values()),
+        'store_write_seconds': sum(s.get('store_write_time', 0.0) for s in summary.values()),
+        'resume_seconds': resume_seconds,
+        'combine_seconds': combine_seconds,
+        'combine_questions_per_sec': num_questions / combine_seconds,
+        'peak_rss': peak_memory()[1],
+    }
+    if not keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    print(json.dumps(result))
+    if output is not None:
+        with open(output, 'a') as f:
+            f.write(json.dumps(result) + '\n')
+
+
+def suite(
+    output: str = 'benchmark.jsonl',
+    datasets=('truthfulqa', 'hotpotqa'),
+    sizes=(1000, 10000, 100000),
+    token_latency: float = 0.0,
+    output_tokens=(2, 2),
+    max_batch_size: int = 8,
+):
+    """
+    Runs `run` for every dataset and size, each in its own process so that its peak RSS is its own.
+
+    The results are appended to `output`, one json line per workload; compare two such files
+    with `compare`.
+    """
+    for dataset in datasets:
+        for size in sizes:
+            subprocess.run([
+                sys.executable, os.path.abspath(__file__), 'run', f'--dataset={dataset}', f'--num_questions={size}',
+                f'--token_latency={token_latency}', f'--output_tokens={list(output_tokens)}',
+                f'--max_batch_size={max_batch_size}', f'--output={output}',
+            ], check=True)
+
+
+def compare(baseline: str, candidate: str):
+    """Prints the ratio candidate / baseline of the speed of every workload found in both result files."""
+    def load(path):
+        results = {}
+        with open(path, 'r') as f:
+            for line in f:
+                r = json.loads(line)
+                results[(r['dataset'], r['num_questions'], r['token_latency'], tuple(r['output_tokens']))] = r
+        return results
+
+    baseline, candidate = load(baseline), load(candidate)
+    keys = ['questions_per_sec', 'batch_fill', 'store_write_seconds', 'resume_seconds', 'combine_seconds', 'peak_rss']
+    print(f"{'workload':<24}" + ''.join(f'{key:>22}' for key in keys))
+    for workload in sorted(set(baseline) & set(candidate)):
+        ratios = [
+            candidate[workload][key] / baseline[workload][key] if baseline[workload][key] else float('nan')
+            for key in keys
+        ]
+        print(f"{workload[0]:<12}{workload[1]:>12}" + ''.join(f'{ratio:>22.2f}' for ratio in ratios))
+
+
+if __name__ == "__main__":
+    fire.Fire({'run': run, 'suite': suite, 'compare': compare})
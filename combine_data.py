@@ -1,67 +1,244 @@
-from datasets import load_dataset
-from my_config import my_config
 import os
 import json
 import glob
-
-
-def read_json(filename):
-    with open(filename, 'r') as f:
-        data = json.load(f)
-    return data
-
-dataset = my_config.dataset
-cache_dir = my_config.cache_dir
-
-
-if dataset == 'truthfulqa':
-    raw_datasets = load_dataset('domenicrosati/TruthfulQA', cache_dir=cache_dir)
-    all_questions = raw_datasets['train']['Question']
-elif dataset == 'hotpotqa':
-    raw_datasets = load_dataset('hotpot_qa', 'distractor', cache_dir=cache_dir)['train'][:10000]
-    all_questions = raw_datasets['question']
-    all_contexts = raw_datasets['context']
-    all_answer = raw_datasets['answer']
-    all_type = raw_datasets['type']
-    all_level = raw_datasets['level']
-
-
-init_responses_dir = f'{cache_dir}/{dataset}/init_responses'
-res_wo_ref_dir = f'{cache_dir}/{dataset}/res_wo_ref'
-res_w_ref_dir = f'{cache_dir}/{dataset}/res_w_ref'
-files = glob.glob(f"{res_w_ref_dir}/*.json")
-
-q_idx_list = [int(os.path.basename(path).split('.')[0]) for path in files]
-q_idx_list.sort()
-
-
-all_data = {}
-for q_idx in q_idx_list:
-    init_responses_path = f'{init_responses_dir}/{q_idx}.json'
-    res_wo_ref_path = f'{res_wo_ref_dir}/{q_idx}.json'
-    res_w_ref_path = f'{res_w_ref_dir}/{q_idx}.json'
-    init_responses = read_json(init_responses_path)
-    res_wo_ref = read_json(res_wo_ref_path)
-    res_w_ref = read_json(res_w_ref_path)
-    if dataset == 'truthfulqa':
-        all_data[q_idx] = {'Question': all_questions[q_idx], 'init_responses': init_responses, 'res_wo_ref':res_wo_ref, 'res_w_ref': res_w_ref}
-    elif dataset == 'hotpotqa':
-        question = all_questions[q_idx]
-        context = all_contexts[q_idx]
-        answer = all_answer[q_idx]
-        type = all_type[q_idx]
-        level = all_level[q_idx]
-        all_data[q_idx] = {'question': question, 'context': context, 'answer': answer, 'type': type, 'level': level, 'init_responses': init_responses, 'res_wo_ref':res_wo_ref, 'res_w_ref': res_w_ref}
-
-save_path = f'all_data_{dataset}.json'
-
-with open(save_path, 'w') as f:
-    json.dump(all_data, f)
-
-
-
-        
-
-breakpoint()
-
-
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from question_source import QuestionSource
+from result_store import SqliteResultStore, SKIP_REASONS
+
+
+MERGED_STAGES = ['res_w_ref', 'init_responses', 'res_wo_ref']
+# merged stage that is never skipped: questions without it are left out
+REQUIRED_STAGE = 'init_responses'
+HOTPOTQA_COLUMNS = ['question', 'context', 'answer', 'type', 'level']
+
+# QuestionSource and result store of a reader process, opened on its first part
+_readers = {}
+
+
+def open_readers(dataset, cache_dir, table=None):
+    key = (dataset, cache_dir)
+    if key not in _readers:
+        _readers[key] = (QuestionSource(dataset, cache_dir, table=table), SqliteResultStore(cache_dir, dataset))
+    return _readers[key]
+
+
+def iter_merged(store, q_idxs=None, decode=True):
+    """
+    Yields (q_idx, values, skipped) for every question whose `MERGED_STAGES` are all done or skipped.
+
+    `values` holds the output of each merged stage, None for the skipped ones (raw json texts
+    with `decode=False`), and `skipped` is {stage: reason} for the skipped ones. `REQUIRED_STAGE`
+    must be done.
+    """
+    optional = [stage for stage in MERGED_STAGES if stage != REQUIRED_STAGE]
+    rows = store.iter_joined([REQUIRED_STAGE], q_idxs, decode=decode, optional=optional + [SKIP_REASONS])
+    for q_idx, (required, *values, reasons) in rows:
+        outputs = dict(zip(optional, values))
+        outputs[REQUIRED_STAGE] = required
+        values = [outputs[stage] for stage in MERGED_STAGES]
+        if reasons is not None and not decode:
+            reasons = json.loads(reasons)
+        reasons = reasons or {}
+        skipped = {stage: reasons[stage] for stage, value in zip(MERGED_STAGES, values) if value is None and stage in reasons}
+        if sum(value is None for value in values) == len(skipped):
+            yield q_idx, values, skipped
+
+
+def iter_records(dataset, cache_dir, q_idxs, table=None):
+    """
+    Yields the merged record of every q_idx, reading only the dataset rows of `q_idxs`.
+
+    The outputs of skipped stages are None and `skip_reasons` lists their stage and reason.
+    """
+    source, store = open_readers(dataset, cache_dir, table)
+    results = iter_merged(store, q_idxs)
+    q_idxs = sorted(q_idxs)
+    rows = source.rows(q_idxs)
+    row_of = {q_idx: i for i, q_idx in enumerate(q_idxs)}
+    for q_idx, values, skipped in results:
+        outputs = dict(zip(MERGED_STAGES, values))
+        i = row_of[q_idx]
+        if dataset == 'truthfulqa':
+            record = {'q_idx': q_idx, 'Question': rows['Question'][i]}
+        elif dataset == 'hotpotqa':
+            record = {'q_idx': q_idx, **{column: rows[column][i] for column in HOTPOTQA_COLUMNS}}
+        record.update({stage: outputs[stage] for stage in ['init_responses', 'res_wo_ref', 'res_w_ref']})
+        record['skip_reasons'] = [{'stage': stage, 'reason': reason} for stage, reason in skipped.items()]
+        yield record
+
+
+def write_part(dataset, cache_dir, path, q_idxs, output_format, table=None):
+    """Writes the records of `q_idxs` to `path`, through a temporary file so that a part is never partial."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    records = iter_records(dataset, cache_dir, q_idxs, table)
+    if output_format == 'jsonl':
+        with open(tmp_path, 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+    elif output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        pq.write_table(pa.Table.from_pylist(list(records)), tmp_path)
+    else:
+        raise ValueError(f"unknown output format {output_format}")
+    os.rename(tmp_path, path)
+    return path
+
+
+def load_manifest(output_dir, dataset, output_format):
+    path = f'{output_dir}/manifest.json'
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['dataset'] == dataset and manifest['format'] == output_format:
+            return manifest
+    return {'dataset': dataset, 'format': output_format, 'next_part': 0, 'parts': {}, 'digests': {}}
+
+
+def save_manifest(output_dir, manifest):
+    tmp_path = f'{output_dir}/manifest.json.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, f'{output_dir}/manifest.json')
+
+
+def combine(
+    dataset: str,
+    cache_dir: str,
+    output_dir: str = None,
+    output_format: str = 'jsonl',
+    part_size: int = 1000,
+    num_readers: int = 1,
+    full_rebuild: bool = False,
+    table=None,
+):
+    """
+    Merges the questions and the stage outputs of a dataset into `{output_dir}/part-*.{jsonl,parquet}`.
+
+    The merge is incremental. `manifest.json` lists the parts and the q_idx of each, with a
+    digest of the stage outputs of every merged q_idx, so a run only reads and writes the
+    questions that are new or whose outputs changed since the last one. A part holding a
+    changed question is written again as a whole. Parts are written to a temporary file and
+    renamed, and the manifest is replaced after each part, so an interrupted merge resumes
+    where it stopped; files not listed in the manifest are deleted. A part being rewritten
+    leaves the manifest in the same replacement as the first new part holding some of its
+    questions, and its other questions lose their digest until they are written again, so
+    the listed parts never hold a question twice (parts listed twice by an older manifest are
+    rewritten). Readers should only read the parts listed in the manifest.
+
+    Questions whose merged stages were skipped by the pipeline (see `pipeline.StageDAG`) are
+    merged too, with None outputs for the skipped stages and their reasons in `skip_reasons`.
+
+    Args:
+        dataset (str): Name of the dataset.
+        cache_dir (str): Root of the outputs, see `result_store`.
+        output_dir (str, optional): Defaults to `all_data_{dataset}`.
+        output_format (str, optional): 'jsonl', or 'parquet' (requires pyarrow). Defaults to 'jsonl'.
+        part_size (int, optional): Number of questions per part. Defaults to 1000.
+        num_readers (int, optional): Number of processes writing parts in parallel. Defaults to 1.
+        full_rebuild (bool, optional): Ignore the manifest and merge everything again. Defaults to False.
+        table (optional): Split to read the questions from instead of loading the dataset, see
+            `question_source.QuestionSource`. It is pickled to the readers when `num_readers > 1`.
+    """
+    if output_dir is None:
+        output_dir = f'all_data_{dataset}'
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir, dataset, output_format)
+    if full_rebuild:
+        manifest.update({'parts': {}, 'digests': {}})
+
+    for path in glob.glob(f'{output_dir}/part-*'):
+        if os.path.basename(path) not in manifest['parts']:
+            os.remove(path)
+
+    store = SqliteResultStore(cache_dir, dataset)
+    # the reasons only count for questions with skipped stages, so the digests of the others do not change
+    digests = {
+        str(q_idx): hashlib.md5('\n'.join(
+            [value or '' for value in values] + ([json.dumps(skipped)] if skipped else [])
+        ).encode()).hexdigest()
+        for q_idx, values, skipped in iter_merged(store, decode=False)
+    }
+    store.close()
+
+    changed = {q_idx for q_idx, digest in digests.items() if manifest['digests'].get(q_idx) != digest}
+    removed = set(manifest['digests']) - set(digests)
+    listed, duplicated = set(), set()
+    for q_idxs in manifest['parts'].values():
+        duplicated.update(listed.intersection(q_idxs))
+        listed.update(q_idxs)
+    stale_parts = [
+        name for name, q_idxs in manifest['parts'].items()
+        if any(str(q_idx) in changed or str(q_idx) in removed or q_idx in duplicated for q_idx in q_idxs)
+    ]
+    todo = {int(q_idx) for q_idx in changed}
+    for name in stale_parts:
+        todo.update(q_idx for q_idx in manifest['parts'][name] if str(q_idx) in digests)
+    todo = sorted(todo)
+    message = f"{len(digests)} questions with results: {len(changed)} new or changed, {len(removed)} removed"
+    if duplicated:
+        message += f", {len(duplicated)} in several parts"
+    print(f"{message}, {len(stale_parts)} parts to rewrite")
+
+    jobs = []
+    for i in range(0, len(todo), part_size):
+        name = f"part-{manifest['next_part']:05d}.{output_format}"
+        manifest['next_part'] += 1
+        jobs.append((name, todo[i:i + part_size]))
+
+    def drop_parts(names, keep=()):
+        for name in names:
+            for q_idx in manifest['parts'].pop(name):
+                if q_idx not in keep:
+                    manifest['digests'].pop(str(q_idx), None)
+
+    def on_written(name, q_idxs):
+        replaced = [
+            stale for stale in stale_parts
+            if stale in manifest['parts'] and not set(q_idxs).isdisjoint(manifest['parts'][stale])
+        ]
+        drop_parts(replaced, keep=set(q_idxs))
+        manifest['parts'][name] = q_idxs
+        manifest['digests'].update({str(q_idx): digests[str(q_idx)] for q_idx in q_idxs})
+        save_manifest(output_dir, manifest)
+        for stale in replaced:
+            os.remove(f'{output_dir}/{stale}')
+        print(f"{name}: {len(q_idxs)} questions")
+
+    if num_readers > 1:
+        with ProcessPoolExecutor(num_readers) as pool:
+            futures = [
+                (name, q_idxs, pool.submit(write_part, dataset, cache_dir, f'{output_dir}/{name}', q_idxs, output_format, table))
+                for name, q_idxs in jobs
+            ]
+            for name, q_idxs, future in futures:
+                future.result()
+                on_written(name, q_idxs)
+    else:
+        for name, q_idxs in jobs:
+            write_part(dataset, cache_dir, f'{output_dir}/{name}', q_idxs, output_format, table)
+            on_written(name, q_idxs)
+
+    # parts left without a question to keep, and the digests of removed questions
+    replaced = [stale for stale in stale_parts if stale in manifest['parts']]
+    drop_parts(replaced)
+    for q_idx in removed:
+        manifest['digests'].pop(q_idx, None)
+    save_manifest(output_dir, manifest)
+    for name in replaced:
+        os.remove(f'{output_dir}/{name}')
+    return manifest
+
+
+if __name__ == "__main__":
+    from my_config import my_config
+    combine(
+        my_config.dataset,
+        my_config.cache_dir,
+        output_dir=my_config.output_dir,
+        output_format=my_config.output_format,
+        part_size=my_config.part_size,
+        num_readers=my_config.num_readers,
+        full_rebuild=my_config.full_rebuild,
+    )
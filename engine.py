@@ -0,0 +1,260 @@
+import time
+from collections import defaultdict, deque
+from typing import Callable, List, Optional
+import torch
+from llama import Llama, Dialog
+from llama.generation import sample_top_p
+from generation import encode_dialog, copy_cache_rows, forward_rows
+from prefix_cache import PrefixCache
+from stop_conditions import find_stop
+
+
+class Request:
+    def __init__(self, prompt, n, max_gen_len, stop, stop_patterns, temperature, top_p, on_done, store_prefix=True, tag=None):
+        self.prompt = prompt
+        self.n = n
+        self.max_gen_len = max_gen_len
+        self.stop = stop
+        self.stop_patterns = stop_patterns
+        self.temperature = temperature
+        self.top_p = top_p
+        self.on_done = on_done
+        self.store_prefix = store_prefix
+        self.tag = tag
+        self.results = [None] * n
+
+
+class Sequence:
+    def __init__(self, request: Request, sample_idx: int, slot: int):
+        self.request = request
+        self.sample_idx = sample_idx
+        self.slot = slot
+        self.tokens: List[int] = []
+
+
+class ContinuousBatchingEngine:
+    """
+    Generation engine that gives every sequence its own KV-cache slot and refills finished slots right away.
+
+    Requests are queued by `submit`. At every step, queued requests are admitted into the free
+    slots (their prompt is prefilled once and copied into the slots of their other samples),
+    then all active sequences are decoded together, each at its own position. A sequence is
+    retired as soon as it produces EOS, reaches its `max_gen_len` or the end of the context, or
+    contains one of its stop conditions, and its slot goes to the next queued request. Unlike
+    `Llama.chat_completion`, a short answer never waits for the longest sequence of its batch.
+
+    It also has `chat_completion` and `sample_n` methods, so it can be used in place of a `Llama`.
+
+    After every step, `last_step` holds its wall time and, for each request `tag`, the number of
+    decoded rows, of prefilled and generated tokens and of decode steps saved, see `run`.
+
+    Args:
+        llama (Llama): The generator whose model and tokenizer are used.
+        prefix_cache (PrefixCache, optional): If given, prompts start from the longest prefix
+            already in the cache and are added to it after their prefill, unless `store_prefix` is off.
+    """
+
+    def __init__(self, llama: Llama, prefix_cache: Optional[PrefixCache] = None):
+        self.llama = llama
+        self.model = llama.model
+        self.tokenizer = llama.tokenizer
+        self.prefix_cache = prefix_cache
+        self.device = self.model.tok_embeddings.weight.device
+        self.max_batch_size = self.model.params.max_batch_size
+        self.max_seq_len = self.model.params.max_seq_len
+
+        self.queue = deque()
+        self.free_slots = list(range(self.max_batch_size))
+        self.active: List[Sequence] = []
+        self.num_steps = 0
+        self.active_rows = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.step_tags = defaultdict(lambda: defaultdict(int))
+        self.last_step = None
+
+    def submit(
+        self,
+        dialog: Dialog,
+        on_done: Callable,
+        n: int = 1,
+        max_gen_len: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        store_prefix: bool = True,
+        tag=None,
+    ):
+        """
+        Queues `n` samples of a dialog.
+
+        Args:
+            on_done (Callable): Called with the list of the `n` predictions once all of them are done.
+            max_gen_len (int, optional): Maximum number of generated tokens. If None, generation only
+                stops at EOS or at the model's max sequence length.
+            stop (List[str], optional): The generation ends at the first of these strings, which is cut off.
+            stop_patterns (List[str], optional): Regular expressions that end the generation, see
+                `stop_conditions.find_stop`.
+            store_prefix (bool, optional): Add the prompt to the prefix cache. Defaults to True.
+            tag (optional): Label of the request in the step statistics, e.g. its stage.
+
+        The predictions have `decode_steps_saved`: the decode steps their slot was freed before
+        the budget of the request (`max_gen_len`, capped by the context) by EOS or a stop condition.
+        """
+        assert n <= self.max_batch_size, (n, self.max_batch_size)
+        prompt = encode_dialog(self.tokenizer, dialog)
+        assert len(prompt) < self.max_seq_len, (len(prompt), self.max_seq_len)
+        if max_gen_len is None:
+            max_gen_len = self.max_seq_len
+        self.queue.append(Request(prompt, n, max_gen_len, stop, stop_patterns, temperature, top_p, on_done, store_prefix, tag))
+
+    def sample(self, logits, sequences: List[Sequence]):
+        next_tokens = torch.empty(len(sequences), dtype=torch.long, device=logits.device)
+        groups = {}
+        for i, seq in enumerate(sequences):
+            groups.setdefault((seq.request.temperature, seq.request.top_p), []).append(i)
+        for (temperature, top_p), idx in groups.items():
+            if temperature > 0:
+                probs = torch.softmax(logits[idx] / temperature, dim=-1)
+                next_tokens[idx] = sample_top_p(probs, top_p).reshape(-1)
+            else:
+                next_tokens[idx] = torch.argmax(logits[idx], dim=-1)
+        return next_tokens.tolist()
+
+    def admit(self):
+        while self.queue and self.queue[0].n <= len(self.free_slots):
+            request = self.queue.popleft()
+            slots = [self.free_slots.pop(0) for _ in range(request.n)]
+            prompt = request.prompt
+            cached_len = 0
+            if self.prefix_cache is not None:
+                cached_len = self.prefix_cache.load(self.model, slots[0], prompt, len(prompt) - 1)
+            tokens = torch.tensor([prompt[cached_len:]], dtype=torch.long, device=self.device)
+            logits = forward_rows(self.model, tokens, [slots[0]], [cached_len])[0, -1]
+            copy_cache_rows(self.model, slots[0], slots[1:], len(prompt))
+            if self.prefix_cache is not None and request.store_prefix:
+                self.prefix_cache.store(self.model, slots[0], prompt)
+            self.prompt_tokens += len(prompt) - cached_len
+            self.step_tags[request.tag]['prompt_tokens'] += len(prompt) - cached_len
+
+            sequences = [Sequence(request, s, slot) for s, slot in enumerate(slots)]
+            for seq, token in zip(sequences, self.sample(logits.expand(request.n, -1), sequences)):
+                self.append(seq, token)
+
+    def append(self, seq: Sequence, token: int):
+        """Adds a generated token to a sequence, and retires the sequence if it is finished."""
+        request = seq.request
+        remaining = self.max_seq_len - len(request.prompt) - len(seq.tokens)
+        finished = token == self.tokenizer.eos_id or remaining <= 1
+        if token != self.tokenizer.eos_id:
+            seq.tokens.append(token)
+            self.generated_tokens += 1
+            self.step_tags[request.tag]['generated_tokens'] += 1
+            finished = finished or len(seq.tokens) >= request.max_gen_len
+        text = None
+        if request.stop or request.stop_patterns:
+            text = self.tokenizer.decode(seq.tokens)
+            cut = find_stop(text, request.stop, request.stop_patterns)
+            if cut is not None:
+                text = text[:cut]
+                finished = True
+
+        if not finished:
+            if seq not in self.active:
+                self.active.append(seq)
+            return
+        if seq in self.active:
+            self.active.remove(seq)
+        self.free_slots.append(seq.slot)
+        # the slot steps freed before the budget of the request, EOS included
+        limit = min(request.max_gen_len, self.max_seq_len - len(request.prompt))
+        steps_saved = limit - len(seq.tokens) - (token == self.tokenizer.eos_id)
+        self.step_tags[request.tag]['decode_steps_saved'] += steps_saved
+        if text is None:
+            text = self.tokenizer.decode(seq.tokens)
+        request.results[seq.sample_idx] = {
+            "generation": {"role": "assistant", "content": text},
+            "decode_steps_saved": steps_saved,
+        }
+        if all(result is not None for result in request.results):
+            request.on_done(request.results)
+
+    def step(self):
+        """Admits queued requests into the free slots, then decodes one token of every active sequence."""
+        start = time.perf_counter()
+        self.step_tags.clear()
+        self.admit()
+        if self.active:
+            sequences = list(self.active)
+            tokens = torch.tensor([[seq.tokens[-1]] for seq in sequences], dtype=torch.long, device=self.device)
+            positions = [len(seq.request.prompt) + len(seq.tokens) - 1 for seq in sequences]
+            logits = forward_rows(self.model, tokens, [seq.slot for seq in sequences], positions)[:, -1]
+            self.num_steps += 1
+            self.active_rows += len(sequences)
+            for seq in sequences:
+                self.step_tags[seq.request.tag]['rows'] += 1
+            for seq, token in zip(sequences, self.sample(logits, sequences)):
+                self.append(seq, token)
+        self.last_step = {
+            'wall_time': time.perf_counter() - start,
+            'max_batch_size': self.max_batch_size,
+            'tags': {tag: dict(stats) for tag, stats in self.step_tags.items()},
+        }
+
+    def run(self, on_step: Optional[Callable] = None):
+        """
+        Steps until every submitted request is done, including the ones submitted by callbacks.
+
+        Args:
+            on_step (Callable, optional): Called with `last_step` after every step.
+        """
+        while self.queue or self.active:
+            self.step()
+            if on_step is not None:
+                on_step(self.last_step)
+
+    @property
+    def fill_ratio(self):
+        """Average share of the slots holding a sequence during a decode step."""
+        if self.num_steps == 0:
+            return 0.0
+        return self.active_rows / (self.num_steps * self.max_batch_size)
+
+    def sample_n(
+        self,
+        dialogs: List[Dialog],
+        n,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        max_gen_len: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+        store_prefix: bool = True,
+    ):
+        """Same as `LlamaGenerator.sample_n`."""
+        counts = [n] * len(dialogs) if isinstance(n, int) else list(n)
+        out = [None] * len(dialogs)
+        for j, (dialog, count) in enumerate(zip(dialogs, counts)):
+            self.submit(dialog, lambda results, j=j: out.__setitem__(j, results), n=count, max_gen_len=max_gen_len,
+                        stop=stop, stop_patterns=stop_patterns, temperature=temperature, top_p=top_p,
+                        store_prefix=store_prefix)
+        self.run()
+        return out
+
+    def chat_completion(
+        self,
+        dialogs: List[Dialog],
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        max_gen_len: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+        store_prefix: bool = True,
+    ):
+        """Same as `LlamaGenerator.chat_completion`."""
+        results = self.sample_n(
+            dialogs, 1, temperature=temperature, top_p=top_p, max_gen_len=max_gen_len,
+            stop=stop, stop_patterns=stop_patterns, store_prefix=store_prefix,
+        )
+        return [predictions[0] for predictions in results]
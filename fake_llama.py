@@ -0,0 +1,115 @@
+import json
+import time
+import hashlib
+from collections import Counter
+from typing import List, Optional, Tuple
+from stop_conditions import find_stop
+
+
+class FakeLlama:
+    """
+    Deterministic stand-in for the `Llama` generator, for running the pipeline without a GPU.
+
+    The generation of a dialog is a short text derived from a hash of the dialog and of the
+    number of samples of it generated before, so a run always gets the same answers and the
+    samples of a dialog differ, even when they are split across several batches.
+
+    Args:
+        max_batch_size (int, optional): Largest accepted batch. Defaults to 8.
+        token_latency (float, optional): Seconds per decode step. A batch takes as many steps as its
+            longest generation has tokens (words), like a batch of `Llama.generate`. Defaults to 0.
+        output_tokens (Tuple[int, int], optional): If given, every generation has a number of words
+            between these bounds, drawn from its hash and capped at `max_gen_len`. Defaults to two words.
+    """
+
+    def __init__(self, max_batch_size: int = 8, token_latency: float = 0.0, output_tokens: Optional[Tuple[int, int]] = None):
+        self.max_batch_size = max_batch_size
+        self.token_latency = token_latency
+        self.output_tokens = output_tokens
+        self.num_calls = 0
+        self.num_dialogs = 0
+        self.num_samples = Counter()
+        self.last_stats = None
+
+    @staticmethod
+    def build(max_batch_size: int = 8, token_latency: float = 0.0, output_tokens: Optional[Tuple[int, int]] = None, **kwargs):
+        return FakeLlama(max_batch_size=max_batch_size, token_latency=token_latency, output_tokens=output_tokens)
+
+    def generate_text(self, dialog, sample_idx=0, stop=None, stop_patterns=None, max_gen_len=None):
+        digest = hashlib.md5((json.dumps(dialog) + str(sample_idx)).encode()).hexdigest()
+        text = f"answer {digest[:8]}"
+        if self.output_tokens is not None:
+            low, high = self.output_tokens
+            num_words = low + int(digest[8:16], 16) % (high - low + 1)
+            if max_gen_len is not None:
+                num_words = min(num_words, max_gen_len)
+            text = ' '.join(['answer'] + [digest[(4 * i) % 32:(4 * i) % 32 + 4] for i in range(num_words - 1)])
+        cut = find_stop(text, stop, stop_patterns)
+        return text if cut is None else text[:cut]
+
+    def next_samples(self, dialog, count):
+        """Returns the sample indices of the next `count` samples of a dialog."""
+        key = hashlib.md5(json.dumps(dialog).encode()).digest()
+        start = self.num_samples[key]
+        self.num_samples[key] += count
+        return range(start, start + count)
+
+    def decode(self, texts):
+        """Waits for the decode steps of a batch."""
+        if self.token_latency > 0 and texts:
+            time.sleep(self.token_latency * max(len(text.split()) for text in texts))
+
+    def set_stats(self, dialogs, texts):
+        # one token per word
+        self.last_stats = {
+            'prompt_tokens': [sum(len(msg['content'].split()) for msg in dialog) for dialog in dialogs],
+            'generated_tokens': [len(text.split()) for text in texts],
+        }
+
+    def chat_completion(
+        self,
+        dialogs,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        max_gen_len: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+    ):
+        assert len(dialogs) <= self.max_batch_size, (len(dialogs), self.max_batch_size)
+        self.num_calls += 1
+        self.num_dialogs += len(dialogs)
+        texts = [
+            self.generate_text(dialog, s, stop, stop_patterns, max_gen_len)
+            for dialog in dialogs for s in self.next_samples(dialog, 1)
+        ]
+        self.decode(texts)
+        self.set_stats(dialogs, texts)
+        return [{"generation": {"role": "assistant", "content": text}} for text in texts]
+
+    def sample_n(
+        self,
+        dialogs,
+        n,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        max_gen_len: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+    ):
+        counts: List[int] = [n] * len(dialogs) if isinstance(n, int) else list(n)
+        assert sum(counts) <= self.max_batch_size, (sum(counts), self.max_batch_size)
+        self.num_calls += 1
+        self.num_dialogs += sum(counts)
+        texts = [
+            [self.generate_text(dialog, s, stop, stop_patterns, max_gen_len) for s in self.next_samples(dialog, count)]
+            for dialog, count in zip(dialogs, counts)
+        ]
+        self.decode([text for group in texts for text in group])
+        self.set_stats(
+            [dialog for dialog, count in zip(dialogs, counts) for _ in range(count)],
+            [text for group in texts for text in group],
+        )
+        return [
+            [{"generation": {"role": "assistant", "content": text}} for text in group]
+            for group in texts
+        ]
@@ -0,0 +1,284 @@
+import math
+from typing import List, Optional, Union
+import torch
+import torch.nn.functional as F
+from llama import Llama, Dialog
+from llama.generation import B_INST, E_INST, B_SYS, E_SYS, sample_top_p
+from llama.model import repeat_kv
+from prefix_cache import PrefixCache
+from stop_conditions import find_stop
+
+
+def encode_dialog(tokenizer, dialog: Dialog) -> List[int]:
+    """Tokenizes a dialog exactly like `Llama.chat_completion` does."""
+    if dialog[0]["role"] == "system":
+        dialog = [
+            {
+                "role": dialog[1]["role"],
+                "content": B_SYS + dialog[0]["content"] + E_SYS + dialog[1]["content"],
+            }
+        ] + dialog[2:]
+    assert all([msg["role"] == "user" for msg in dialog[::2]]) and all(
+        [msg["role"] == "assistant" for msg in dialog[1::2]]
+    ), "model only supports 'system', 'user' and 'assistant' roles, starting with 'system', then 'user' and alternating (u/a/u/a/u...)"
+    dialog_tokens: List[int] = sum(
+        [
+            tokenizer.encode(
+                f"{B_INST} {(prompt['content']).strip()} {E_INST} {(answer['content']).strip()} ",
+                bos=True,
+                eos=True,
+            )
+            for prompt, answer in zip(dialog[::2], dialog[1::2])
+        ],
+        [],
+    )
+    assert dialog[-1]["role"] == "user", f"Last message must be from user, got {dialog[-1]['role']}"
+    dialog_tokens += tokenizer.encode(
+        f"{B_INST} {(dialog[-1]['content']).strip()} {E_INST}",
+        bos=True,
+        eos=False,
+    )
+    return dialog_tokens
+
+
+def copy_cache_rows(model, src: int, dsts: List[int], length: int):
+    """Copies the first `length` KV-cache positions of row `src` into the rows `dsts`."""
+    if not dsts or length == 0:
+        return
+    for layer in model.layers:
+        attention = layer.attention
+        attention.cache_k[dsts, :length] = attention.cache_k[src:src + 1, :length]
+        attention.cache_v[dsts, :length] = attention.cache_v[src:src + 1, :length]
+
+
+def decode_steps_saved(limits: List[int], decoded: List[int]) -> int:
+    """
+    Returns the decode steps a batch skipped by ending before its budget: `limits` are the tokens
+    each row could generate (its `max_gen_len`, capped by the context) and `decoded` the tokens
+    each row decoded, EOS included. The batch runs as many steps as its longest row.
+    """
+    return max(limits, default=0) - max(decoded, default=0)
+
+
+def rotate(x, freqs_cis):
+    """Rotary embedding of `x` (bsz, seqlen, heads, head_dim) with per-position `freqs_cis` (bsz, seqlen, head_dim / 2)."""
+    x_ = torch.view_as_complex(x.float().reshape(*x.shape[:-1], -1, 2))
+    return torch.view_as_real(x_ * freqs_cis[:, :, None, :]).flatten(3).type_as(x)
+
+
+def attention_rows(attention, x, rows, positions, freqs_cis, mask):
+    """
+    Attention of `x` whose row `i` is at `positions[i]` in the KV-cache row `rows[i]`. `rows` is a
+    slice when the rows are contiguous, so the cached keys and values are read as a view; a tensor
+    of rows gathers them, which copies the visible prefix of every row.
+    """
+    bsz, seqlen, _ = x.shape
+    xq = attention.wq(x).view(bsz, seqlen, attention.n_local_heads, attention.head_dim)
+    xk = attention.wk(x).view(bsz, seqlen, attention.n_local_kv_heads, attention.head_dim)
+    xv = attention.wv(x).view(bsz, seqlen, attention.n_local_kv_heads, attention.head_dim)
+    xq, xk = rotate(xq, freqs_cis), rotate(xk, freqs_cis)
+
+    attention.cache_k = attention.cache_k.to(xq)
+    attention.cache_v = attention.cache_v.to(xq)
+    end = mask.shape[-1]
+    if isinstance(rows, slice):
+        cache_k, cache_v = attention.cache_k[rows], attention.cache_v[rows]
+        batch = torch.arange(bsz, device=x.device)[:, None]
+        cache_k[batch, positions] = xk
+        cache_v[batch, positions] = xv
+        keys, values = cache_k[:, :end], cache_v[:, :end]
+    else:
+        attention.cache_k[rows[:, None], positions] = xk
+        attention.cache_v[rows[:, None], positions] = xv
+        keys, values = attention.cache_k[rows, :end], attention.cache_v[rows, :end]
+    keys, values = repeat_kv(keys, attention.n_rep), repeat_kv(values, attention.n_rep)
+
+    xq, keys, values = xq.transpose(1, 2), keys.transpose(1, 2), values.transpose(1, 2)
+    scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(attention.head_dim) + mask
+    scores = F.softmax(scores.float(), dim=-1).type_as(xq)
+    output = torch.matmul(scores, values).transpose(1, 2).contiguous().view(bsz, seqlen, -1)
+    return attention.wo(output)
+
+
+@torch.inference_mode()
+def forward_rows(model, tokens: torch.Tensor, rows: List[int], start_pos: List[int]):
+    """
+    Same as `Transformer.forward`, but row `i` of `tokens` is written to the KV-cache row `rows[i]`
+    starting at position `start_pos[i]`, so every sequence can be at its own position.
+    """
+    bsz, seqlen = tokens.shape
+    h = model.tok_embeddings(tokens)
+    model.freqs_cis = model.freqs_cis.to(h.device)
+    positions = torch.tensor(start_pos, device=h.device)[:, None] + torch.arange(seqlen, device=h.device)
+    freqs_cis = model.freqs_cis[positions]
+    # each query sees the keys of its own row up to its position; later positions may hold stale entries
+    end = max(start_pos) + seqlen
+    visible = torch.arange(end, device=h.device)[None, None, :] <= positions[:, :, None]
+    mask = torch.zeros(visible.shape, device=h.device).masked_fill(~visible, float("-inf"))[:, None].type_as(h)
+    if list(rows) == list(range(rows[0], rows[0] + bsz)):
+        rows = slice(rows[0], rows[0] + bsz)
+    else:
+        rows = torch.tensor(rows, device=h.device)
+    for layer in model.layers:
+        h = h + attention_rows(layer.attention, layer.attention_norm(h), rows, positions, freqs_cis, mask)
+        h = h + layer.feed_forward(layer.ffn_norm(h))
+    return model.output(model.norm(h)).float()
+
+
+class LlamaGenerator:
+    """
+    Wraps a `Llama` generator with generation methods that reuse the KV cache.
+
+    `chat_completion` keeps the signature and outputs of `Llama.chat_completion`, so the
+    wrapper can be used anywhere a `Llama` is expected. After each call, `last_stats` holds
+    the prompt and generated token counts of every row of the batch.
+
+    Args:
+        llama (Llama): The generator to wrap.
+        prefix_cache (PrefixCache, optional): If given, prompts start from the longest prefix
+            already in the cache and only the remaining tokens are prefilled. Prompts are added
+            to the cache after their prefill, unless `store_prefix` is off.
+    """
+
+    def __init__(self, llama: Llama, prefix_cache: Optional[PrefixCache] = None):
+        self.llama = llama
+        self.model = llama.model
+        self.tokenizer = llama.tokenizer
+        self.prefix_cache = prefix_cache
+        self.device = self.model.tok_embeddings.weight.device
+        self.last_stats = None
+
+    def chat_completion(
+        self,
+        dialogs: List[Dialog],
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        max_gen_len: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+        store_prefix: bool = True,
+    ):
+        """Same as `Llama.chat_completion`, without logprobs, with the stop conditions of `sample_n`."""
+        results = self.sample_n(
+            dialogs, 1, temperature=temperature, top_p=top_p, max_gen_len=max_gen_len,
+            stop=stop, stop_patterns=stop_patterns, store_prefix=store_prefix,
+        )
+        return [predictions[0] for predictions in results]
+
+    @torch.inference_mode()
+    def sample_n(
+        self,
+        dialogs: List[Dialog],
+        n: Union[int, List[int]],
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        max_gen_len: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+        store_prefix: bool = True,
+    ):
+        """
+        Samples several continuations of each dialog while prefilling its prompt only once.
+
+        The whole prompt of every dialog is run through the model a single time in one row of
+        the KV cache, which is then copied into the rows of its other samples. All samples are
+        decoded together afterwards, each at its own position (see `forward_rows`), so a prompt
+        longer than the others of its batch is never fed one token per decode step as in
+        `Llama.generate`. A sample is finished once it produces EOS, has `max_gen_len` tokens,
+        reaches the end of the context or contains a stop condition; finished samples leave the
+        batch, and decoding ends as soon as every sample is finished.
+
+        Args:
+            dialogs (List[Dialog]): Dialogs to complete.
+            n (int or List[int]): Number of samples per dialog. The total number of samples
+                must not exceed the model's max batch size.
+            temperature (float, optional): Temperature value for controlling randomness in sampling. Defaults to 0.6.
+            top_p (float, optional): Top-p probability threshold for nucleus sampling. Defaults to 0.9.
+            max_gen_len (int, optional): Maximum length of the generated sequences. If None, it will be
+                set to the model's max sequence length minus 1.
+            stop (List[str], optional): Strings that end a sample, which is cut before them.
+            stop_patterns (List[str], optional): Regular expressions that end a sample, see
+                `stop_conditions.find_stop`.
+            store_prefix (bool, optional): Add the prompts to the prefix cache. Off for prompts that
+                no later prompt extends. Defaults to True.
+
+        Returns:
+            List[List[ChatPrediction]]: For each dialog, the list of its `n` predictions. `last_stats`
+            also has the `decode_steps_saved` of the batch, see `decode_steps_saved`.
+        """
+        counts = [n] * len(dialogs) if isinstance(n, int) else list(n)
+        params = self.model.params
+        bsz = sum(counts)
+        assert bsz <= params.max_batch_size, (bsz, params.max_batch_size)
+        if max_gen_len is None:
+            max_gen_len = params.max_seq_len - 1
+
+        prompts = [encode_dialog(self.tokenizer, dialog) for dialog in dialogs]
+        rows = []
+        for count in counts:
+            start = sum(len(r) for r in rows)
+            rows.append(list(range(start, start + count)))
+        row_prompts = [prompt for prompt, count in zip(prompts, counts) for _ in range(count)]
+        assert max(len(t) for t in prompts) < params.max_seq_len
+
+        # Each prompt is prefilled in full, at its own positions, in the first row of its samples,
+        # then copied into their other rows. Only the part missing from the prefix cache goes
+        # through the model.
+        logits = torch.zeros((bsz, params.vocab_size), dtype=torch.float, device=self.device)
+        for j, prompt in enumerate(prompts):
+            row = rows[j][0]
+            cached_len = 0
+            if self.prefix_cache is not None:
+                cached_len = self.prefix_cache.load(self.model, row, prompt, len(prompt) - 1)
+            tokens = torch.tensor([prompt[cached_len:]], dtype=torch.long, device=self.device)
+            logits[rows[j]] = forward_rows(self.model, tokens, [row], [cached_len])[0, -1]
+            copy_cache_rows(self.model, row, rows[j][1:], len(prompt))
+            if self.prefix_cache is not None and store_prefix:
+                self.prefix_cache.store(self.model, row, prompt)
+
+        # every row then decodes at its own position, until EOS, its budget, the end of the context
+        # or a stop condition
+        generated: List[List[int]] = [[] for _ in range(bsz)]
+        decoded = [0] * bsz
+        active = list(range(bsz))
+        while active:
+            if temperature > 0:
+                probs = torch.softmax(logits / temperature, dim=-1)
+                next_tokens = sample_top_p(probs, top_p)
+            else:
+                next_tokens = torch.argmax(logits, dim=-1)
+            still_active = []
+            for k, token in zip(active, next_tokens.reshape(-1).tolist()):
+                decoded[k] += 1
+                if token == self.tokenizer.eos_id:
+                    continue
+                generated[k].append(token)
+                if (stop or stop_patterns) and find_stop(self.tokenizer.decode(generated[k]), stop, stop_patterns) is not None:
+                    continue
+                if len(generated[k]) < max_gen_len and len(row_prompts[k]) + len(generated[k]) < params.max_seq_len:
+                    still_active.append(k)
+            active = still_active
+            if active:
+                tokens = torch.tensor([[generated[k][-1]] for k in active], dtype=torch.long, device=self.device)
+                positions = [len(row_prompts[k]) + len(generated[k]) - 1 for k in active]
+                logits = forward_rows(self.model, tokens, active, positions)[:, -1]
+
+        out = []
+        for j, prompt in enumerate(prompts):
+            predictions = []
+            for row in rows[j]:
+                text = self.tokenizer.decode(generated[row])
+                cut = find_stop(text, stop, stop_patterns)
+                if cut is not None:
+                    text = text[:cut]
+                predictions.append({"generation": {"role": "assistant", "content": text}})
+            out.append(predictions)
+
+        self.last_stats = {
+            'prompt_tokens': [len(t) for t in row_prompts],
+            'generated_tokens': [len(toks) for toks in generated],
+            'decode_steps_saved': decode_steps_saved(
+                [min(max_gen_len, params.max_seq_len - len(t)) for t in row_prompts], decoded
+            ),
+        }
+        return out
@@ -0,0 +1,194 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import sqlite3
+from typing import Callable, Dict, List, Optional
+
+
+DIGESTS_FILE = 'weight_digests.json'
+
+
+def file_digest(path, chunk_size: int = 1 << 24):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def weight_digests(ckpt_dir, digests_path):
+    """
+    Returns {file name: sha256} of the weight files of a checkpoint.
+
+    Hashing the weights takes a while, so the digests are kept in the json file `digests_path`,
+    under the absolute path of the checkpoint, with the size and modification time of each
+    file, and a file is only hashed again when they change. The file lives next to the
+    generation cache rather than in the checkpoint, whose directory is often read-only.
+    """
+    ckpt_key = os.path.abspath(ckpt_dir)
+    digests = {}
+    if os.path.exists(digests_path):
+        with open(digests_path, 'r') as f:
+            digests = json.load(f)
+    cached = digests.get(ckpt_key, {})
+    entries = {}
+    for path in sorted(glob.glob(os.path.join(ckpt_dir, '*.pth'))):
+        stat = os.stat(path)
+        entry = cached.get(os.path.basename(path))
+        if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+            entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_digest(path)}
+        entries[os.path.basename(path)] = entry
+    if entries != cached:
+        digests[ckpt_key] = entries
+        try:
+            tmp_path = f'{digests_path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(digests, f)
+            os.replace(tmp_path, digests_path)
+        except OSError:
+            pass
+    return {name: entry['sha256'] for name, entry in entries.items()}
+
+
+def checkpoint_id(ckpt_dir, cache_dir):
+    """
+    Identifies a checkpoint by its `params.json` and the contents of its weight files, whose digests
+    are kept in `{cache_dir}/weight_digests.json`, see `weight_digests`.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    params_path = os.path.join(ckpt_dir, 'params.json')
+    if os.path.exists(params_path):
+        with open(params_path, 'rb') as f:
+            digest.update(f.read())
+    for name, weights in weight_digests(ckpt_dir, os.path.join(cache_dir, DIGESTS_FILE)).items():
+        digest.update(f'{name}:{weights}'.encode())
+    return digest.hexdigest()
+
+
+class GenerationCache:
+    """
+    Content-addressed cache of generations, shared by every stage, run and worker.
+
+    A generation is keyed by a hash of the checkpoint and its context length, the tokenized dialog,
+    the sampling parameters and stop conditions, the seed and the index of the sample, so the same request
+    is never generated twice, whatever question, shard or output directory it comes from,
+    while any change to the model or the sampling gives a new key. Entries live in `{cache_dir}/generations.sqlite`
+    and the least recently used ones are evicted once they take more than `max_bytes`. The total
+    size is kept up to date in the `cache_size` table by every writer, so checking the budget
+    does not scan the cache.
+
+    Args:
+        cache_dir (str): Directory of the cache file.
+        checkpoint (str): Identifier of the model, see `checkpoint_id`.
+        max_bytes (int): Size budget of the cached generations.
+        max_seq_len (int, optional): Context length of the model, which caps the generations.
+        seed (int, optional): Seed of the generator. Defaults to 1, the seed of `Llama.build`.
+        encode (Callable, optional): Tokenizes a dialog, usually `generation.encode_dialog` with the
+            model's tokenizer. Defaults to the json text of the dialog.
+    """
+
+    def __init__(
+        self,
+        cache_dir,
+        checkpoint: str,
+        max_bytes: int,
+        max_seq_len: Optional[int] = None,
+        seed: int = 1,
+        encode: Optional[Callable] = None,
+        timeout: float = 60.0,
+    ):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.checkpoint = checkpoint
+        self.max_bytes = max_bytes
+        self.max_seq_len = max_seq_len
+        self.seed = seed
+        self.encode = encode
+        self.conn = sqlite3.connect(f'{cache_dir}/generations.sqlite', timeout=timeout, isolation_level=None)
+        # workers of other hosts may share the cache directory, which WAL mode does not support
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS generations ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS generations_last_used ON generations (last_used)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY, total INTEGER NOT NULL)')
+        # caches created before the table get their total once
+        self.conn.execute('INSERT OR IGNORE INTO cache_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM generations')
+        self.hits = 0
+        self.misses = 0
+
+    def keys(
+        self,
+        dialog,
+        n: int,
+        temperature: float,
+        top_p: float,
+        max_gen_len: Optional[int],
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+    ) -> List[str]:
+        """Returns the keys of the `n` samples of a dialog."""
+        tokens = self.encode(dialog) if self.encode is not None else json.dumps(dialog)
+        request = [self.checkpoint, self.max_seq_len, tokens, temperature, top_p, max_gen_len, self.seed]
+        if stop or stop_patterns:
+            request += [stop or [], stop_patterns or []]
+        request = json.dumps(request)
+        return [hashlib.sha256(f'{request}{s}'.encode()).hexdigest() for s in range(n)]
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        """Returns {key: generation} for the cached keys, and marks them as recently used."""
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self.conn.execute(
+                f'SELECT key, value FROM generations WHERE key IN ({",".join("?" * len(chunk))})', chunk
+            )
+            found.update(rows)
+        if found:
+            now = time.time()
+            self.conn.executemany('UPDATE generations SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, str]):
+        now = time.time()
+        rows = [(key, value, len(key) + len(value.encode()), now) for key, value in items.items()]
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            replaced = 0
+            keys = list(items)
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                (size,) = self.conn.execute(
+                    f'SELECT COALESCE(SUM(size), 0) FROM generations WHERE key IN ({",".join("?" * len(chunk))})', chunk
+                ).fetchone()
+                replaced += size
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO generations (key, value, size, last_used) VALUES (?, ?, ?, ?)', rows,
+            )
+            self.conn.execute(
+                'UPDATE cache_size SET total = total + ? WHERE id = 0', (sum(row[2] for row in rows) - replaced,)
+            )
+            self.evict()
+
+    def evict(self):
+        """Deletes the least recently used generations over the budget. Called within the transaction of `put_many`."""
+        (total,) = self.conn.execute('SELECT total FROM cache_size WHERE id = 0').fetchone()
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in self.conn.execute('SELECT key, size FROM generations ORDER BY last_used'):
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        self.conn.executemany('DELETE FROM generations WHERE key = ?', evicted)
+        self.conn.execute('UPDATE cache_size SET total = ? WHERE id = 0', (total,))
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+from typing import Optional
+import fire
+from work_queue import WorkQueue
+from run_llama import CACHE_DIR
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def worker_flags(**kwargs):
+    """Returns the command line flags of run_llama.py setting `kwargs`, dicts and lists as json."""
+    flags = []
+    for key, value in kwargs.items():
+        if isinstance(value, (dict, list, tuple)):
+            value = json.dumps(value)
+        flags.append(f'--{key}={value}')
+    return flags
+
+
+def start_worker(worker_idx, gpus, run_args):
+    port = free_port()
+    env = dict(os.environ)
+    if gpus:
+        env['CUDA_VISIBLE_DEVICES'] = str(gpus[worker_idx % len(gpus)])
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_llama.py')
+    cmd = ['torchrun', '--master-port', str(port), script, '--use_queue'] + run_args
+    print(f"worker {worker_idx}: port {port}, CUDA_VISIBLE_DEVICES={env.get('CUDA_VISIBLE_DEVICES')}")
+    return subprocess.Popen(cmd, env=env)
+
+
+def main(
+    num_workers: int,
+    dataset: str,
+    ckpt_dir: str = 'llama-2-7b-chat/',
+    tokenizer_path: str = 'tokenizer.model',
+    max_seq_len: int = 4096,
+    max_batch_size: int = 6,
+    gpus: Optional[str] = None,
+    chunk_size: int = 20,
+    lease_seconds: float = 600.0,
+    max_restarts: int = 3,
+    cache_dir: str = CACHE_DIR,
+    **run_args,
+):
+    """
+    Starts `num_workers` run_llama.py workers on free ports, all pulling from the work queue.
+
+    A worker that exits with an error is restarted (up to `max_restarts` times per worker)
+    as long as the queue still has work; its leased items are picked up again once their
+    lease expires.
+
+    Args:
+        num_workers (int): Number of workers to start.
+        dataset (str): Name of the dataset.
+        gpus (str, optional): Comma separated GPU ids, assigned to the workers round-robin.
+            If None, CUDA_VISIBLE_DEVICES is left unchanged.
+        cache_dir (str, optional): Root of the outputs and of the work queue. Defaults to `run_llama.CACHE_DIR`.
+        **run_args: Other options of `run_llama.main` (e.g. --stage_settings, --generation_cache_gb),
+            passed on to every worker.
+    """
+    if gpus is None:
+        gpus = []
+    elif isinstance(gpus, (list, tuple)):
+        gpus = [str(gpu) for gpu in gpus]
+    else:
+        gpus = [gpu for gpu in str(gpus).split(',') if gpu != '']
+    run_args = worker_flags(
+        ckpt_dir=ckpt_dir,
+        tokenizer_path=tokenizer_path,
+        max_seq_len=max_seq_len,
+        max_batch_size=max_batch_size,
+        dataset=dataset,
+        chunk_size=chunk_size,
+        lease_seconds=lease_seconds,
+        cache_dir=cache_dir,
+        **run_args,
+    )
+
+    queue = WorkQueue(cache_dir, dataset, lease_seconds=lease_seconds)
+    workers = {i: start_worker(i, gpus, run_args) for i in range(num_workers)}
+    restarts = {i: 0 for i in range(num_workers)}
+
+    while workers:
+        time.sleep(10)
+        for i, proc in list(workers.items()):
+            code = proc.poll()
+            if code is None:
+                continue
+            del workers[i]
+            counts = queue.counts()
+            remaining = counts['pending'] + counts['leased'] + counts['expired']
+            if code != 0 and remaining > 0 and restarts[i] < max_restarts:
+                restarts[i] += 1
+                print(f"worker {i} exited with code {code}, restarting ({restarts[i]}/{max_restarts})")
+                workers[i] = start_worker(i, gpus, run_args)
+            else:
+                print(f"worker {i} exited with code {code}")
+
+    counts = queue.counts()
+    print(f"work queue: {counts}")
+    sys.exit(0 if counts['done'] > 0 and counts['pending'] + counts['leased'] + counts['expired'] == 0 else 1)
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,162 @@
+import os
+import sys
+import json
+import glob
+import time
+import resource
+import threading
+from collections import Counter, defaultdict
+import fire
+
+
+class Metrics:
+    """
+    Writes performance records of one worker to `{cache_dir}/{dataset}/metrics/{worker}.jsonl`.
+
+    Every record is a json line with an `event` (`generate`, `store_read`, `store_write`,
+    `store_enqueue`), the `stage` it belongs to and its measurements. `summarize` aggregates
+    the files of all workers. Records may come from several threads.
+    """
+
+    def __init__(self, cache_dir, dataset, worker):
+        os.makedirs(f'{cache_dir}/{dataset}/metrics', exist_ok=True)
+        self.path = f'{cache_dir}/{dataset}/metrics/{worker}.jsonl'
+        self.file = open(self.path, 'a')
+        self.lock = threading.Lock()
+
+    def record(self, event, stage, **fields):
+        fields.update({'event': event, 'stage': stage, 'time': time.time()})
+        with self.lock:
+            self.file.write(json.dumps(fields) + '\n')
+            self.file.flush()
+
+    def record_commit(self, records, wall_time):
+        """Records a batch of (stage, q_idx, value) committed by `AsyncResultStore`, its time split between the stages."""
+        for stage, count in Counter(stage for stage, _, _ in records).items():
+            self.record('store_write', stage, wall_time=wall_time * count / len(records), count=count)
+
+    def close(self):
+        self.file.close()
+
+
+def peak_memory():
+    """Returns (peak GPU memory since the last call, peak host RSS), in bytes."""
+    gpu = None
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available():
+        gpu = torch.cuda.max_memory_allocated()
+        torch.cuda.reset_peak_memory_stats()
+    return gpu, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class InstrumentedStore:
+    """
+    Result store wrapper recording the time spent in every read and write.
+
+    Args:
+        queued_writes (bool, optional): Whether `put` only queues the result, as with
+            `AsyncResultStore`. Its time is then recorded as `store_enqueue`, and the commits
+            are recorded as `store_write` by the writer thread, see `Metrics.record_commit`.
+    """
+
+    def __init__(self, store, metrics: Metrics, queued_writes: bool = False):
+        self.store = store
+        self.metrics = metrics
+        self.write_event = 'store_enqueue' if queued_writes else 'store_write'
+
+    def timed(self, event, stage, method, *args, count=1):
+        start = time.perf_counter()
+        out = method(*args)
+        self.metrics.record(event, stage, wall_time=time.perf_counter() - start, count=count)
+        return out
+
+    def exists(self, stage, q_idx):
+        return self.timed('store_read', stage, self.store.exists, stage, q_idx)
+
+    def get(self, stage, q_idx):
+        return self.timed('store_read', stage, self.store.get, stage, q_idx)
+
+    def put(self, stage, q_idx, value):
+        return self.timed(self.write_event, stage, self.store.put, stage, q_idx, value)
+
+    def done_ids(self, stage):
+        return self.timed('store_read', stage, self.store.done_ids, stage)
+
+    def get_many(self, stage, q_idxs=None):
+        return self.timed('store_read', stage, self.store.get_many, stage, q_idxs)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)] if values else 0.0
+
+
+def summarize(dataset: str, cache_dir: str = '/newdisk/reflective_thinking', output: str = None):
+    """
+    Aggregates the metrics files of all workers into a per-stage breakdown.
+
+    The wall time and tokens/sec of a stage count the share of each batch given to its rows,
+    while the latency percentiles are those of the whole batches (or engine steps) it was part of.
+
+    Args:
+        dataset (str): Name of the dataset.
+        output (str, optional): Path of a json file to also write the summary to.
+    """
+    gen = defaultdict(lambda: defaultdict(list))
+    io = defaultdict(lambda: defaultdict(float))
+    files = glob.glob(f'{cache_dir}/{dataset}/metrics/*.jsonl')
+    for path in files:
+        with open(path, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                if record['event'] == 'generate':
+                    # older records have no batch_wall_time, their attributed time is the closest
+                    record.setdefault('batch_wall_time', record['wall_time'])
+                    for key, value in record.items():
+                        if isinstance(value, (int, float)):
+                            gen[record['stage']][key].append(value)
+                else:
+                    io[record['stage']][f"{record['event']}_time"] += record['wall_time']
+                    io[record['stage']][f"{record['event']}s"] += record['count']
+
+    summary = {}
+    for stage in sorted(set(gen) | set(io)):
+        g = gen[stage]
+        wall_time = sum(g['wall_time'])
+        generated = sum(g['generated_tokens'])
+        padded = sum(g['prompt_tokens']) + sum(g['padding_tokens'])
+        summary[stage] = {
+            'batches': len(g['wall_time']),
+            'rows': sum(g['rows']),
+            'wall_time': wall_time,
+            'prompt_tokens': sum(g['prompt_tokens']),
+            'generated_tokens': generated,
+            'tokens_per_sec': generated / wall_time if wall_time else 0.0,
+            'batch_fill': sum(g['rows']) / sum(g['max_batch_size']) if g['max_batch_size'] else 0.0,
+            'padding_fraction': sum(g['padding_tokens']) / padded if padded else 0.0,
+            'latency_p50': percentile(g['batch_wall_time'], 0.5),
+            'latency_p95': percentile(g['batch_wall_time'], 0.95),
+            'peak_gpu_memory': max(g['peak_gpu_memory'], default=None),
+            'peak_host_memory': max(g['peak_host_memory'], default=None),
+            **io[stage],
+        }
+
+    print(f"{len(files)} metrics files")
+    print(f"{'stage':<16}{'batches':>8}{'rows':>8}{'gen s':>10}{'tok/s':>9}{'fill':>6}{'pad':>6}{'p50 s':>8}{'p95 s':>8}{'read s':>8}{'write s':>8}")
+    for stage, s in summary.items():
+        print(
+            f"{stage:<16}{s['batches']:>8}{s['rows']:>8}{s['wall_time']:>10.1f}{s['tokens_per_sec']:>9.1f}"
+            f"{s['batch_fill']:>6.2f}{s['padding_fraction']:>6.2f}{s['latency_p50']:>8.2f}{s['latency_p95']:>8.2f}"
+            f"{s.get('store_read_time', 0.0):>8.2f}{s.get('store_write_time', 0.0):>8.2f}"
+        )
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    fire.Fire(summarize)
@@ -1,7 +1,4 @@
 import argparse
-import hashlib
-import json
-import os
 
 
 parser = argparse.ArgumentParser()
@@ -16,6 +13,13 @@ parser.add_argument('--tokenizer_path', type=str, default='tokenizer.model')
 parser.add_argument('--max_seq_len', type=int, default=512)
 parser.add_argument('--max_batch_size', type=int, default=6)
 
+# combine_data.py
+parser.add_argument('--output_dir', type=str, default=None, help='directory of the merged parts, all_data_{dataset} by default')
+parser.add_argument('--output_format', type=str, default='jsonl', choices=['jsonl', 'parquet'], help='format of the merged parts')
+parser.add_argument('--part_size', type=int, default=1000, help='number of questions per merged part')
+parser.add_argument('--num_readers', type=int, default=1, help='number of processes writing merged parts')
+parser.add_argument('--full_rebuild', action='store_true', default=False, help='ignore the merge manifest and merge everything again')
+
 # preproces:
 parser.add_argument('--save_hidden_states', action='store_true', default=False, help='whether to save model hidden states during preprocessing')
 parser.add_argument('--train_from_path', action='store_true', default=False, help='loading a model')
@@ -69,4 +73,10 @@ parser.add_argument('--wandb_name', type=str, help='wandb run id')
 parser.add_argument('--seed', type=int, default=42)
 
 
-my_config = parser.parse_args()
\ No newline at end of file
+def __getattr__(name):
+    # sys.argv is only parsed when `my_config` is first used, not when the module is imported,
+    # so that importing it from a fire entry point does not parse that entry point's flags
+    if name == 'my_config':
+        globals()['my_config'] = parser.parse_args()
+        return globals()['my_config']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
@@ -0,0 +1,571 @@
+import os
+import copy
+import json
+from typing import Callable, Dict, List, Optional
+from collections import defaultdict
+from batching import BatchScheduler, record_step
+from agreement import answer_agreement
+from result_store import SKIP_REASONS
+
+
+HOTPOTQA_SYSTEM_PROMPT = "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."
+NUM_SAMPLES = 4
+# stage whose samples are compared for the early exit of `Stage.early_exit` stages
+AGREEMENT_STAGE = 'init_responses'
+# a newline after a short first line, for `Stage.stop_patterns`
+SHORT_ANSWER_PATTERN = r'^\s*[^\n]{1,200}?(\n)'
+
+
+def format_context(context):
+    formatted_context = ""
+    for title, sentences in zip(context['title'], context['sentences']):
+        formatted_context += f"{title}: " + " ".join(sentences) + " "
+    return formatted_context
+
+
+def hotpotqa_prompt(item):
+    return f"Context: {item['formatted_context']}\n Question: {item['question']} \n Provide a short answer without explanation."
+
+
+def init_responses_dialogs(dataset, item, deps):
+    question = item['question']
+    if dataset == 'truthfulqa':
+        return [
+            [{"role": "user", "content": f"{question}"}]
+        ]
+    elif dataset == 'hotpotqa':
+        return [
+            [
+                {"role": "system", "content": HOTPOTQA_SYSTEM_PROMPT},
+                {"role": "user", "content": hotpotqa_prompt(item)},
+            ]
+        ]
+
+
+def init_critiques_dialogs(dataset, item, deps):
+    question = item['question']
+    all_responses = deps['init_responses']
+    if dataset == 'truthfulqa':
+        return [
+            [
+                {"role": "user", "content": f"{question}"},
+                {"role": "assistant", "content": f"{response}"},
+                {"role": "user", "content": "Could you critique your last response?"},
+            ]
+            for response in all_responses
+        ]
+    elif dataset == 'hotpotqa':
+        return [
+            [
+                {"role": "system", "content": HOTPOTQA_SYSTEM_PROMPT},
+                {"role": "user", "content": hotpotqa_prompt(item)},
+                {"role": "assistant", "content": f"{response}"},
+                {"role": "user", "content": f"Please review and critique your previous response. You can refer back to the original context if needed."},
+            ]
+            for response in all_responses
+        ]
+
+
+def res_wo_ref_dialogs(dataset, item, deps):
+    question = item['question']
+    all_responses = deps['init_responses']
+    if dataset == 'truthfulqa':
+        dialog = [{"role": "system", "content": HOTPOTQA_SYSTEM_PROMPT}]
+        for response in all_responses:
+            dialog.append({"role": "user", "content": f"{question}"})
+            dialog.append({"role": "assistant", "content": f"{response}"})
+        dialog.append({"role": "user", "content": f"{question}"})
+    elif dataset == 'hotpotqa':
+        dialog = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": hotpotqa_prompt(item)},
+        ]
+        for response in all_responses:
+            dialog.append({"role": "assistant", "content": f"{response}"})
+            dialog.append({"role": "user", "content": f"{question}\n Provide a short answer without explanation."})
+    return [dialog]
+
+
+def res_w_ref_dialogs(dataset, item, deps):
+    question = item['question']
+    all_responses = deps['init_responses']
+    all_critiques = deps['init_critiques']
+    if dataset == 'truthfulqa':
+        dialog = [{"role": "system", "content": HOTPOTQA_SYSTEM_PROMPT}]
+        for response, critique in zip(all_responses, all_critiques):
+            dialog.append({"role": "user", "content": f"{question}"})
+            dialog.append({"role": "assistant", "content": f"{response}"})
+            dialog.append({"role": "user", "content": "Please review and critique your previous response."})
+            dialog.append({"role": "assistant", "content": f"{critique}"})
+        dialog.append({"role": "user", "content": f"{question}"})
+    elif dataset == 'hotpotqa':
+        dialog = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": hotpotqa_prompt(item)},
+        ]
+        for response, critique in zip(all_responses, all_critiques):
+            dialog.append({"role": "assistant", "content": f"{response}"})
+            dialog.append({"role": "user", "content": "Please review and critique your previous response. You can refer back to the original context if needed."})
+            dialog.append({"role": "assistant", "content": f"{critique}"})
+            dialog.append({"role": "user", "content": f"{question}\n Provide a short answer without explanation."})
+    return [dialog]
+
+
+def skip_long_context(dataset, item):
+    # with a token index, StageDAG checks the real token count instead
+    if dataset == 'hotpotqa' and 'prompt_tokens' not in item and len(item['formatted_context']) >= 8000:
+        return "context too long"
+    return None
+
+
+def skip_res_w_ref(dataset, item):
+    if dataset == 'truthfulqa' and item['q_idx'] in [153, 192, 504]:
+        return "excluded question"
+    return None
+
+
+class Stage:
+    """
+    One node type of the reflection pipeline.
+
+    Args:
+        name (str): Name of the stage, also the name of its output directory.
+        deps (List[str]): Stages whose outputs are needed to build the dialogs.
+        build_dialogs (Callable): Called as `build_dialogs(dataset, item, deps)` with the outputs
+            of the dependencies, returns the dialogs to generate.
+        max_gen_len (int, optional): Generation budget of the stage. If None, the `max_gen_len`
+            given to the pipeline is used.
+        single (bool): Whether the stage stores a single generation instead of a list.
+        n_samples (int): Number of samples generated for each dialog.
+        skip (Callable, optional): Called as `skip(dataset, item)`, returns a reason if the
+            stage should not be run for that question.
+        stop (List[str], optional): Strings that end a generation, see `stop_conditions.find_stop`.
+        stop_patterns (List[str], optional): Regular expressions of a complete answer that end a
+            generation, like `SHORT_ANSWER_PATTERN`.
+        speculative (bool): Whether the stage is generated with speculative decoding when the
+            pipeline has a speculative generator, see `speculative`.
+        early_exit (bool): Whether the stage is skipped for questions whose `AGREEMENT_STAGE`
+            samples agree, when the pipeline has an `agreement_threshold`.
+        store_prefix (bool): Whether the prompts of the stage are added to the prefix cache of the
+            generator, see `prefix_cache`. Off for the last stage, whose prompts nothing extends.
+        dataset_settings (Dict[str, dict], optional): Settings among `STAGE_SETTINGS` that only apply to
+            one dataset, as {dataset: {setting: value}}, see `stages_for_dataset`.
+
+    `max_gen_len`, `stop`, `stop_patterns`, `speculative` and `store_prefix` are enforced by the generator.
+    They and `early_exit` can be overridden per stage with `apply_stage_settings`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        deps: List[str],
+        build_dialogs: Callable,
+        max_gen_len: Optional[int] = None,
+        single: bool = False,
+        n_samples: int = 1,
+        skip: Optional[Callable] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+        speculative: bool = False,
+        early_exit: bool = False,
+        store_prefix: bool = True,
+        dataset_settings: Optional[Dict[str, dict]] = None,
+    ):
+        self.name = name
+        self.deps = deps
+        self.build_dialogs = build_dialogs
+        self.max_gen_len = max_gen_len
+        self.single = single
+        self.n_samples = n_samples
+        self.skip = skip
+        self.stop = stop
+        self.stop_patterns = stop_patterns
+        self.speculative = speculative
+        self.early_exit = early_exit
+        self.store_prefix = store_prefix
+        self.dataset_settings = dataset_settings or {}
+
+
+STAGES = [
+    # the hotpotqa prompts of the answering stages ask for a short answer, which ends at its first line
+    Stage(
+        'init_responses', [], init_responses_dialogs, max_gen_len=384, n_samples=NUM_SAMPLES, skip=skip_long_context,
+        dataset_settings={'hotpotqa': {'stop_patterns': [SHORT_ANSWER_PATTERN]}},
+    ),
+    Stage('init_critiques', ['init_responses'], init_critiques_dialogs, early_exit=True),
+    Stage(
+        'res_wo_ref', ['init_responses'], res_wo_ref_dialogs,
+        single=True, speculative=True, early_exit=True,
+        dataset_settings={'hotpotqa': {'max_gen_len': 128, 'stop_patterns': [SHORT_ANSWER_PATTERN]}},
+    ),
+    Stage(
+        'res_w_ref', ['init_responses', 'init_critiques'], res_w_ref_dialogs,
+        single=True, skip=skip_res_w_ref, speculative=True, early_exit=True, store_prefix=False,
+        dataset_settings={'hotpotqa': {'max_gen_len': 128, 'stop_patterns': [SHORT_ANSWER_PATTERN]}},
+    ),
+]
+
+STAGE_SETTINGS = ['max_gen_len', 'stop', 'stop_patterns', 'speculative', 'early_exit', 'store_prefix']
+
+
+def load_stage_settings(settings):
+    """Reads stage settings given as a dict, a json string or the path of a json file."""
+    if settings is None or isinstance(settings, dict):
+        return settings
+    if os.path.exists(settings):
+        with open(settings, 'r') as f:
+            return json.load(f)
+    return json.loads(settings)
+
+
+def stages_for_dataset(stages: List[Stage], dataset: str):
+    """Returns copies of `stages` with their `dataset_settings` for `dataset` applied."""
+    return apply_stage_settings(stages, {
+        stage.name: stage.dataset_settings[dataset] for stage in stages if dataset in stage.dataset_settings
+    })
+
+
+def apply_stage_settings(stages: List[Stage], settings: Optional[Dict[str, dict]]):
+    """
+    Returns copies of `stages` with the generation settings of `settings` applied.
+
+    Args:
+        settings (Dict[str, dict], optional): {stage name: {setting: value}}, with settings among
+            `STAGE_SETTINGS`, e.g. `{"res_wo_ref": {"max_gen_len": 64, "stop_patterns": [SHORT_ANSWER_PATTERN]}}`.
+    """
+    settings = settings or {}
+    unknown = set(settings) - {stage.name for stage in stages}
+    if unknown:
+        raise ValueError(f"settings for unknown stages {sorted(unknown)}")
+    out = []
+    for stage in stages:
+        stage = copy.copy(stage)
+        for key, value in settings.get(stage.name, {}).items():
+            if key not in STAGE_SETTINGS:
+                raise ValueError(f"unknown stage setting {key}, expected one of {STAGE_SETTINGS}")
+            setattr(stage, key, value)
+        out.append(stage)
+    return out
+
+
+class StageDAG:
+    """
+    Runs the stages of the pipeline as a dependency graph over many questions.
+
+    A node is one (stage, q_idx) pair. Nodes whose output already exists in the store are
+    done from the start, so an interrupted run resumes where it stopped. At every round all
+    ready nodes (every dependency done) of all questions are generated together, packed in
+    full batches; nodes of different stages share a batch when they use the same generation
+    budget. The loop stops when nothing is ready; the remaining nodes are blocked. With a
+    continuous batching engine as generator, there are no rounds, see `run_continuous`.
+
+    Skipped nodes are not generated, and the reason of every skip is written to the store as
+    {stage: reason} under the `SKIP_REASONS` pseudo-stage, so that `combine_data` can label
+    them. With an `agreement_threshold`, the `early_exit` stages of a question are skipped as
+    soon as the normalized answers of its `AGREEMENT_STAGE` samples agree at least that much
+    (see `agreement.answer_agreement`). They are only skipped, not done, so a later run
+    without the threshold generates them.
+
+    Args:
+        generator: Object with a `chat_completion` method, usually a `Llama`, or a
+            `ContinuousBatchingEngine`.
+        store: Result store with `done_ids`, `get` and `put` methods, see `result_store`.
+        dataset (str): Name of the dataset.
+        items (List[dict]): Questions to process, each with at least `q_idx` and `question`
+            (and `formatted_context` for hotpotqa).
+        stages (List[Stage], optional): Stages to run. Defaults to `STAGES` with the settings of the
+            dataset, see `stages_for_dataset`. Dependencies left out of the list are only read from the store.
+        count_tokens (Callable, optional): Returns the prompt length of a dialog in tokens. If given,
+            nodes whose prompt leaves less than `min_gen_len` tokens of `max_seq_len` are skipped,
+            and batches are formed from dialogs of similar length. Items may carry their first
+            prompt length as `prompt_tokens` (see `token_index`) to be skipped without building
+            their dialogs.
+        max_seq_len (int, optional): Maximum sequence length of the model.
+        min_gen_len (int, optional): Number of tokens a prompt must leave for generation. Defaults to 64.
+        metrics (Metrics, optional): Where to record the time and tokens of every batch, see `metrics`.
+        cache (GenerationCache, optional): Cache of generations shared by all stages, see `generation_cache`.
+        speculative (SpeculativeGenerator, optional): Generator of the stages with `speculative` set,
+            see `speculative`. Not used with a continuous batching engine.
+        agreement_threshold (float, optional): Share of the `AGREEMENT_STAGE` samples that must give
+            the same normalized answer to skip the `early_exit` stages of a question, e.g. 1.0 when
+            all of them agree. Disabled if None.
+    """
+
+    def __init__(
+        self,
+        generator,
+        store,
+        dataset: str,
+        items: List[dict],
+        max_batch_size: int,
+        max_gen_len: Optional[int] = None,
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        stages: Optional[List[Stage]] = None,
+        count_tokens: Optional[Callable] = None,
+        max_seq_len: Optional[int] = None,
+        min_gen_len: int = 64,
+        metrics=None,
+        cache=None,
+        speculative=None,
+        agreement_threshold: Optional[float] = None,
+    ):
+        self.generator = generator
+        self.store = store
+        self.dataset = dataset
+        self.items = {item['q_idx']: item for item in items}
+        self.max_batch_size = max_batch_size
+        self.max_gen_len = max_gen_len
+        self.temperature = temperature
+        self.top_p = top_p
+        self.stages = {stage.name: stage for stage in (stages or stages_for_dataset(STAGES, dataset))}
+        self.count_tokens = count_tokens
+        self.max_seq_len = max_seq_len
+        self.min_gen_len = min_gen_len
+        self.metrics = metrics
+        self.cache = cache
+        self.speculative = speculative
+        self.agreement_threshold = agreement_threshold
+
+        self.outputs: Dict[tuple, object] = {}
+        self.skipped: Dict[tuple, str] = {}
+        self.done = set()
+        self.running = set()
+        self.schedulers = None
+        self.steps_saved = defaultdict(int)
+        self.speculative_stats = defaultdict(lambda: defaultdict(int))
+        stage_names = set(self.stages)
+        for stage in self.stages.values():
+            stage_names.update(stage.deps)
+        for stage_name in stage_names:
+            done_ids = self.store.done_ids(stage_name)
+            for q_idx in self.items:
+                if q_idx in done_ids:
+                    self.done.add((stage_name, q_idx))
+        self.skip_reasons = self.store.get_many(SKIP_REASONS, list(self.items))
+
+    def get_output(self, stage_name, q_idx):
+        node = (stage_name, q_idx)
+        if node not in self.outputs:
+            self.outputs[node] = self.store.get(stage_name, q_idx)
+        return self.outputs[node]
+
+    def ready_nodes(self, q_idxs=None):
+        ready = []
+        for q_idx in (self.items if q_idxs is None else q_idxs):
+            item = self.items[q_idx]
+            for stage in self.stages.values():
+                node = (stage.name, q_idx)
+                if node in self.done or node in self.skipped or node in self.running:
+                    continue
+                # checked before the dependencies, so that stages depending on skipped ones are skipped too
+                reason = self.early_exit_reason(stage, q_idx)
+                if reason is None:
+                    if not all((dep, q_idx) in self.done for dep in stage.deps):
+                        continue
+                    reason = stage.skip(self.dataset, item) if stage.skip is not None else None
+                if reason is None and not stage.deps and 'prompt_tokens' in item and self.over_budget(item['prompt_tokens']):
+                    reason = f"prompt too long ({item['prompt_tokens']} tokens)"
+                if reason is not None:
+                    self.skip(node, reason)
+                    continue
+                ready.append(node)
+        return ready
+
+    def early_exit_reason(self, stage, q_idx):
+        if self.agreement_threshold is None or not stage.early_exit or (AGREEMENT_STAGE, q_idx) not in self.done:
+            return None
+        agreement = answer_agreement(self.get_output(AGREEMENT_STAGE, q_idx))
+        if agreement >= self.agreement_threshold:
+            return f"{AGREEMENT_STAGE} agree ({agreement:.2f} >= {self.agreement_threshold})"
+        return None
+
+    def skip(self, node, reason):
+        """Marks a node as skipped and records the reason in the store."""
+        stage_name, q_idx = node
+        self.skipped[node] = reason
+        reasons = self.skip_reasons.setdefault(q_idx, {})
+        if reasons.get(stage_name) != reason:
+            reasons[stage_name] = reason
+            self.store.put(SKIP_REASONS, q_idx, dict(reasons))
+
+    def over_budget(self, num_tokens):
+        return self.max_seq_len is not None and num_tokens + self.min_gen_len > self.max_seq_len
+
+    def blocked_nodes(self):
+        """Returns {(stage, q_idx): reason} for every node that is neither done nor runnable."""
+        blocked = dict(self.skipped)
+        for q_idx in self.items:
+            for stage in self.stages.values():
+                node = (stage.name, q_idx)
+                if node in self.done or node in blocked:
+                    continue
+                missing = [dep for dep in stage.deps if (dep, q_idx) not in self.done]
+                blocked[node] = f"waiting for {', '.join(missing)}"
+        return blocked
+
+    def generation_settings(self, stage_name):
+        """
+        Returns (max_gen_len, stop, stop_patterns, speculative, store_prefix) of a stage; nodes with
+        the same settings share batches.
+        """
+        stage = self.stages[stage_name]
+        max_gen_len = stage.max_gen_len if stage.max_gen_len is not None else self.max_gen_len
+        speculative = stage.speculative and self.speculative is not None and not hasattr(self.generator, 'submit')
+        return max_gen_len, tuple(stage.stop or ()), tuple(stage.stop_patterns or ()), speculative, stage.store_prefix
+
+    def make_scheduler(self, settings, lengths):
+        max_gen_len, stop, stop_patterns, speculative, store_prefix = settings
+        return BatchScheduler(
+            self.speculative if speculative else self.generator,
+            self.max_batch_size,
+            max_gen_len=max_gen_len,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            count_tokens=(lambda dialog: lengths[id(dialog)]) if lengths is not None else None,
+            metrics=self.metrics,
+            stage_of=lambda node: node[0],
+            cache=self.cache,
+            stop=list(stop),
+            stop_patterns=list(stop_patterns),
+            store_prefix=store_prefix,
+        )
+
+    def add_node(self, scheduler, node, lengths):
+        """Builds the dialogs of a node and adds them to `scheduler`. Returns False if the node is skipped."""
+        stage_name, q_idx = node
+        stage = self.stages[stage_name]
+        deps = {dep: self.get_output(dep, q_idx) for dep in stage.deps}
+        dialogs = stage.build_dialogs(self.dataset, self.items[q_idx], deps)
+        if self.count_tokens is not None:
+            for dialog in dialogs:
+                lengths[id(dialog)] = self.count_tokens(dialog)
+            longest = max(lengths[id(dialog)] for dialog in dialogs)
+            if self.over_budget(longest):
+                self.skip(node, f"prompt too long ({longest} tokens)")
+                return False
+        scheduler.add(node, dialogs, self.on_done, n=stage.n_samples)
+        return True
+
+    def run(self):
+        if hasattr(self.generator, 'submit'):
+            return self.run_continuous()
+
+        rounds = 0
+        while True:
+            ready = self.ready_nodes()
+            if not ready:
+                break
+            rounds += 1
+
+            by_settings = defaultdict(list)
+            for node in ready:
+                by_settings[self.generation_settings(node[0])].append(node)
+
+            for settings, nodes in by_settings.items():
+                lengths = {} if self.count_tokens is not None else None
+                scheduler = self.make_scheduler(settings, lengths)
+                for node in nodes:
+                    self.add_node(scheduler, node, lengths)
+                scheduler.flush()
+                self.add_stats(scheduler)
+                message = f"round {rounds}: {len(nodes)} nodes in {scheduler.num_batches} batches (fill {scheduler.fill_ratio:.2f}"
+                if self.count_tokens is not None:
+                    message += f", padding {scheduler.padding_fraction:.2f}"
+                print(message + ")")
+
+        return self.blocked_nodes()
+
+    def run_continuous(self):
+        """
+        Runs the graph on a continuous batching engine (see `engine`): a node is submitted as soon
+        as its dependencies are done, instead of waiting for the end of a round.
+        """
+        self.schedulers = {}
+        num_done = len(self.done)
+        for node in self.ready_nodes():
+            self.submit(node)
+        on_step = None
+        if self.metrics is not None:
+            on_step = lambda step: record_step(self.metrics, step)
+        self.generator.run(on_step=on_step)
+        for scheduler in self.schedulers.values():
+            self.add_stats(scheduler)
+        print(f"{len(self.done) - num_done} nodes in {self.generator.num_steps} decode steps (fill {self.generator.fill_ratio:.2f})")
+        self.schedulers = None
+        return self.blocked_nodes()
+
+    def submit(self, node):
+        settings = self.generation_settings(node[0])
+        if settings not in self.schedulers:
+            self.schedulers[settings] = self.make_scheduler(settings, None)
+        self.running.add(node)
+        if not self.add_node(self.schedulers[settings], node, {}):
+            self.running.discard(node)
+
+    def add_stats(self, scheduler):
+        for stage_name, steps in scheduler.steps_saved.items():
+            self.steps_saved[stage_name] += steps
+        for stage_name, stats in scheduler.speculative.items():
+            for key, value in stats.items():
+                self.speculative_stats[stage_name][key] += value
+
+    def on_done(self, node, generations):
+        stage_name, q_idx = node
+        output = generations[-1] if self.stages[stage_name].single else generations
+        self.store.put(stage_name, q_idx, output)
+        self.outputs[node] = output
+        self.done.add(node)
+        self.running.discard(node)
+        if self.schedulers is not None:
+            for ready in self.ready_nodes([q_idx]):
+                self.submit(ready)
+
+    def report(self, blocked=None):
+        if blocked is None:
+            blocked = self.blocked_nodes()
+        counts = defaultdict(int)
+        for (stage_name, _) in self.done:
+            if stage_name in self.stages:
+                counts[stage_name] += 1
+        skipped = defaultdict(int)
+        for (stage_name, _) in self.skipped:
+            skipped[stage_name] += 1
+        for stage_name in self.stages:
+            message = f"{stage_name}: {counts[stage_name]}/{len(self.items)} done"
+            if skipped[stage_name]:
+                message += f", {skipped[stage_name]} skipped"
+            if self.steps_saved[stage_name]:
+                message += f", {self.steps_saved[stage_name]:.0f} decode steps skipped before its budget"
+            stats = self.speculative_stats.get(stage_name)
+            if stats and stats['steps']:
+                acceptance = stats['accepted'] / stats['proposed'] if stats['proposed'] else 0.0
+                message += (
+                    f", speculative: {acceptance:.2f} of {stats['proposed']} draft tokens accepted,"
+                    f" {stats['tokens'] / stats['steps']:.2f} tokens per main model step"
+                )
+            print(message)
+        for (stage_name, q_idx), reason in sorted(blocked.items(), key=lambda x: (x[0][1], x[0][0])):
+            print(f"blocked {stage_name} {q_idx}: {reason}")
+
+
+def run_questions(generator, store, dataset, items, stage_names=None, stage_settings=None, **kwargs):
+    """
+    Runs the pipeline over `items` and prints its report.
+
+    Args:
+        stage_names (List[str], optional): Names of the stages to run. Defaults to all of them.
+        stage_settings (Dict[str, dict], optional): Generation settings per stage, see `apply_stage_settings`.
+            They take precedence over the settings of the dataset, see `stages_for_dataset`.
+        **kwargs: Passed to `StageDAG` (max_batch_size, max_gen_len, temperature, top_p, metrics...).
+
+    Returns:
+        Dict[tuple, str]: The blocked nodes, see `StageDAG.blocked_nodes`.
+    """
+    stages = apply_stage_settings(stages_for_dataset(STAGES, dataset), stage_settings)
+    if stage_names is not None:
+        stages = [stage for stage in stages if stage.name in stage_names]
+    dag = StageDAG(generator, store, dataset, items, stages=stages, **kwargs)
+    blocked = dag.run()
+    dag.report(blocked)
+    return blocked
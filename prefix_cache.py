@@ -0,0 +1,114 @@
+from collections import OrderedDict
+from typing import List
+import torch
+
+
+class PrefixCache:
+    """
+    LRU cache of KV-cache prefixes, keyed by a hash of their token ids.
+
+    Token sequences are cut into blocks of `block_size` tokens and every block boundary gets
+    a chained hash (the hash of the previous boundary and the block's tokens). An entry
+    holds the keys and values of all layers for a block-aligned prefix, and every boundary
+    hash of that prefix points to it, so a lookup finds the longest cached prefix of any
+    token sequence, even one that only shares part of a stored prompt. A boundary shared by
+    several entries (prompts with a common prefix that then diverge) points to all of them,
+    so it stays reachable as long as one of them is cached.
+
+    Args:
+        max_bytes (int): Memory budget of the cached tensors. Least recently used entries are
+            evicted once it is exceeded.
+        block_size (int, optional): Granularity of the cached prefixes. Defaults to 16.
+        device (str, optional): Device where the cached tensors are kept. Defaults to "cpu".
+    """
+
+    def __init__(self, max_bytes: int, block_size: int = 16, device: str = "cpu"):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.device = device
+
+        self.entries = OrderedDict()
+        self.index = {}
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+
+    def block_hashes(self, tokens: List[int]):
+        hashes = []
+        h = 0
+        for end in range(self.block_size, len(tokens) + 1, self.block_size):
+            h = hash((h, tuple(tokens[end - self.block_size:end])))
+            hashes.append(h)
+        return hashes
+
+    def lookup(self, tokens: List[int]):
+        """Returns (entry key, length) of the longest cached prefix of `tokens`, or (None, 0)."""
+        best = (None, 0)
+        for i, h in enumerate(self.block_hashes(tokens)):
+            if h not in self.index:
+                break
+            # the most recently stored entry holding this block
+            key = next(reversed(self.index[h]))
+            length = (i + 1) * self.block_size
+            if self.entries[key]['tokens'][:length] != tokens[:length]:
+                break
+            best = (key, length)
+        return best
+
+    def load(self, model, row: int, tokens: List[int], max_len: int) -> int:
+        """
+        Copies the longest cached prefix of `tokens`, capped at `max_len`, into row `row` of
+        the model's KV cache and returns its length.
+        """
+        key, length = self.lookup(tokens[:max_len])
+        if key is None:
+            self.misses += 1
+            return 0
+        self.hits += 1
+        self.reused_tokens += length
+        self.entries.move_to_end(key)
+        entry = self.entries[key]
+        for layer, cache_k, cache_v in zip(model.layers, entry['k'], entry['v']):
+            attention = layer.attention
+            attention.cache_k[row, :length] = cache_k[:length].to(attention.cache_k.device)
+            attention.cache_v[row, :length] = cache_v[:length].to(attention.cache_v.device)
+        return length
+
+    def store(self, model, row: int, tokens: List[int]):
+        """Stores the block-aligned prefix of `tokens`, whose KV cache is in row `row`."""
+        hashes = self.block_hashes(tokens)
+        if not hashes or self.max_bytes <= 0:
+            return
+        key = hashes[-1]
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+
+        # shorter entries that are a prefix of this one become redundant
+        for h in hashes[:-1]:
+            if h in self.entries:
+                self.remove(h)
+
+        length = len(hashes) * self.block_size
+        cache_k = torch.stack([layer.attention.cache_k[row, :length] for layer in model.layers]).to(self.device)
+        cache_v = torch.stack([layer.attention.cache_v[row, :length] for layer in model.layers]).to(self.device)
+        num_bytes = cache_k.numel() * cache_k.element_size() * 2
+        if num_bytes > self.max_bytes:
+            return
+        self.entries[key] = {'tokens': list(tokens[:length]), 'k': cache_k, 'v': cache_v, 'hashes': hashes, 'num_bytes': num_bytes}
+        self.num_bytes += num_bytes
+        for h in hashes:
+            self.index.setdefault(h, {})[key] = None
+
+        while self.num_bytes > self.max_bytes:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        self.num_bytes -= entry['num_bytes']
+        for h in entry['hashes']:
+            keys = self.index[h]
+            del keys[key]
+            if not keys:
+                del self.index[h]
@@ -0,0 +1,117 @@
+import os
+import sqlite3
+from typing import List
+from pipeline import format_context
+
+
+HOTPOTQA_NUM_QUESTIONS = 10000
+
+
+class QuestionSource:
+    """
+    Lazy access to the questions of a dataset.
+
+    The split is loaded with `datasets.load_dataset`, which memory-maps its Arrow files, and
+    only the rows of the requested range are turned into Python objects. Formatted hotpotqa
+    contexts are cached in `{cache_dir}/{dataset}/prompts.sqlite` under the fingerprint of
+    the split, so they are computed once for all runs and workers.
+
+    Args:
+        dataset (str): Name of the dataset.
+        cache_dir (str): Cache directory of `datasets` and root of the outputs.
+        table (optional): Split to use instead of loading it, any object with `len`, slicing
+            into a dict of columns and `select`, like a `datasets.Dataset`.
+        fingerprint (str, optional): Fingerprint of `table`. Defaults to `table._fingerprint`.
+        num_questions (int, optional): Number of questions to use. Defaults to the whole split,
+            or its first `HOTPOTQA_NUM_QUESTIONS` for hotpotqa.
+    """
+
+    def __init__(self, dataset, cache_dir, table=None, fingerprint=None, num_questions=None):
+        if table is None:
+            from datasets import load_dataset
+            if dataset == 'truthfulqa':
+                table = load_dataset('domenicrosati/TruthfulQA', cache_dir=cache_dir)['train']
+            elif dataset == 'hotpotqa':
+                table = load_dataset('hotpot_qa', 'distractor', cache_dir=cache_dir)['train']
+        self.dataset = dataset
+        self.table = table
+        self.fingerprint = fingerprint or getattr(table, '_fingerprint', None)
+        self.num_questions = len(table)
+        if num_questions is not None:
+            self.num_questions = min(self.num_questions, num_questions)
+        elif dataset == 'hotpotqa':
+            self.num_questions = min(self.num_questions, HOTPOTQA_NUM_QUESTIONS)
+        self.question_column = 'Question' if dataset == 'truthfulqa' else 'question'
+
+        self.conn = None
+        if dataset == 'hotpotqa' and self.fingerprint is not None:
+            os.makedirs(f'{cache_dir}/{dataset}', exist_ok=True)
+            self.conn = sqlite3.connect(f'{cache_dir}/{dataset}/prompts.sqlite', timeout=60.0, isolation_level=None)
+            # not WAL: the outputs may be on a network filesystem shared by several hosts
+            self.conn.execute('PRAGMA journal_mode=DELETE')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS contexts ('
+                'fingerprint TEXT NOT NULL, q_idx INTEGER NOT NULL, formatted_context TEXT NOT NULL, '
+                'PRIMARY KEY (fingerprint, q_idx)) WITHOUT ROWID'
+            )
+
+    def __len__(self):
+        return self.num_questions
+
+    def rows(self, q_idxs: List[int]):
+        """Returns the rows of the given q_idx as a dict of columns."""
+        q_idxs = list(q_idxs)
+        if not q_idxs:
+            return self.table[0:0]
+        if q_idxs == list(range(q_idxs[0], q_idxs[-1] + 1)):
+            return self.table[q_idxs[0]:q_idxs[-1] + 1]
+        return self.table.select(q_idxs)[:len(q_idxs)]
+
+    def formatted_contexts(self, q_idxs: List[int], contexts=None):
+        """Returns {q_idx: formatted context}, from the prompt cache when possible."""
+        q_idxs = list(q_idxs)
+        cached = {}
+        if self.conn is not None:
+            for i in range(0, len(q_idxs), 500):
+                chunk = q_idxs[i:i + 500]
+                rows = self.conn.execute(
+                    f'SELECT q_idx, formatted_context FROM contexts WHERE fingerprint = ? AND q_idx IN ({",".join("?" * len(chunk))})',
+                    [self.fingerprint] + chunk,
+                )
+                cached.update(rows)
+
+        missing = [q_idx for q_idx in q_idxs if q_idx not in cached]
+        if missing:
+            if contexts is None:
+                contexts = dict(zip(missing, self.rows(missing)['context']))
+            new = {q_idx: format_context(contexts[q_idx]) for q_idx in missing}
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute('BEGIN')
+                    self.conn.executemany(
+                        'INSERT OR REPLACE INTO contexts (fingerprint, q_idx, formatted_context) VALUES (?, ?, ?)',
+                        [(self.fingerprint, q_idx, text) for q_idx, text in new.items()],
+                    )
+            cached.update(new)
+        return cached
+
+    def items(self, start: int, end: int):
+        """Returns the pipeline items of the questions in `[start, end)`."""
+        q_idxs = list(range(max(start, 0), min(end, self.num_questions)))
+        if not q_idxs:
+            return []
+        # avoid decoding the context column when the formatted contexts are cached
+        table = self.table
+        if hasattr(table, 'select_columns'):
+            table = table.select_columns([self.question_column])
+        questions = table[q_idxs[0]:q_idxs[-1] + 1][self.question_column]
+        if self.dataset == 'hotpotqa':
+            formatted_contexts = self.formatted_contexts(q_idxs)
+
+        items = []
+        for q_idx, question in zip(q_idxs, questions):
+            item = {'q_idx': q_idx, 'question': question}
+            if self.dataset == 'hotpotqa':
+                item['formatted_context'] = formatted_contexts[q_idx]
+            items.append(item)
+        return items
@@ -0,0 +1,315 @@
+import os
+import json
+import queue
+import time
+import sqlite3
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+
+
+STAGE_NAMES = ['init_responses', 'init_critiques', 'res_wo_ref', 'res_w_ref']
+# pseudo-stage holding {stage: reason} for the stages the pipeline skipped for a question
+SKIP_REASONS = 'skip_reasons'
+
+
+class SqliteResultStore:
+    """
+    Stores the output of every stage in a single SQLite file, `{cache_dir}/{dataset}/results.sqlite`.
+
+    Each (stage, q_idx) pair is one row of a table indexed by its primary key, so existence
+    checks and reads are single index lookups, and all done q_idx of a stage come from one
+    query instead of a directory scan. The database uses the rollback journal with a busy timeout,
+    so several shard workers can append to it at the same time, also from other hosts through a
+    network filesystem, where the shared memory index of WAL mode does not work. A result is only
+    visible once its transaction is committed, so a killed worker never leaves a partial one.
+
+    Args:
+        synchronous (str, optional): SQLite `synchronous` setting. With 'FULL', every commit is
+            fsynced. Defaults to 'NORMAL'.
+    """
+
+    def __init__(self, cache_dir, dataset, timeout: float = 60.0, synchronous: str = 'NORMAL'):
+        os.makedirs(f'{cache_dir}/{dataset}', exist_ok=True)
+        self.path = f'{cache_dir}/{dataset}/results.sqlite'
+        self.conn = sqlite3.connect(self.path, timeout=timeout, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute(f'PRAGMA synchronous={synchronous}')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'stage TEXT NOT NULL, q_idx INTEGER NOT NULL, value TEXT NOT NULL, '
+            'PRIMARY KEY (stage, q_idx)) WITHOUT ROWID'
+        )
+
+    def exists(self, stage, q_idx):
+        row = self.conn.execute('SELECT 1 FROM results WHERE stage = ? AND q_idx = ?', (stage, q_idx)).fetchone()
+        return row is not None
+
+    def get(self, stage, q_idx):
+        row = self.conn.execute('SELECT value FROM results WHERE stage = ? AND q_idx = ?', (stage, q_idx)).fetchone()
+        if row is None:
+            raise KeyError((stage, q_idx))
+        return json.loads(row[0])
+
+    def put(self, stage, q_idx, value):
+        self.conn.execute(
+            'INSERT OR REPLACE INTO results (stage, q_idx, value) VALUES (?, ?, ?)',
+            (stage, q_idx, json.dumps(value)),
+        )
+
+    def put_many(self, records: Iterable[tuple]):
+        """Writes (stage, q_idx, value) records in a single transaction."""
+        with self.conn:
+            self.conn.execute('BEGIN')
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO results (stage, q_idx, value) VALUES (?, ?, ?)',
+                [(stage, q_idx, json.dumps(value)) for stage, q_idx, value in records],
+            )
+
+    def done_ids(self, stage):
+        return {q_idx for (q_idx,) in self.conn.execute('SELECT q_idx FROM results WHERE stage = ?', (stage,))}
+
+    def get_many(self, stage, q_idxs=None) -> Dict[int, object]:
+        """Returns {q_idx: value} for the given q_idx of a stage (all of them if None)."""
+        if q_idxs is None:
+            rows = self.conn.execute('SELECT q_idx, value FROM results WHERE stage = ? ORDER BY q_idx', (stage,))
+            return {q_idx: json.loads(value) for q_idx, value in rows}
+        out = {}
+        q_idxs = list(q_idxs)
+        for i in range(0, len(q_idxs), 500):
+            chunk = q_idxs[i:i + 500]
+            rows = self.conn.execute(
+                f'SELECT q_idx, value FROM results WHERE stage = ? AND q_idx IN ({",".join("?" * len(chunk))})',
+                [stage] + chunk,
+            )
+            for q_idx, value in rows:
+                out[q_idx] = json.loads(value)
+        return out
+
+    def iter_joined(self, stages: List[str], q_idxs=None, decode: bool = True, optional: List[str] = ()):
+        """
+        Yields (q_idx, [value of each stage]) for every q_idx done in all `stages`, in q_idx order.
+
+        The values of the `optional` stages follow, None where they are not done. Rows are
+        streamed from the database; with `decode=False` the values are the raw json texts.
+        """
+        joins = ''.join(
+            f' JOIN results r{i} ON r{i}.stage = ? AND r{i}.q_idx = r0.q_idx' for i in range(1, len(stages))
+        ) + ''.join(
+            f' LEFT JOIN results r{i} ON r{i}.stage = ? AND r{i}.q_idx = r0.q_idx'
+            for i in range(len(stages), len(stages) + len(optional))
+        )
+        columns = ", ".join(f"r{i}.value" for i in range(len(stages) + len(optional)))
+        query = f'SELECT r0.q_idx, {columns} FROM results r0{joins} WHERE r0.stage = ?'
+        params = list(stages[1:]) + list(optional) + [stages[0]]
+        chunks = [None]
+        if q_idxs is not None:
+            q_idxs = sorted(q_idxs)
+            chunks = [q_idxs[i:i + 500] for i in range(0, len(q_idxs), 500)]
+        for chunk in chunks:
+            if chunk is None:
+                rows = self.conn.execute(query + ' ORDER BY r0.q_idx', params)
+            else:
+                rows = self.conn.execute(query + f' AND r0.q_idx IN ({",".join("?" * len(chunk))}) ORDER BY r0.q_idx', params + chunk)
+            for q_idx, *values in rows:
+                yield q_idx, [json.loads(value) if value is not None else None for value in values] if decode else values
+
+    def close(self):
+        self.conn.close()
+
+
+class JsonResultStore:
+    """
+    Stores the output of every stage as `{cache_dir}/{dataset}/{stage}/{q_idx}.json`.
+
+    This is the original layout; it is kept to import existing runs into `SqliteResultStore`.
+    Files are written under a temporary name and renamed, so a `{q_idx}.json` is never partial.
+    """
+
+    def __init__(self, cache_dir, dataset):
+        self.root = f'{cache_dir}/{dataset}'
+
+    def path(self, stage, q_idx):
+        return f'{self.root}/{stage}/{q_idx}.json'
+
+    def exists(self, stage, q_idx):
+        return os.path.exists(self.path(stage, q_idx))
+
+    def get(self, stage, q_idx):
+        with open(self.path(stage, q_idx), 'r') as f:
+            return json.load(f)
+
+    def put(self, stage, q_idx, value):
+        self.put_many([(stage, q_idx, value)])
+
+    def put_many(self, records: Iterable[tuple]):
+        """Writes every record to a temporary file, fsyncs them, then renames them into place."""
+        written = []
+        for stage, q_idx, value in records:
+            os.makedirs(f'{self.root}/{stage}', exist_ok=True)
+            tmp_path = f'{self.path(stage, q_idx)}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(value, f)
+                f.flush()
+                os.fsync(f.fileno())
+            written.append((tmp_path, self.path(stage, q_idx)))
+        for tmp_path, path in written:
+            os.replace(tmp_path, path)
+
+    def done_ids(self, stage):
+        if not os.path.isdir(f'{self.root}/{stage}'):
+            return set()
+        return {int(name.split('.')[0]) for name in os.listdir(f'{self.root}/{stage}') if name.endswith('.json')}
+
+    def get_many(self, stage, q_idxs=None):
+        if q_idxs is None:
+            q_idxs = sorted(self.done_ids(stage))
+        return {q_idx: self.get(stage, q_idx) for q_idx in q_idxs if self.exists(stage, q_idx)}
+
+    def close(self):
+        pass
+
+    def iter_joined(self, stages: List[str], q_idxs=None, decode: bool = True, optional: List[str] = ()):
+        done = set.intersection(*(self.done_ids(stage) for stage in stages))
+        for q_idx in sorted(done if q_idxs is None else done & set(q_idxs)):
+            values = []
+            for stage in list(stages) + list(optional):
+                if not self.exists(stage, q_idx):
+                    values.append(None)
+                    continue
+                with open(self.path(stage, q_idx), 'r') as f:
+                    values.append(json.load(f) if decode else f.read())
+            yield q_idx, values
+
+
+class AsyncResultStore:
+    """
+    Result store wrapper that writes in a background thread, so generation does not wait for the disk.
+
+    `put` only queues the result; the writer thread commits the queued results in batches of
+    up to `batch_size` with `put_many`, one transaction (and one fsync) per batch. The queue
+    holds at most `max_pending` results, after which `put` blocks. Reads see the queued results
+    as well as the committed ones. Call `flush` before relying on the results being on disk,
+    e.g. before marking work as complete, and `close` at the end. Once a commit fails, `put`,
+    `flush` and `close` raise, and the results that were not committed stay readable.
+
+    Args:
+        open_store (Callable): Returns a new result store; called once for reads and once in
+            the writer thread, since SQLite connections are not shared between threads.
+        on_commit (Callable, optional): Called in the writer thread as `on_commit(records, wall_time)`
+            after each batch is committed, with the time `put_many` took, commit and fsync included.
+    """
+
+    def __init__(self, open_store: Callable, max_pending: int = 256, batch_size: int = 64, on_commit: Optional[Callable] = None):
+        self.store = open_store()
+        self.batch_size = batch_size
+        self.on_commit = on_commit
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.error = None
+        self.thread = threading.Thread(target=self.write_loop, args=(open_store,), daemon=True)
+        self.thread.start()
+
+    def write_loop(self, open_store):
+        store = open_store()
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [record for record in batch if record is not None]
+            committed = False
+            try:
+                if records and self.error is None:
+                    start = time.perf_counter()
+                    store.put_many(records)
+                    committed = True
+                    if self.on_commit is not None:
+                        self.on_commit(records, time.perf_counter() - start)
+            except Exception as e:
+                self.error = e
+            # results that were not committed stay readable from `pending`
+            if committed:
+                with self.lock:
+                    for stage, q_idx, value in records:
+                        if self.pending.get((stage, q_idx)) is value:
+                            del self.pending[(stage, q_idx)]
+            for _ in batch:
+                self.queue.task_done()
+            if batch[-1] is None:
+                store.close()
+                return
+
+    def check(self):
+        if self.error is not None:
+            raise RuntimeError("the result writer failed") from self.error
+
+    def put(self, stage, q_idx, value):
+        self.check()
+        with self.lock:
+            self.pending[(stage, q_idx)] = value
+        self.queue.put((stage, q_idx, value))
+
+    def put_many(self, records: Iterable[tuple]):
+        for stage, q_idx, value in records:
+            self.put(stage, q_idx, value)
+
+    def exists(self, stage, q_idx):
+        with self.lock:
+            if (stage, q_idx) in self.pending:
+                return True
+        return self.store.exists(stage, q_idx)
+
+    def get(self, stage, q_idx):
+        with self.lock:
+            if (stage, q_idx) in self.pending:
+                return self.pending[(stage, q_idx)]
+        return self.store.get(stage, q_idx)
+
+    def done_ids(self, stage):
+        with self.lock:
+            pending = {q_idx for (s, q_idx) in self.pending if s == stage}
+        return self.store.done_ids(stage) | pending
+
+    def get_many(self, stage, q_idxs=None):
+        if q_idxs is not None:
+            q_idxs = list(q_idxs)
+        with self.lock:
+            pending = {q_idx: value for (s, q_idx), value in self.pending.items() if s == stage}
+        out = self.store.get_many(stage, q_idxs)
+        if q_idxs is not None:
+            pending = {q_idx: pending[q_idx] for q_idx in q_idxs if q_idx in pending}
+        out.update(pending)
+        return out
+
+    def flush(self):
+        """Blocks until every queued result is committed."""
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.store.close()
+        self.check()
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+def import_json_results(cache_dir, dataset):
+    """Copies the outputs of the per-question JSON layout into the SQLite store."""
+    json_store = JsonResultStore(cache_dir, dataset)
+    store = SqliteResultStore(cache_dir, dataset)
+    for stage in STAGE_NAMES:
+        values = json_store.get_many(stage)
+        store.put_many((stage, q_idx, value) for q_idx, value in values.items())
+        print(f"{stage}: imported {len(values)} results")
+    store.close()
+
+
+if __name__ == "__main__":
+    from my_config import my_config
+    import_json_results(my_config.cache_dir, my_config.dataset)
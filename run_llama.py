@@ -1,16 +1,15 @@
 from typing import List, Optional
-import fire
-from llama import Llama, Dialog
-from datasets import load_dataset
-from my_config import my_config
 import os
-import json
+import sys
+import time
+import fire
+from pipeline import STAGES, run_questions, load_stage_settings
+from result_store import SqliteResultStore, AsyncResultStore, SKIP_REASONS
+from work_queue import WorkQueue, Heartbeat, worker_id
+
+# torch, llama and datasets are only imported by `main`, so that `status` and `plan` start fast
+CACHE_DIR = '/newdisk/reflective_thinking'
 
-def format_context(context):
-    formatted_context = ""
-    for title, sentences in zip(context['title'], context['sentences']):
-        formatted_context += f"{title}: " + " ".join(sentences) + " "
-    return formatted_context
 
 def main(
     ckpt_dir: str,
@@ -22,10 +21,31 @@ def main(
     max_gen_len: Optional[int] = None,
     dataset: str=None,
     k : int=1,
+    prefix_cache_gb: float = 0.0,
+    use_queue: bool = False,
+    chunk_size: int = 20,
+    lease_seconds: float = 600.0,
+    poll_seconds: float = 10.0,
+    use_token_index: bool = False,
+    compute_speed: bool = False,
+    generation_cache_gb: float = 0.0,
+    generation_cache_dir: str = CACHE_DIR,
+    continuous_batching: bool = False,
+    stage_settings=None,
+    speculative: bool = False,
+    draft_ckpt_dir: Optional[str] = None,
+    num_draft: int = 4,
+    agreement_threshold: Optional[float] = None,
+    cache_dir: str = CACHE_DIR,
+    generator=None,
+    source=None,
 ):
     """
     Entry point of the program for generating text using a pretrained model.
 
+    The four stages (init_responses, init_critiques, res_wo_ref, res_w_ref) are run as a
+    dependency graph over every question of the shard, see `pipeline.StageDAG`.
+
     Args:
         ckpt_dir (str): The directory containing checkpoint files for the pretrained model.
         tokenizer_path (str): The path to the tokenizer model used for text encoding/decoding.
@@ -37,320 +57,413 @@ def main(
         max_batch_size (int, optional): The maximum batch size for generating sequences. Defaults to 8.
         max_gen_len (int, optional): The maximum length of generated sequences. If None, it will be
             set to the model's max sequence length. Defaults to None.
+        prefix_cache_gb (float, optional): Host memory budget, in GB, of the KV cache kept for prompt
+            prefixes so that later stages of a question only prefill their new suffix. Disabled if 0.
+            Defaults to 0.
+        use_queue (bool, optional): Pull ranges of `chunk_size` questions from the shared work queue
+            (see `work_queue.WorkQueue`) until every range is done, instead of processing the static shard `k`.
+            While other workers hold leases, the worker waits for them to finish or expire, so that it
+            takes over the ranges of dead workers. Requires one process per model (model parallel size 1).
+            Defaults to False.
+        chunk_size (int, optional): Number of questions per work queue item. Defaults to 20.
+        lease_seconds (float, optional): Lease duration of a work queue item. Defaults to 600.
+        poll_seconds (float, optional): Wait between two claims while other workers hold every
+            remaining range. Defaults to 10.
+        use_token_index (bool, optional): Count prompt tokens with the tokenizer (see `token_index`)
+            to skip prompts that do not fit in `max_seq_len`, instead of the 8000 characters rule
+            for hotpotqa contexts, and to batch prompts of similar length together. Defaults to False.
+        compute_speed (bool, optional): Record the time, tokens, batch fill and memory of every batch
+            and the time of every result store access in `{cache_dir}/{dataset}/metrics/`. Run
+            `python metrics.py --dataset ...` for the per-stage report. Defaults to False.
+        generation_cache_gb (float, optional): Disk budget of the cache of generations keyed by model,
+            prompt tokens and sampling parameters, shared by all runs and workers (see `generation_cache`),
+            so that requests generated before are not generated again. Disabled if 0. Defaults to 0.
+        generation_cache_dir (str, optional): Directory of the generation cache and of the digests of the
+            checkpoint weights it is keyed by. It does not depend on `cache_dir`, so runs writing their
+            outputs elsewhere still share it. Defaults to `CACHE_DIR`.
+        continuous_batching (bool, optional): Generate with `engine.ContinuousBatchingEngine`, which retires
+            each sequence when it ends and refills its slot right away, and submit every node of the
+            graph as soon as its dependencies are done. Defaults to False.
+        stage_settings (optional): Generation settings (max_gen_len, stop, stop_patterns, speculative...) per stage, as a
+            dict, a json string or the path of a json file, see `pipeline.apply_stage_settings`.
+            Defaults to the settings of `pipeline.STAGES`.
+        speculative (bool, optional): Generate the stages with the `speculative` setting (res_wo_ref and
+            res_w_ref by default) with speculative decoding, see `speculative.SpeculativeGenerator`.
+            Cannot be combined with `continuous_batching`. Defaults to False.
+        draft_ckpt_dir (str, optional): Checkpoint of a small draft model sharing the tokenizer. If None,
+            drafts are copied from earlier occurrences of the last tokens in the dialog (prompt lookup).
+            Like the main checkpoint, it needs one shard per torchrun process (`Llama.build` asserts it),
+            so the released llama 2 checkpoints, whose sizes have 1, 2 and 8 shards, cannot be paired.
+        num_draft (int, optional): Number of draft tokens verified per step. Defaults to 4.
+        agreement_threshold (float, optional): Skip init_critiques, res_wo_ref and res_w_ref for the questions
+            whose init responses give the same normalized answer at least this often (e.g. 1.0 when all
+            of them agree), see `pipeline.StageDAG`. The skip reasons are stored for `combine_data`.
+            Disabled if None. Defaults to None.
+        cache_dir (str, optional): Root of the outputs and caches. Defaults to `CACHE_DIR`.
+        generator (optional): Generator to use instead of building one from the checkpoint, e.g. a
+            `fake_llama.FakeLlama` in `benchmark`. The prefix cache and speculative decoding need a real one.
+        source (QuestionSource, optional): Questions to use instead of loading the dataset.
     """
 
-    cache_dir = '/newdisk/reflective_thinking'
-
-    generator = Llama.build(
-        ckpt_dir=ckpt_dir,
-        tokenizer_path=tokenizer_path,
-        max_seq_len=max_seq_len,
-        max_batch_size=max_batch_size,
+    from question_source import QuestionSource
+
+    stage_settings = load_stage_settings(stage_settings)
+    generator, speculative_generator, prefix_cache, cache = build_generators(
+        ckpt_dir,
+        tokenizer_path,
+        max_seq_len,
+        max_batch_size,
+        prefix_cache_gb=prefix_cache_gb,
+        generation_cache_gb=generation_cache_gb,
+        generation_cache_dir=generation_cache_dir,
+        continuous_batching=continuous_batching,
+        speculative=speculative,
+        draft_ckpt_dir=draft_ckpt_dir,
+        num_draft=num_draft,
+        generator=generator,
+    )
+    if source is None:
+        source = QuestionSource(dataset, cache_dir)
+    runner = DatasetRunner(
+        generator, dataset, source, cache_dir,
+        compute_speed=compute_speed, use_token_index=use_token_index, tokenizer_path=tokenizer_path,
     )
 
-    if dataset == 'truthfulqa':
-        raw_datasets = load_dataset('domenicrosati/TruthfulQA', cache_dir=cache_dir)
-        all_questions = raw_datasets['train']['Question']
-    elif dataset == 'hotpotqa':
-        raw_datasets = load_dataset('hotpot_qa', 'distractor', cache_dir=cache_dir)['train'][:10000]
-        all_questions = raw_datasets['question']
-        all_contexts = raw_datasets['context']
-
-    for q_idx, question in enumerate(all_questions):
-
-        if q_idx < 20 * k or q_idx >= 20 * (k + 1):
-            continue
-
-        init_responses_dir = f'{cache_dir}/{dataset}/init_responses'
-        os.makedirs(init_responses_dir, exist_ok=True)
-
-        init_responses_path = f'{init_responses_dir}/{q_idx}.json'
-
-        if not os.path.exists(init_responses_path):
-
-            all_responses = []
-
-            if dataset == 'truthfulqa':
-                dialogs: List[Dialog] = [
-                    [{"role": "user", "content": f"{question}"}],
-                    [{"role": "user", "content": f"{question}"}],
-                    [{"role": "user", "content": f"{question}"}],
-                    [{"role": "user", "content": f"{question}"}],
-                ]
-            elif dataset == 'hotpotqa':
-                context = all_contexts[q_idx]
-                formatted_context = format_context(context)
-                if len(formatted_context) >= 8000:
-                    print("context too long; disregard")
+    def run_range(start, end):
+        runner.run(
+            start,
+            end,
+            max_batch_size=max_batch_size,
+            max_gen_len=max_gen_len,
+            temperature=temperature,
+            top_p=top_p,
+            max_seq_len=max_seq_len,
+            cache=cache,
+            stage_settings=stage_settings,
+            speculative=speculative_generator,
+            agreement_threshold=agreement_threshold,
+        )
+
+    if use_queue:
+        if int(os.environ.get('WORLD_SIZE', 1)) > 1:
+            raise ValueError("--use_queue needs one process per model, got WORLD_SIZE > 1")
+        queue = WorkQueue(cache_dir, dataset, lease_seconds=lease_seconds)
+        queue.fill(len(source), chunk_size)
+        owner = worker_id()
+        with Heartbeat(cache_dir, dataset, owner, lease_seconds=lease_seconds):
+            while True:
+                claimed = queue.claim(owner)
+                if claimed is None:
+                    if queue.counts()['leased'] == 0:
+                        break
+                    # the leases of other workers end when they finish or expire, then they are claimable
+                    time.sleep(poll_seconds)
                     continue
+                start, end = claimed
+                print(f"{owner}: questions {start} to {end}")
+                run_range(start, end)
+                runner.store.flush()
+                queue.complete(start, owner)
+        print(f"work queue: {queue.counts()}")
+    else:
+        run_range(20 * k, 20 * (k + 1))
+
+    runner.close()
+    if prefix_cache is not None:
+        print(f"prefix cache: {prefix_cache.hits} hits, {prefix_cache.misses} misses, {prefix_cache.reused_tokens} prompt tokens reused")
+    if cache is not None:
+        print(f"generation cache: {cache.hits} hits, {cache.misses} misses")
+    if runner.metrics is not None:
+        print(f"metrics written to {runner.metrics.path}")
+
+
+def build_generators(
+    ckpt_dir: str,
+    tokenizer_path: str,
+    max_seq_len: int,
+    max_batch_size: int,
+    prefix_cache_gb: float = 0.0,
+    generation_cache_gb: float = 0.0,
+    generation_cache_dir: str = CACHE_DIR,
+    continuous_batching: bool = False,
+    speculative: bool = False,
+    draft_ckpt_dir: Optional[str] = None,
+    num_draft: int = 4,
+    generator=None,
+    checkpoint: Optional[str] = None,
+):
+    """
+    Builds the generator, the speculative generator, the prefix cache and the generation cache
+    of `main` and `worker_daemon.serve` from their options, see `main`.
 
-                dialogs: List[Dialog] = [
-                    [
-                        {"role": "system", "content": "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."},
-                        {"role": "user", "content": f"Context: {formatted_context}\n Question: {question} \n Provide a short answer without explanation."}
-                    ],
-                    [
-                        {"role": "system", "content": "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."},
-                        {"role": "user", "content": f"Context: {formatted_context}\n Question: {question} \n Provide a short answer without explanation."}
-                    ],
-                    [
-                        {"role": "system", "content": "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."},
-                        {"role": "user", "content": f"Context: {formatted_context}\n Question: {question} \n Provide a short answer without explanation."}
-                    ],
-                    [
-                        {"role": "system", "content": "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."},
-                        {"role": "user", "content": f"Context: {formatted_context}\n Question: {question} \n Provide a short answer without explanation."}
-                    ],
-                ]
-
-    
-            results = generator.chat_completion(
-                dialogs,  # type: ignore
-                max_gen_len=384,
-                temperature=temperature,
-                top_p=top_p,
-            )
-
-            for dialog, result in zip(dialogs, results):
-                all_responses.append(result['generation']['content'])
-
-            with open(init_responses_path, 'w') as f:
-                json.dump(all_responses, f)
-
-        init_critiques_dir = f'{cache_dir}/{dataset}/init_critiques'
-        os.makedirs(init_critiques_dir, exist_ok=True)
-
-        init_critiques_path = f'{init_critiques_dir}/{q_idx}.json'
-
-        if not os.path.exists(init_critiques_path):
-
-            with open(init_responses_path, 'r') as f:
-                all_responses = json.load(f)
-
-            all_critiques = []
-
-            if dataset == 'truthfulqa':
-
-                dialogs: List[Dialog] = [
-                    [
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[0]}"},
-                        {"role": "user", "content": "Could you critique your last response?"},
-                    ],
-                    [
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[1]}"},
-                        {"role": "user", "content": "Could you critique your last response?"},
-                    ],
-                    [
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[2]}"},
-                        {"role": "user", "content": "Could you critique your last response?"},
-                    ],
-                    [
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[3]}"},
-                        {"role": "user", "content": "Could you critique your last response?"},
-                    ],
-                ]
-
-            elif dataset == 'hotpotqa':
-                context = all_contexts[q_idx]
-                formatted_context = format_context(context)
-                if len(formatted_context) >= 8000:
-                    print("context too long; disregard")
-                    continue
+    Args:
+        generator (optional): Generator to use instead of building one from the checkpoint.
+        checkpoint (str, optional): Identifier of the model in the generation cache. Defaults to
+            `generation_cache.checkpoint_id` of `ckpt_dir`.
 
-                dialogs: List[Dialog] = [
-                    [
-                        {"role": "system", "content": "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."},
-                        {"role": "user", "content": f"Context: {formatted_context}\n Question: {question} \n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[0]}"},
-                        {"role": "user", "content": f"Please review and critique your previous response. You can refer back to the original context if needed."}
-                    ],
-                    [
-                        {"role": "system", "content": "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."},
-                        {"role": "user", "content": f"Context: {formatted_context}\n Question: {question} \n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[1]}"},
-                        {"role": "user", "content": f"Please review and critique your previous response. You can refer back to the original context if needed."}
-                    ],
-                    [
-                        {"role": "system", "content": "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."},
-                        {"role": "user", "content": f"Context: {formatted_context}\n Question: {question} \n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[2]}"},
-                        {"role": "user", "content": f"Please review and critique your previous response. You can refer back to the original context if needed."}
-                    ],
-                    [
-                        {"role": "system", "content": "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."},
-                        {"role": "user", "content": f"Context: {formatted_context}\n Question: {question} \n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[3]}"},
-                        {"role": "user", "content": f"Please review and critique your previous response. You can refer back to the original context if needed."}
-                    ],
-                ]
-
-            results = generator.chat_completion(
-                dialogs,  # type: ignore
-                max_gen_len=max_gen_len,
-                temperature=temperature,
-                top_p=top_p,
+    Returns:
+        Tuple: (generator, speculative generator, prefix cache, generation cache), the last three None when disabled.
+    """
+    if speculative and continuous_batching:
+        raise ValueError("--speculative cannot be combined with --continuous_batching")
+
+    prefix_cache = None
+    if generator is None:
+        from llama import Llama
+        from generation import LlamaGenerator
+        from engine import ContinuousBatchingEngine
+        from prefix_cache import PrefixCache
+        if prefix_cache_gb > 0:
+            prefix_cache = PrefixCache(int(prefix_cache_gb * 1024 ** 3))
+        generator_class = ContinuousBatchingEngine if continuous_batching else LlamaGenerator
+        generator = generator_class(Llama.build(
+            ckpt_dir=ckpt_dir,
+            tokenizer_path=tokenizer_path,
+            max_seq_len=max_seq_len,
+            max_batch_size=max_batch_size,
+        ), prefix_cache=prefix_cache)
+
+    speculative_generator = None
+    if speculative:
+        from llama import Llama
+        from speculative import SpeculativeGenerator
+        draft = None
+        if draft_ckpt_dir is not None:
+            draft = Llama.build(
+                ckpt_dir=draft_ckpt_dir,
+                tokenizer_path=tokenizer_path,
+                max_seq_len=max_seq_len,
+                max_batch_size=max_batch_size,
             )
+        speculative_generator = SpeculativeGenerator(
+            generator.llama, draft=draft, num_draft=num_draft, prefix_cache=prefix_cache
+        )
+
+    cache = None
+    if generation_cache_gb > 0:
+        from generation_cache import GenerationCache, checkpoint_id
+        encode = None
+        if hasattr(generator, 'tokenizer'):
+            from generation import encode_dialog
+            encode = lambda dialog: encode_dialog(generator.tokenizer, dialog)
+        if checkpoint is None:
+            checkpoint = checkpoint_id(ckpt_dir, generation_cache_dir)
+        cache = GenerationCache(
+            generation_cache_dir, checkpoint, int(generation_cache_gb * 1024 ** 3),
+            max_seq_len=max_seq_len, encode=encode,
+        )
+    return generator, speculative_generator, prefix_cache, cache
+
+
+class DatasetRunner:
+    """
+    Runs question ranges of one dataset through the pipeline, for `main` and `worker_daemon.serve`.
 
-            for dialog, result in zip(dialogs, results):
-                all_critiques.append(result['generation']['content'])
-
-            with open(init_critiques_path, 'w') as f:
-                json.dump(all_critiques, f)
-
-
-        res_wo_ref_dir = f'{cache_dir}/{dataset}/res_wo_ref'
-        os.makedirs(res_wo_ref_dir, exist_ok=True)
-
-        res_wo_ref_path = f'{res_wo_ref_dir}/{q_idx}.json'
-
-        if not os.path.exists(res_wo_ref_path):
-
-            with open(init_responses_path, 'r') as f:
-                all_responses = json.load(f)
-
-            if dataset == 'truthfulqa':
-
-                dialogs: List[Dialog] = [
-                    [
-                        {"role": "system", "content": "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."},
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[0]}"},
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[1]}"},
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[2]}"},
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[3]}"},
-                        {"role": "user", "content": f"{question}"},
-                    ]
-                ]
+    It holds the result store of the dataset (committed by a background thread, one fsync per
+    batch) and, depending on the options, its metrics and token index, see `main`.
 
-            elif dataset == 'hotpotqa':
-                context = all_contexts[q_idx]
-                formatted_context = format_context(context)
+    Args:
+        source (QuestionSource): Questions of the dataset.
+        compute_speed (bool, optional): Record metrics in `{cache_dir}/{dataset}/metrics/`. Defaults to False.
+        use_token_index (bool, optional): Count prompt tokens with the tokenizer of `generator`, whose
+            model file is `tokenizer_path`. Defaults to False.
+        tokenizer_path (str, optional): Path of the tokenizer model, which keys the token index.
+            Required with `use_token_index`.
+    """
 
-                if len(formatted_context) >= 8000:
-                    print("context too long; disregard")
-                    continue
+    def __init__(
+        self,
+        generator,
+        dataset,
+        source,
+        cache_dir,
+        compute_speed: bool = False,
+        use_token_index: bool = False,
+        tokenizer_path: Optional[str] = None,
+    ):
+        from metrics import Metrics, InstrumentedStore
+        self.generator = generator
+        self.dataset = dataset
+        self.source = source
+        self.metrics = None
+        if compute_speed:
+            self.metrics = Metrics(cache_dir, dataset, worker_id())
+        self.store = AsyncResultStore(
+            lambda: SqliteResultStore(cache_dir, dataset, synchronous='FULL'),
+            on_commit=self.metrics.record_commit if self.metrics is not None else None,
+        )
+        if self.metrics is not None:
+            self.store = InstrumentedStore(self.store, self.metrics, queued_writes=True)
+
+        self.count_tokens = None
+        self.index = None
+        if use_token_index:
+            from generation import encode_dialog
+            from token_index import TokenIndex, tokenizer_id
+            if tokenizer_path is None:
+                raise ValueError("use_token_index needs the tokenizer_path of the generator")
+            self.count_tokens = lambda dialog: len(encode_dialog(generator.tokenizer, dialog))
+            self.index = TokenIndex.load_or_build(source, self.count_tokens, cache_dir, tokenizer_id(tokenizer_path))
+
+    def run(self, start, end, **kwargs):
+        """
+        Runs the questions of `[start, end)`, see `pipeline.run_questions` for `kwargs`.
+
+        Returns:
+            Tuple: (number of questions, blocked nodes), see `pipeline.StageDAG.blocked_nodes`.
+        """
+        items = self.source.items(start, end)
+        if self.index is not None:
+            for item in items:
+                item['prompt_tokens'] = self.index[item['q_idx']]
+        blocked = run_questions(
+            self.generator, self.store, self.dataset, items, count_tokens=self.count_tokens, metrics=self.metrics, **kwargs
+        )
+        return len(items), blocked
+
+    def close(self):
+        self.store.close()
+        if self.metrics is not None:
+            self.metrics.close()
+
+
+def to_ranges(q_idxs) -> List[tuple]:
+    """Groups q_idx into [start, end) ranges of consecutive values."""
+    ranges = []
+    for q_idx in sorted(q_idxs):
+        if ranges and ranges[-1][1] == q_idx:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([q_idx, q_idx + 1])
+    return [tuple(r) for r in ranges]
+
+
+def format_ranges(ranges, limit: int = 10):
+    text = ', '.join(f'{start}-{end - 1}' if end - start > 1 else f'{start}' for start, end in ranges[:limit])
+    if len(ranges) > limit:
+        text += f', ... ({len(ranges) - limit} more)'
+    return text
+
+
+def node_states(dataset, cache_dir, start=0, end=None):
+    """
+    Reads the state of every (stage, q_idx) node of `[start, end)` from the result store.
 
-                dialogs: List[Dialog] = [
-                    [
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": f"Context: {formatted_context}\n Question: {question} \n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[0]}"},
-                        {"role": "user", "content": f"{question}\n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[1]}"},
-                        {"role": "user", "content": f"{question}\n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[2]}"},
-                        {"role": "user", "content": f"{question}\n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[3]}"},
-                        {"role": "user", "content": f"{question}\n Provide a short answer without explanation."},
-                    ]
-                ]
-
-            results = generator.chat_completion(
-                dialogs,  # type: ignore
-                max_gen_len=max_gen_len,
-                temperature=temperature,
-                top_p=top_p,
+    Returns (end, done, skipped, blocked): `done` is {stage: set of q_idx}, `skipped` is
+    {stage: {q_idx: reason}} with the reasons recorded by the pipeline, and `blocked` is
+    {stage: set of q_idx} for the nodes that will never run because a dependency was skipped.
+    Without `end`, the range ends with the work queue, or after the last q_idx with a result.
+    Returns None if the dataset has no results.
+    """
+    path = f'{cache_dir}/{dataset}/results.sqlite'
+    if not os.path.exists(path):
+        return None
+    store = SqliteResultStore(cache_dir, dataset)
+    all_done = {stage.name: store.done_ids(stage.name) for stage in STAGES}
+    reasons = store.get_many(SKIP_REASONS)
+    store.close()
+    if end is None:
+        seen = [q_idx for ids in all_done.values() for q_idx in ids] + list(reasons)
+        end = max(seen) + 1 if seen else start
+        if os.path.exists(f'{cache_dir}/{dataset}/queue.sqlite'):
+            queue = WorkQueue(cache_dir, dataset)
+            (queue_end,) = queue.conn.execute('SELECT COALESCE(MAX(end), 0) FROM items').fetchone()
+            queue.close()
+            end = max(end, queue_end)
+    q_idxs = range(start, end)
+
+    done, skipped, blocked = {}, {}, {}
+    for stage in STAGES:
+        done[stage.name] = {q_idx for q_idx in all_done[stage.name] if start <= q_idx < end}
+        skipped[stage.name] = {
+            q_idx: reasons[q_idx][stage.name] for q_idx in q_idxs
+            if q_idx in reasons and stage.name in reasons[q_idx] and q_idx not in done[stage.name]
+        }
+        # STAGES lists dependencies first
+        blocked[stage.name] = {
+            q_idx for q_idx in q_idxs
+            if q_idx not in done[stage.name] and q_idx not in skipped[stage.name] and any(
+                q_idx in skipped[dep] or q_idx in blocked[dep] for dep in stage.deps
             )
+        }
+    return end, done, skipped, blocked
 
-            for dialog, result in zip(dialogs, results):
-                res_wo_ref = result['generation']['content']
-
-            with open(res_wo_ref_path, 'w') as f:
-                json.dump(res_wo_ref, f)
-
-
-        res_w_ref_dir = f'{cache_dir}/{dataset}/res_w_ref'
-        os.makedirs(res_w_ref_dir, exist_ok=True)
-
-        res_w_ref_path = f'{res_w_ref_dir}/{q_idx}.json'
-
-        if not os.path.exists(res_w_ref_path):
 
-            with open(init_responses_path, 'r') as f:
-                all_responses = json.load(f)
-
-            with open(init_critiques_path, 'r') as f:
-                all_critiques = json.load(f)
-
-            if dataset == 'truthfulqa':
-
-                if q_idx in [153, 192, 504]:
-                    continue
-
-                dialogs: List[Dialog] = [
-                    [
-                        {"role": "system", "content": "You are a helpful assistant. Answer the question based on the context provided. Provide extremely concise answers with no explanation."},
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[0]}"},
-                        {"role": "user", "content": "Please review and critique your previous response."},
-                        {"role": "assistant","content": f"{all_critiques[0]}"},
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[1]}"},
-                        {"role": "user", "content": "Please review and critique your previous response."},
-                        {"role": "assistant","content": f"{all_critiques[1]}"},
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[2]}"},
-                        {"role": "user", "content": "Please review and critique your previous response."},
-                        {"role": "assistant","content": f"{all_critiques[2]}"},
-                        {"role": "user", "content": f"{question}"},
-                        {"role": "assistant","content": f"{all_responses[3]}"},
-                        {"role": "user", "content": "Please review and critique your previous response."},
-                        {"role": "assistant","content": f"{all_critiques[3]}"},
-                        {"role": "user", "content": f"{question}"},
-                    ]
-                ]
-
-            elif dataset == 'hotpotqa':
-                context = all_contexts[q_idx]
-                formatted_context = format_context(context)
-
-                if len(formatted_context) >= 8000:
-                    print("context too long; disregard")
-                    continue
-
-                dialogs: List[Dialog] = [
-                    [
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": f"Context: {formatted_context}\n Question: {question} \n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[0]}"},
-                        {"role": "user", "content": "Please review and critique your previous response. You can refer back to the original context if needed."},
-                        {"role": "assistant","content": f"{all_critiques[0]}"},
-                        {"role": "user", "content": f"{question}\n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[1]}"},
-                        {"role": "user", "content": "Please review and critique your previous response. You can refer back to the original context if needed."},
-                        {"role": "assistant","content": f"{all_critiques[1]}"},
-                        {"role": "user", "content": f"{question}\n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[2]}"},
-                        {"role": "user", "content": "Please review and critique your previous response. You can refer back to the original context if needed."},
-                        {"role": "assistant","content": f"{all_critiques[2]}"},
-                        {"role": "user", "content": f"{question}\n Provide a short answer without explanation."},
-                        {"role": "assistant","content": f"{all_responses[3]}"},
-                        {"role": "user", "content": "Please review and critique your previous response. You can refer back to the original context if needed."},
-                        {"role": "assistant","content": f"{all_critiques[3]}"},
-                        {"role": "user", "content": f"{question}\n Provide a short answer without explanation."},
-                    ]
-                ]
-
-            results = generator.chat_completion(
-                dialogs,  # type: ignore
-                max_gen_len=max_gen_len,
-                temperature=temperature,
-                top_p=top_p,
-            )
+def status(dataset: str, start: int = 0, end: Optional[int] = None, shard_size: int = 20, cache_dir: str = CACHE_DIR):
+    """
+    Prints the progress of a dataset from the result store, without loading the model or the dataset.
 
-            for dialog, result in zip(dialogs, results):
-                res_w_ref = result['generation']['content']
+    For every stage: the number of done, skipped and blocked questions of `[start, end)`, the
+    missing q_idx ranges, and the skipped questions grouped by reason (e.g. long contexts).
+    Also prints which shards `--k` of `shard_size` questions are finished and the state of the
+    work queue. Without `end`, the range ends with the work queue, or after the last q_idx with a result.
+    """
+    states = node_states(dataset, cache_dir, start, end)
+    if states is None:
+        print(f"no results for {dataset} in {cache_dir}")
+        return
+    end, done, skipped, blocked = states
+    print(f"{dataset}: questions {start} to {end - 1}")
+    unfinished = set()
+    for stage in STAGES:
+        missing = set(range(start, end)) - done[stage.name] - set(skipped[stage.name]) - blocked[stage.name]
+        unfinished |= missing
+        print(
+            f"{stage.name}: {len(done[stage.name])} done, {len(skipped[stage.name])} skipped, "
+            f"{len(blocked[stage.name])} blocked, {len(missing)} missing"
+        )
+        if missing:
+            print(f"  missing: {format_ranges(to_ranges(missing))}")
+        by_reason = {}
+        for q_idx, reason in skipped[stage.name].items():
+            by_reason.setdefault(reason.split(' (')[0], []).append(q_idx)
+        for reason, q_idxs in sorted(by_reason.items()):
+            print(f"  skipped, {reason}: {len(q_idxs)} ({format_ranges(to_ranges(q_idxs))})")
+
+    shards = range(start // shard_size, (end + shard_size - 1) // shard_size)
+    finished = [k for k in shards if not any(q_idx in unfinished for q_idx in range(k * shard_size, (k + 1) * shard_size))]
+    print(f"finished shards of {shard_size}: {len(finished)}/{len(shards)} ({format_ranges(to_ranges(finished))})")
+    if os.path.exists(f'{cache_dir}/{dataset}/queue.sqlite'):
+        queue = WorkQueue(cache_dir, dataset)
+        print(f"work queue: {queue.counts()}")
+        queue.close()
+
+
+def plan(dataset: str, start: int, end: int, chunk_size: int = 20, cache_dir: str = CACHE_DIR):
+    """
+    Prints the pending work of `[start, end)`, without loading the model or the dataset.
 
-            with open(res_w_ref_path, 'w') as f:
-                json.dump(res_w_ref, f)
+    A node is pending unless it is done, skipped with a recorded reason, or blocked by a skipped
+    dependency. Prints the pending q_idx ranges of every stage, then the `[start, end)` chunks of
+    `chunk_size` questions (the shards `--k` with the default 20) that still have pending work.
+    """
+    states = node_states(dataset, cache_dir, start, end)
+    pending = {}
+    for stage in STAGES:
+        if states is None:
+            pending[stage.name] = set(range(start, end))
+            continue
+        _, done, skipped, blocked = states
+        pending[stage.name] = set(range(start, end)) - done[stage.name] - set(skipped[stage.name]) - blocked[stage.name]
+
+    for stage in STAGES:
+        if pending[stage.name]:
+            print(f"{stage.name}: {len(pending[stage.name])} pending ({format_ranges(to_ranges(pending[stage.name]))})")
+    todo = set().union(*pending.values())
+    chunks = sorted({
+        (max(q_idx // chunk_size * chunk_size, start), min((q_idx // chunk_size + 1) * chunk_size, end)) for q_idx in todo
+    })
+    if not chunks:
+        print(f"{dataset}: nothing to do in {start} to {end - 1}")
+        return
+    print(f"{len(todo)} questions in {len(chunks)} chunks of {chunk_size} to run:")
+    for chunk_start, chunk_end in chunks:
+        print(f"  {chunk_start} {chunk_end}")
 
 
 if __name__ == "__main__":
-    fire.Fire(main)
+    commands = {'status': status, 'plan': plan}
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        fire.Fire(commands)
+    else:
+        fire.Fire(main)
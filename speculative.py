@@ -0,0 +1,281 @@
+from typing import List, Optional, Union
+import torch
+from llama import Llama, Dialog
+from generation import encode_dialog, copy_cache_rows, forward_rows, decode_steps_saved
+from prefix_cache import PrefixCache
+from stop_conditions import find_stop
+
+
+def sampling_probs(logits, temperature: float, top_p: float):
+    """The distribution `Llama.generate` samples from: softmax at `temperature`, restricted to the top-p nucleus."""
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+    mask = torch.cumsum(probs_sort, dim=-1) - probs_sort > top_p
+    probs_sort[mask] = 0.0
+    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
+    return torch.zeros_like(probs).scatter_(-1, probs_idx, probs_sort)
+
+
+def forward_chunks(model, chunks: List[List[int]], rows: List[int], start_pos: List[int]):
+    """
+    Runs token chunks of different lengths through `forward_rows`, right-padded to the longest one.
+
+    Padding only writes KV-cache positions after the real tokens of a row, which are never
+    attended to before being overwritten. Rows whose padding would run past the end of the
+    cache are run on their own. Returns the logits of the real tokens of each chunk.
+    """
+    length = max(len(chunk) for chunk in chunks)
+    overflow = [i for i, start in enumerate(start_pos) if start + length > model.params.max_seq_len]
+    if overflow:
+        logits = [None] * len(chunks)
+        fits = [i for i in range(len(chunks)) if i not in overflow]
+        groups = [fits] if fits else []
+        for idx in groups + [[i] for i in overflow]:
+            outputs = forward_chunks(model, [chunks[i] for i in idx], [rows[i] for i in idx], [start_pos[i] for i in idx])
+            for i, output in zip(idx, outputs):
+                logits[i] = output
+        return logits
+    tokens = torch.tensor(
+        [chunk + [chunk[-1]] * (length - len(chunk)) for chunk in chunks],
+        dtype=torch.long,
+        device=model.tok_embeddings.weight.device,
+    )
+    logits = forward_rows(model, tokens, rows, start_pos)
+    return [logits[i, :len(chunk)] for i, chunk in enumerate(chunks)]
+
+
+def lookup_draft(tokens: List[int], num_draft: int, ngram: int):
+    """Proposes the tokens that followed the last earlier occurrence of the final n-gram of `tokens`."""
+    for n in range(min(ngram, len(tokens) - 1), 0, -1):
+        suffix = tokens[-n:]
+        for start in range(len(tokens) - n - 1, -1, -1):
+            if tokens[start:start + n] == suffix:
+                return tokens[start + n:start + n + num_draft]
+    return []
+
+
+class SpeculativeGenerator:
+    """
+    Speculative decoding with a draft model or with prompt-lookup drafting.
+
+    At every step, each sequence gets up to `num_draft` proposed tokens, either sampled from the
+    small `draft` model or, without one, copied from what followed the last earlier occurrence
+    of its final `ngram` tokens in the dialog (answers of the reflection stages mostly repeat
+    earlier turns). The main model scores the proposals of all sequences in a single forward
+    pass, each sequence at its own position, and they are accepted with the rejection rule of
+    speculative sampling, so the samples follow exactly the distribution of regular sampling at
+    the same temperature and top_p (and are the greedy tokens at temperature 0).
+
+    It has the `chat_completion` and `sample_n` methods of `LlamaGenerator`. Each prediction
+    also has `speculative`: the number of proposed and accepted tokens, of generated tokens and
+    of main model steps of its sequence.
+
+    Args:
+        llama (Llama): The main generator.
+        draft (Llama, optional): Draft generator with the same tokenizer. If None, prompt lookup is used.
+        num_draft (int, optional): Number of tokens proposed per step. Defaults to 4.
+        ngram (int, optional): Longest n-gram matched by prompt lookup. Defaults to 3.
+        prefix_cache (PrefixCache, optional): Used for the prompts of the main model, as in `LlamaGenerator`.
+    """
+
+    def __init__(
+        self,
+        llama: Llama,
+        draft: Optional[Llama] = None,
+        num_draft: int = 4,
+        ngram: int = 3,
+        prefix_cache: Optional[PrefixCache] = None,
+    ):
+        self.llama = llama
+        self.prefix_cache = prefix_cache
+        self.model = llama.model
+        self.tokenizer = llama.tokenizer
+        self.draft_model = draft.model if draft is not None else None
+        self.num_draft = num_draft
+        self.ngram = ngram
+        self.last_stats = None
+
+    def chat_completion(
+        self,
+        dialogs: List[Dialog],
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        max_gen_len: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+        store_prefix: bool = True,
+    ):
+        """Same as `LlamaGenerator.chat_completion`."""
+        results = self.sample_n(
+            dialogs, 1, temperature=temperature, top_p=top_p, max_gen_len=max_gen_len,
+            stop=stop, stop_patterns=stop_patterns, store_prefix=store_prefix,
+        )
+        return [predictions[0] for predictions in results]
+
+    def propose(self, seqs, drafts_valid, active, budgets, temperature, top_p):
+        """Returns the proposed tokens of the active rows and, with a draft model, their draft distributions."""
+        if self.draft_model is None:
+            proposals = [lookup_draft(seqs[k], budgets[k], self.ngram) for k in active]
+            return proposals, [None] * len(active)
+
+        # bring the draft cache up to date, then sample the proposals one token at a time
+        logits = forward_chunks(
+            self.draft_model, [seqs[k][drafts_valid[k]:] for k in active], active, [drafts_valid[k] for k in active]
+        )
+        logits = torch.stack([row[-1] for row in logits])
+        proposals = [[] for _ in active]
+        dists = [[] for _ in active]
+        for j in range(max(budgets[k] for k in active)):
+            if temperature > 0:
+                probs = sampling_probs(logits, temperature, top_p)
+                next_tokens = torch.multinomial(probs, num_samples=1).reshape(-1).tolist()
+            else:
+                probs = None
+                next_tokens = torch.argmax(logits, dim=-1).tolist()
+            for i, k in enumerate(active):
+                if j < budgets[k]:
+                    proposals[i].append(next_tokens[i])
+                    dists[i].append(probs[i] if probs is not None else None)
+            if j + 1 == max(budgets[k] for k in active):
+                break
+            # rows without budget left feed their token at the last position, which no valid entry uses
+            tokens = torch.tensor([[t] for t in next_tokens], dtype=torch.long, device=logits.device)
+            positions = [min(len(seqs[k]) + j, self.draft_model.params.max_seq_len - 1) for k in active]
+            logits = forward_rows(self.draft_model, tokens, active, positions)[:, -1]
+        return proposals, dists
+
+    def verify(self, logits, proposal, dists, temperature, top_p):
+        """Returns the tokens kept from `proposal`, followed by a corrected or a bonus token."""
+        out = []
+        for j, token in enumerate(proposal):
+            if temperature == 0:
+                target = int(torch.argmax(logits[j]))
+                if target != token:
+                    return out + [target]
+                out.append(token)
+                continue
+            p = sampling_probs(logits[j], temperature, top_p)
+            q = dists[j] if dists is not None and dists[j] is not None else torch.nn.functional.one_hot(
+                torch.tensor(token, device=p.device), p.shape[-1]
+            ).to(p)
+            if torch.rand(()) * q[token] <= p[token]:
+                out.append(token)
+                continue
+            residual = torch.clamp(p - q, min=0)
+            return out + [int(torch.multinomial(residual / residual.sum(), 1))]
+        if temperature == 0:
+            return out + [int(torch.argmax(logits[len(proposal)]))]
+        return out + [int(torch.multinomial(sampling_probs(logits[len(proposal)], temperature, top_p), 1))]
+
+    @torch.inference_mode()
+    def sample_n(
+        self,
+        dialogs: List[Dialog],
+        n: Union[int, List[int]],
+        temperature: float = 0.6,
+        top_p: float = 0.9,
+        max_gen_len: Optional[int] = None,
+        stop: Optional[List[str]] = None,
+        stop_patterns: Optional[List[str]] = None,
+        store_prefix: bool = True,
+    ):
+        """Same as `LlamaGenerator.sample_n`."""
+        counts = [n] * len(dialogs) if isinstance(n, int) else list(n)
+        params = self.model.params
+        bsz = sum(counts)
+        assert bsz <= params.max_batch_size, (bsz, params.max_batch_size)
+        if max_gen_len is None:
+            max_gen_len = params.max_seq_len - 1
+
+        prompts = [encode_dialog(self.tokenizer, dialog) for dialog in dialogs]
+        rows, row_prompts = [], []
+        for prompt, count in zip(prompts, counts):
+            rows.append(list(range(len(row_prompts), len(row_prompts) + count)))
+            row_prompts += [prompt] * count
+        assert max(len(t) for t in prompts) < params.max_seq_len
+
+        # the caches hold every token of a sequence but the last one, which is fed at the next step
+        for j, prompt in enumerate(prompts):
+            row = rows[j][0]
+            cached_len = 0
+            if self.prefix_cache is not None:
+                cached_len = self.prefix_cache.load(self.model, row, prompt, len(prompt) - 1)
+            if cached_len < len(prompt) - 1:
+                forward_chunks(self.model, [prompt[cached_len:-1]], [row], [cached_len])
+            copy_cache_rows(self.model, row, rows[j][1:], len(prompt) - 1)
+            if self.prefix_cache is not None and store_prefix:
+                self.prefix_cache.store(self.model, row, prompt[:-1])
+            if self.draft_model is not None:
+                forward_chunks(self.draft_model, [prompt[:-1]], [row], [0])
+                copy_cache_rows(self.draft_model, row, rows[j][1:], len(prompt) - 1)
+
+        seqs = [list(t) for t in row_prompts]
+        drafts_valid = [len(t) - 1 for t in row_prompts]
+        finished = [False] * bsz
+        eos = [False] * bsz
+        stats = [{'proposed': 0, 'accepted': 0, 'tokens': 0, 'steps': 0} for _ in range(bsz)]
+        while not all(finished):
+            active = [k for k in range(bsz) if not finished[k]]
+            # leave room for the corrected or bonus token, within the budget and the context
+            budgets = {
+                k: max(0, min(
+                    self.num_draft,
+                    max_gen_len - (len(seqs[k]) - len(row_prompts[k])) - 1,
+                    params.max_seq_len - len(seqs[k]) - 1,
+                ))
+                for k in active
+            }
+            proposals, dists = self.propose(seqs, drafts_valid, active, budgets, temperature, top_p)
+            logits = forward_chunks(
+                self.model, [[seqs[k][-1]] + proposal for k, proposal in zip(active, proposals)],
+                active, [len(seqs[k]) - 1 for k in active],
+            )
+            for i, k in enumerate(active):
+                new_tokens = self.verify(logits[i], proposals[i], dists[i], temperature, top_p)
+                stats[k]['proposed'] += len(proposals[i])
+                stats[k]['accepted'] += len(new_tokens) - 1
+                stats[k]['steps'] += 1
+                # the draft cache holds the accepted proposals it was fed, all but the last one
+                drafts_valid[k] = len(seqs[k]) + min(len(new_tokens) - 1, max(len(proposals[i]) - 1, 0))
+                for token in new_tokens:
+                    generated = len(seqs[k]) - len(row_prompts[k])
+                    if token == self.tokenizer.eos_id or generated >= max_gen_len or len(seqs[k]) >= params.max_seq_len:
+                        finished[k] = True
+                        eos[k] = token == self.tokenizer.eos_id
+                        break
+                    seqs[k].append(token)
+                    stats[k]['tokens'] += 1
+                    if (stop or stop_patterns) and find_stop(
+                        self.tokenizer.decode(seqs[k][len(row_prompts[k]):]), stop, stop_patterns
+                    ) is not None:
+                        finished[k] = True
+                        break
+                else:
+                    generated = len(seqs[k]) - len(row_prompts[k])
+                    finished[k] = generated >= max_gen_len or len(seqs[k]) >= params.max_seq_len
+
+        out = []
+        for j, prompt in enumerate(prompts):
+            predictions = []
+            for row in rows[j]:
+                toks = seqs[row][len(prompt):]
+                text = self.tokenizer.decode(toks)
+                cut = find_stop(text, stop, stop_patterns)
+                if cut is not None:
+                    text = text[:cut]
+                predictions.append({
+                    "generation": {"role": "assistant", "content": text},
+                    "speculative": stats[row],
+                })
+            out.append(predictions)
+
+        self.last_stats = {
+            'prompt_tokens': [len(t) for t in row_prompts],
+            'generated_tokens': [stats[k]['tokens'] for k in range(bsz)],
+            # in positions rather than steps of the main model, which may decode several per step
+            'decode_steps_saved': decode_steps_saved(
+                [min(max_gen_len, params.max_seq_len - len(t)) for t in row_prompts],
+                [stats[k]['tokens'] + eos[k] for k in range(bsz)],
+            ),
+        }
+        return out
@@ -0,0 +1,20 @@
+import re
+from typing import List, Optional
+
+
+def find_stop(text: str, stop: Optional[List[str]] = None, stop_patterns: Optional[List[str]] = None):
+    """
+    Returns where `text` should be cut, or None if it contains no stop condition.
+
+    Args:
+        stop (List[str], optional): The text is cut before the first of these strings.
+        stop_patterns (List[str], optional): Regular expressions of a complete answer, e.g.
+            `^[^\\n]{1,200}(\\n)` for a newline after a short span. The text is cut at the start
+            of the first group of the earliest match, or at the start of the match if it has no group.
+    """
+    cuts = [text.index(s) for s in stop or [] if s in text]
+    for pattern in stop_patterns or []:
+        match = re.search(pattern, text)
+        if match is not None:
+            cuts.append(match.start(1) if match.re.groups else match.start())
+    return min(cuts) if cuts else None
@@ -0,0 +1,27 @@
+import os
+import sys
+import tempfile
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope='session')
+def cpu_llama():
+    """
+    Runs the test on the CPU: a model parallel group of one process, as `Llama.build` sets up
+    with NCCL, and the CUDA-only parts of `llama` moved to the CPU, see `tiny_llama.CPUOnly`.
+    """
+    import torch
+    from tiny_llama import CPUOnly
+    try:
+        import fairscale.nn.model_parallel.initialize as fs_init
+    except ImportError:
+        fs_init = None
+    if fs_init is not None and not fs_init.model_parallel_is_initialized():
+        if not torch.distributed.is_initialized():
+            init_file = tempfile.NamedTemporaryFile(delete=False)
+            torch.distributed.init_process_group('gloo', init_method=f'file://{init_file.name}', rank=0, world_size=1)
+        fs_init.initialize_model_parallel(1)
+    with CPUOnly():
+        yield
@@ -0,0 +1,134 @@
+import os
+import json
+import pytest
+
+pytest.importorskip('fire')
+from benchmark import SyntheticTable
+from result_store import SqliteResultStore, SKIP_REASONS
+import combine_data
+
+NUM_QUESTIONS = 12
+
+
+def put_results(cache_dir, q_idxs, version=0):
+    store = SqliteResultStore(cache_dir, 'truthfulqa')
+    for q_idx in q_idxs:
+        store.put('init_responses', q_idx, [f'init {q_idx}.{version}'] * 2)
+        store.put('res_wo_ref', q_idx, f'wo {q_idx}.{version}')
+        if q_idx % 5 == 3:
+            store.put(SKIP_REASONS, q_idx, {'res_w_ref': 'excluded question'})
+        else:
+            store.put('res_w_ref', q_idx, f'w {q_idx}.{version}')
+    store.close()
+
+
+def delete_results(cache_dir, q_idx):
+    store = SqliteResultStore(cache_dir, 'truthfulqa')
+    store.conn.execute('DELETE FROM results WHERE q_idx = ?', (q_idx,))
+    store.close()
+
+
+def read_output(output_dir):
+    """Returns {q_idx: record} of the parts listed in the manifest, checking no question is listed twice."""
+    with open(f'{output_dir}/manifest.json') as f:
+        manifest = json.load(f)
+    listed = [q_idx for q_idxs in manifest['parts'].values() for q_idx in q_idxs]
+    assert len(listed) == len(set(listed))
+    records = {}
+    for name, q_idxs in manifest['parts'].items():
+        with open(f'{output_dir}/{name}') as f:
+            part = [json.loads(line) for line in f]
+        assert [record['q_idx'] for record in part] == q_idxs
+        records.update((record['q_idx'], record) for record in part)
+    assert set(manifest['digests']) == {str(q_idx) for q_idx in records}
+    return records
+
+
+def combine(cache_dir, output_dir, **kwargs):
+    kwargs.setdefault('part_size', 4)
+    return combine_data.combine(
+        'truthfulqa', cache_dir, output_dir=output_dir, table=SyntheticTable('truthfulqa', NUM_QUESTIONS), **kwargs
+    )
+
+
+@pytest.fixture
+def dirs(tmp_path):
+    cache_dir, output_dir = str(tmp_path / 'cache'), str(tmp_path / 'out')
+    # the last question has no init_responses and is left out
+    put_results(cache_dir, range(NUM_QUESTIONS - 1))
+    return cache_dir, output_dir
+
+
+def test_first_build(dirs):
+    cache_dir, output_dir = dirs
+    manifest = combine(cache_dir, output_dir)
+    assert len(manifest['parts']) == 3
+    assert sorted(os.listdir(output_dir)) == sorted(list(manifest['parts']) + ['manifest.json'])
+    records = read_output(output_dir)
+    assert sorted(records) == list(range(NUM_QUESTIONS - 1))
+    assert records[1]['res_wo_ref'] == 'wo 1.0' and records[1]['skip_reasons'] == []
+    assert records[3]['res_w_ref'] is None
+    assert records[3]['skip_reasons'] == [{'stage': 'res_w_ref', 'reason': 'excluded question'}]
+
+    # nothing changed, nothing is written
+    assert combine(cache_dir, output_dir)['parts'] == manifest['parts']
+
+
+def test_changed_removed_and_duplicated(dirs):
+    cache_dir, output_dir = dirs
+    manifest = combine(cache_dir, output_dir)
+    put_results(cache_dir, [1], version=1)
+    delete_results(cache_dir, 6)
+    # an older manifest listing a question in two parts
+    first, last = sorted(manifest['parts'])[0], sorted(manifest['parts'])[-1]
+    manifest['parts'][last] = manifest['parts'][last] + [manifest['parts'][first][0]]
+    combine_data.save_manifest(output_dir, manifest)
+
+    manifest = combine(cache_dir, output_dir)
+    records = read_output(output_dir)
+    assert sorted(records) == [q_idx for q_idx in range(NUM_QUESTIONS - 1) if q_idx != 6]
+    assert records[1]['res_wo_ref'] == 'wo 1.1'
+    assert sorted(os.listdir(output_dir)) == sorted(list(manifest['parts']) + ['manifest.json'])
+
+
+def test_interrupted_between_parts(dirs, monkeypatch):
+    cache_dir, output_dir = dirs
+    combine(cache_dir, output_dir)
+    put_results(cache_dir, [0, 5, 9], version=1)
+
+    write_part = combine_data.write_part
+    written = []
+
+    def interrupted(*args, **kwargs):
+        if written:
+            raise KeyboardInterrupt
+        written.append(args[2])
+        return write_part(*args, **kwargs)
+
+    monkeypatch.setattr(combine_data, 'write_part', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        combine(cache_dir, output_dir, part_size=2)
+    # the manifest lists every question at most once, some of them still to be merged again
+    records = read_output(output_dir)
+    assert len(records) < NUM_QUESTIONS - 1
+
+    monkeypatch.setattr(combine_data, 'write_part', write_part)
+    manifest = combine(cache_dir, output_dir)
+    records = read_output(output_dir)
+    assert sorted(records) == list(range(NUM_QUESTIONS - 1))
+    assert [records[q_idx]['res_wo_ref'] for q_idx in [0, 5, 9]] == ['wo 0.1', 'wo 5.1', 'wo 9.1']
+    assert sorted(os.listdir(output_dir)) == sorted(list(manifest['parts']) + ['manifest.json'])
+
+
+def test_several_readers(dirs, tmp_path):
+    cache_dir, output_dir = dirs
+    combine(cache_dir, str(tmp_path / 'single'))
+    manifest = combine(cache_dir, output_dir, num_readers=2)
+    assert len(manifest['parts']) == 3
+    assert read_output(output_dir) == read_output(str(tmp_path / 'single'))
+
+    put_results(cache_dir, [2, 10], version=1)
+    combine(cache_dir, output_dir, num_readers=2, part_size=1)
+    records = read_output(output_dir)
+    assert sorted(records) == list(range(NUM_QUESTIONS - 1))
+    assert records[10]['res_w_ref'] == 'w 10.1'
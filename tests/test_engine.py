@@ -0,0 +1,74 @@
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('llama')
+from tiny_llama import DIALOGS, tiny_llama
+from engine import ContinuousBatchingEngine
+from prefix_cache import PrefixCache
+
+
+def reference(llama, dialogs, max_gen_lens):
+    return [
+        llama.chat_completion([dialog], temperature=0, max_gen_len=max_gen_len)[0]['generation']['content']
+        for dialog, max_gen_len in zip(dialogs, max_gen_lens)
+    ]
+
+
+@pytest.mark.parametrize('use_prefix_cache', [False, True])
+def test_greedy_matches_generate(cpu_llama, use_prefix_cache):
+    llama = tiny_llama(seed=0)
+    max_gen_lens = [3, 40, 7, 60, 1, 25, 12]
+    expected = reference(llama, DIALOGS, max_gen_lens)
+
+    prefix_cache = PrefixCache(10 ** 8) if use_prefix_cache else None
+    engine = ContinuousBatchingEngine(llama, prefix_cache=prefix_cache)
+    results = {}
+    # more requests than slots, so finished slots are refilled while others decode
+    for i, (dialog, max_gen_len) in enumerate(zip(DIALOGS, max_gen_lens)):
+        engine.submit(dialog, lambda predictions, i=i: results.__setitem__(i, predictions), max_gen_len=max_gen_len, temperature=0)
+    engine.run()
+    assert [results[i][0]['generation']['content'] for i in range(len(DIALOGS))] == expected
+    assert 0 < engine.fill_ratio <= 1
+
+    # a second pass finds the prompts in the prefix cache
+    outputs = engine.chat_completion(DIALOGS[:4], temperature=0, max_gen_len=20)
+    assert [out['generation']['content'] for out in outputs] == reference(llama, DIALOGS[:4], [20] * 4)
+    if prefix_cache is not None:
+        assert prefix_cache.hits > 0
+
+
+def test_samples_share_prefill(cpu_llama):
+    llama = tiny_llama(seed=0)
+    engine = ContinuousBatchingEngine(llama)
+    results = engine.sample_n(DIALOGS[:2], n=[3, 1], temperature=0, max_gen_len=15)
+    expected = reference(llama, DIALOGS[:2], [15, 15])
+    assert [[p['generation']['content'] for p in predictions] for predictions in results] == [[expected[0]] * 3, [expected[1]]]
+
+
+def test_step_stats(cpu_llama):
+    llama = tiny_llama(seed=0)
+    engine = ContinuousBatchingEngine(llama)
+    steps = []
+    for i, dialog in enumerate(DIALOGS):
+        engine.submit(dialog, lambda predictions: None, n=2, max_gen_len=10, temperature=0, tag=f'stage{i % 2}')
+    engine.run(on_step=steps.append)
+
+    def total(key):
+        return sum(stats.get(key, 0) for step in steps for stats in step['tags'].values())
+
+    assert set(tag for step in steps for tag in step['tags']) == {'stage0', 'stage1'}
+    assert total('rows') == engine.active_rows
+    assert total('generated_tokens') == engine.generated_tokens
+    assert total('prompt_tokens') == engine.prompt_tokens
+    assert all(step['wall_time'] > 0 and step['max_batch_size'] == 4 for step in steps)
+
+
+def test_decode_steps_saved(cpu_llama):
+    llama = tiny_llama(seed=0)
+    engine = ContinuousBatchingEngine(llama)
+    steps = []
+    for dialog in DIALOGS[:3]:
+        engine.submit(dialog, lambda predictions: None, n=2, max_gen_len=10, temperature=0, stop_patterns=[r'(?s).'], tag='stage')
+    engine.run(on_step=steps.append)
+    # every slot is freed after its first token, 9 steps before the budget
+    assert sum(step['tags'].get('stage', {}).get('decode_steps_saved', 0) for step in steps) == 6 * 9
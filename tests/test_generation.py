@@ -0,0 +1,101 @@
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('llama')
+from tiny_llama import DIALOGS, tiny_llama
+from generation import LlamaGenerator, encode_dialog
+from prefix_cache import PrefixCache
+
+
+def reference(llama, dialogs, max_gen_len):
+    return [
+        llama.chat_completion([dialog], temperature=0, max_gen_len=max_gen_len)[0]['generation']['content']
+        for dialog in dialogs
+    ]
+
+
+class TokenCounter:
+    """Counts the tokens run through the model, prefill and decode."""
+
+    def __init__(self, model):
+        self.tokens = 0
+        model.tok_embeddings.register_forward_hook(self.hook)
+
+    def hook(self, module, inputs, output):
+        self.tokens += inputs[0].numel()
+
+
+def test_mixed_prompt_lengths_prefill_in_full(cpu_llama):
+    llama = tiny_llama(seed=0)
+    dialogs = [DIALOGS[0], DIALOGS[5], DIALOGS[6], DIALOGS[2]]
+    expected = reference(llama, dialogs, 12)
+    counter = TokenCounter(llama.model)
+    generator = LlamaGenerator(llama)
+    predictions = generator.chat_completion(dialogs, temperature=0, max_gen_len=12)
+    assert [p['generation']['content'] for p in predictions] == expected
+
+    # every prompt goes through the model once, and every row decodes one token per step
+    prompt_tokens = sum(len(encode_dialog(llama.tokenizer, dialog)) for dialog in dialogs)
+    decoded = sum(max(n - 1, 0) for n in generator.last_stats['generated_tokens'])
+    assert generator.last_stats['prompt_tokens'] == [len(encode_dialog(llama.tokenizer, d)) for d in dialogs]
+    assert counter.tokens <= prompt_tokens + decoded + len(dialogs)
+
+
+def test_prefix_cache_prefills_the_suffix(cpu_llama):
+    llama = tiny_llama(seed=0)
+    prefix_cache = PrefixCache(10 ** 8, block_size=4)
+    generator = LlamaGenerator(llama, prefix_cache=prefix_cache)
+    first = [[{"role": "user", "content": "abc abc abc " * 6 + "first"}], DIALOGS[0]]
+    generator.chat_completion(first, temperature=0, max_gen_len=5)
+
+    # the long dialog continued, batched with a much shorter prompt
+    answer = {"role": "assistant", "content": "x"}
+    followup = [first[0] + [answer, {"role": "user", "content": "next"}], DIALOGS[1]]
+    expected = reference(llama, followup, 5)
+    reused_tokens = prefix_cache.reused_tokens
+    counter = TokenCounter(llama.model)
+    predictions = generator.chat_completion(followup, temperature=0, max_gen_len=5)
+    assert [p['generation']['content'] for p in predictions] == expected
+    reused = prefix_cache.reused_tokens - reused_tokens
+    assert reused >= len(encode_dialog(llama.tokenizer, first[0])) - 4
+    # only the suffixes missing from the cache are prefilled, then at most 4 decode steps per row
+    prompt_tokens = sum(len(encode_dialog(llama.tokenizer, dialog)) for dialog in followup)
+    assert counter.tokens <= prompt_tokens - reused + 2 * 4
+
+
+def test_samples_of_mixed_prompts_fork_the_full_prefill(cpu_llama):
+    llama = tiny_llama(seed=0, max_batch_size=6)
+    dialogs = [DIALOGS[0], DIALOGS[4]]
+    expected = reference(llama, dialogs, 10)
+    counter = TokenCounter(llama.model)
+    generator = LlamaGenerator(llama)
+    results = generator.sample_n(dialogs, n=[4, 2], temperature=0, max_gen_len=10)
+    assert [[p['generation']['content'] for p in predictions] for predictions in results] == [[expected[0]] * 4, [expected[1]] * 2]
+
+    # each prompt is prefilled once for all its samples, longer prompt included
+    prompt_tokens = sum(len(encode_dialog(llama.tokenizer, dialog)) for dialog in dialogs)
+    assert counter.tokens <= prompt_tokens + 6 * 9
+
+
+def test_decode_steps_saved(cpu_llama):
+    llama = tiny_llama(seed=0)
+    generator = LlamaGenerator(llama)
+    # every row stops at its first token: the batch skips all but one of its 10 steps
+    predictions = generator.chat_completion(DIALOGS[:3], temperature=0, max_gen_len=10, stop_patterns=[r'(?s).'])
+    assert [p['generation']['content'] for p in predictions] == [''] * 3
+    assert generator.last_stats['decode_steps_saved'] == 9
+
+
+def test_contiguous_and_scattered_rows_agree(cpu_llama):
+    import torch
+    from generation import forward_rows
+
+    llama = tiny_llama(seed=0)
+    model = llama.model
+    prompts = [encode_dialog(llama.tokenizer, dialog)[:12] for dialog in DIALOGS[:2]]
+    tokens = torch.tensor(prompts)
+    expected = model.forward(tokens, 0)[:, -1]
+    # contiguous rows use a view of the cache, scattered ones gather it
+    for rows in [[1, 2], [3, 0]]:
+        forward_rows(model, tokens[:, :8], rows, [0, 0])
+        torch.testing.assert_close(forward_rows(model, tokens[:, 8:], rows, [8, 8])[:, -1], expected)
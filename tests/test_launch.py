@@ -0,0 +1,16 @@
+import pytest
+
+fire = pytest.importorskip('fire')
+import launch
+
+
+def test_worker_flags_round_trip():
+    run_args = {
+        'dataset': 'hotpotqa',
+        'cache_dir': '/tmp/outputs',
+        'lease_seconds': 0.5,
+        'speculative': True,
+        'stage_settings': {'res_wo_ref': {'max_gen_len': 64, 'stop': ['\n']}},
+    }
+    parsed = fire.Fire(lambda **kwargs: kwargs, command=launch.worker_flags(**run_args))
+    assert parsed == run_args
@@ -0,0 +1,29 @@
+import pytest
+
+pytest.importorskip('fire')
+from fake_llama import FakeLlama
+from batching import BatchScheduler, record_step
+from metrics import Metrics, summarize
+
+
+def test_latency_of_mixed_batches(tmp_path):
+    metrics = Metrics(str(tmp_path), 'truthfulqa', 'worker')
+    generator = FakeLlama(max_batch_size=4, token_latency=0.02, output_tokens=(5, 5))
+    scheduler = BatchScheduler(generator, 4, metrics=metrics, stage_of=lambda key: key[0])
+    for key in [('a', 0), ('a', 1), ('a', 2), ('b', 0)]:
+        scheduler.add(key, [[{"role": "user", "content": f"question {key}"}]], lambda key, outputs: None)
+    scheduler.flush()
+    # an engine step that decoded one row of each stage
+    record_step(metrics, {
+        'wall_time': 0.05, 'max_batch_size': 4,
+        'tags': {'a': {'rows': 1, 'generated_tokens': 1}, 'b': {'rows': 1, 'generated_tokens': 1}},
+    })
+    metrics.close()
+
+    summary = summarize('truthfulqa', cache_dir=str(tmp_path))
+    # the batch went 3/4 to a and 1/4 to b, the step half to each
+    batch_time = (summary['a']['wall_time'] - 0.025) * 4 / 3
+    assert batch_time >= 0.1
+    assert summary['b']['wall_time'] == pytest.approx(batch_time / 4 + 0.025)
+    # the latencies are those of the whole batch and step, not of the share of each stage
+    assert summary['b']['latency_p50'] == summary['a']['latency_p50'] == pytest.approx(batch_time)
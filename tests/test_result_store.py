@@ -0,0 +1,141 @@
+import sqlite3
+import threading
+import pytest
+
+from result_store import SqliteResultStore, JsonResultStore, AsyncResultStore
+
+
+class GatedStore(SqliteResultStore):
+    """Store whose commits wait for `gate`, and fail once `fail` is set."""
+
+    def __init__(self, cache_dir, gate, fail):
+        super().__init__(cache_dir, 'truthfulqa')
+        self.gate = gate
+        self.fail = fail
+
+    def put_many(self, records):
+        self.gate.wait()
+        if self.fail.is_set():
+            raise OSError("disk full")
+        super().put_many(records)
+
+
+@pytest.fixture(params=[SqliteResultStore, JsonResultStore])
+def store(request, tmp_path):
+    store = request.param(str(tmp_path), 'truthfulqa')
+    yield store
+    store.close()
+
+
+def test_put_and_get(store):
+    store.put('init_responses', 3, ['a', 'b'])
+    store.put_many([('res_wo_ref', 3, 'c'), ('res_wo_ref', 1, {'answer': 'd'})])
+    store.put('res_wo_ref', 3, 'e')
+    assert store.exists('init_responses', 3) and not store.exists('init_responses', 1)
+    assert store.get('init_responses', 3) == ['a', 'b']
+    with pytest.raises((KeyError, FileNotFoundError)):
+        store.get('init_responses', 1)
+    assert store.done_ids('res_wo_ref') == {1, 3}
+    assert store.done_ids('res_w_ref') == set()
+    assert store.get_many('res_wo_ref') == {1: {'answer': 'd'}, 3: 'e'}
+    assert store.get_many('res_wo_ref', [3, 5]) == {3: 'e'}
+
+
+def test_iter_joined(store):
+    for q_idx in range(1200):
+        store.put('init_responses', q_idx, [f'init {q_idx}'])
+        if q_idx % 2 == 0:
+            store.put('init_critiques', q_idx, [f'critique {q_idx}'])
+        if q_idx % 3 == 0:
+            store.put('res_w_ref', q_idx, f'w {q_idx}')
+
+    joined = list(store.iter_joined(['init_responses', 'init_critiques']))
+    assert [q_idx for q_idx, _ in joined] == list(range(0, 1200, 2))
+    assert joined[1] == (2, [['init 2'], ['critique 2']])
+
+    # optional stages are None where they are not done
+    joined = dict(store.iter_joined(['init_critiques'], optional=['res_w_ref', 'res_wo_ref']))
+    assert joined[6] == [['critique 6'], 'w 6', None] and joined[4] == [['critique 4'], None, None]
+
+    # the requested q_idx span several chunks of the IN clause, not all of them done
+    q_idxs = list(range(1199, -1, -7)) + [5000]
+    joined = list(store.iter_joined(['init_responses', 'init_critiques'], q_idxs=q_idxs, optional=['res_w_ref']))
+    assert [q_idx for q_idx, _ in joined] == sorted(q_idx for q_idx in q_idxs if q_idx % 2 == 0 and q_idx < 1200)
+    assert all(values[2] == (f'w {q_idx}' if q_idx % 3 == 0 else None) for q_idx, values in joined)
+
+    raw = dict(store.iter_joined(['init_responses'], q_idxs=[7], decode=False))
+    assert raw == {7: ['["init 7"]']}
+
+
+def test_rollback_journal(tmp_path):
+    # a store created in WAL mode is converted
+    conn = sqlite3.connect(f'{tmp_path}/results.sqlite')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.close()
+    store = SqliteResultStore(str(tmp_path), '.')
+    (mode,), = store.conn.execute('PRAGMA journal_mode')
+    assert mode == 'delete'
+
+    # writes of another worker are seen as soon as they are committed
+    other = SqliteResultStore(str(tmp_path), '.')
+    other.put_many([('init_responses', q_idx, [q_idx]) for q_idx in range(3)])
+    assert store.done_ids('init_responses') == {0, 1, 2}
+    other.close()
+    store.close()
+
+
+def test_async_reads_see_queued_results(tmp_path):
+    gate, fail = threading.Event(), threading.Event()
+    store = AsyncResultStore(lambda: GatedStore(str(tmp_path), gate, fail))
+    store.put('init_responses', 0, ['committed'])
+    gate.set()
+    store.flush()
+    gate.clear()
+
+    store.put('init_responses', 1, ['queued'])
+    store.put('res_wo_ref', 1, 'queued')
+    assert store.exists('init_responses', 1) and store.get('res_wo_ref', 1) == 'queued'
+    assert store.done_ids('init_responses') == {0, 1}
+    assert store.get_many('init_responses') == {0: ['committed'], 1: ['queued']}
+    assert store.get_many('init_responses', [1, 2]) == {1: ['queued']}
+    committed = SqliteResultStore(str(tmp_path), 'truthfulqa')
+    assert committed.done_ids('init_responses') == {0}
+
+    gate.set()
+    store.close()
+    assert committed.done_ids('init_responses') == {0, 1}
+    committed.close()
+
+
+def test_async_flush_commits_in_order(tmp_path):
+    commits = []
+    store = AsyncResultStore(
+        lambda: SqliteResultStore(str(tmp_path), 'truthfulqa'), max_pending=4, batch_size=3,
+        on_commit=lambda records, wall_time: commits.extend(records),
+    )
+    records = [('res_wo_ref', i % 5, f'answer {i}') for i in range(20)]
+    store.put_many(records)
+    store.flush()
+    assert commits == records and store.pending == {}
+    committed = SqliteResultStore(str(tmp_path), 'truthfulqa')
+    assert committed.get_many('res_wo_ref') == {q_idx: f'answer {15 + q_idx}' for q_idx in range(5)}
+    committed.close()
+    store.close()
+
+
+def test_async_write_error(tmp_path):
+    gate, fail = threading.Event(), threading.Event()
+    store = AsyncResultStore(lambda: GatedStore(str(tmp_path), gate, fail))
+    store.put('init_responses', 0, ['lost'])
+    fail.set()
+    gate.set()
+    with pytest.raises(RuntimeError) as error:
+        store.flush()
+    assert isinstance(error.value.__cause__, OSError)
+    with pytest.raises(RuntimeError):
+        store.put('init_responses', 1, ['refused'])
+    # the results that were not committed are still read
+    assert store.get('init_responses', 0) == ['lost']
+    assert store.done_ids('init_responses') == {0}
+    with pytest.raises(RuntimeError):
+        store.close()
@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('llama')
+from tiny_llama import DIALOGS, tiny_llama
+from generation import LlamaGenerator
+from speculative import SpeculativeGenerator
+
+
+def contents(predictions):
+    return [p['generation']['content'] for p in predictions]
+
+
+def check_stats(predictions, max_gen_len):
+    for p in predictions:
+        s = p['speculative']
+        assert 0 <= s['accepted'] <= s['proposed']
+        assert s['steps'] >= 1
+        assert s['tokens'] <= s['accepted'] + s['steps']
+        assert s['tokens'] <= max_gen_len
+
+
+@pytest.mark.parametrize('use_draft', [False, True])
+def test_greedy_matches_generate(cpu_llama, use_draft):
+    llama = tiny_llama(seed=0)
+    draft = tiny_llama(seed=1) if use_draft else None
+    # one dialog at a time, so the batch never exceeds the 4 cache rows
+    for dialog in DIALOGS:
+        expected = LlamaGenerator(llama).chat_completion([dialog], temperature=0, max_gen_len=30)
+        predictions = SpeculativeGenerator(llama, draft, num_draft=3).chat_completion([dialog], temperature=0, max_gen_len=30)
+        assert contents(predictions) == contents(expected)
+        check_stats(predictions, 30)
+
+
+def test_draft_of_the_same_model_is_always_accepted(cpu_llama):
+    llama = tiny_llama(seed=0)
+    predictions = SpeculativeGenerator(llama, tiny_llama(seed=0), num_draft=4).chat_completion(
+        DIALOGS[:2], temperature=0, max_gen_len=20
+    )
+    check_stats(predictions, 20)
+    for p in predictions:
+        s = p['speculative']
+        assert s['accepted'] == s['proposed']
+
+
+def test_sampled_counts(cpu_llama):
+    llama = tiny_llama(seed=0)
+    generator = SpeculativeGenerator(llama, tiny_llama(seed=1), num_draft=4)
+    results = generator.sample_n(DIALOGS[:2], n=[3, 1], temperature=0.8, max_gen_len=25)
+    assert [len(predictions) for predictions in results] == [3, 1]
+    for predictions in results:
+        check_stats(predictions, 25)
@@ -0,0 +1,32 @@
+import os
+import pytest
+
+pytest.importorskip('fire')
+from benchmark import SyntheticTable
+from question_source import QuestionSource
+from token_index import TokenIndex, tokenizer_id
+
+
+def test_index_is_keyed_by_tokenizer(tmp_path):
+    source = QuestionSource('truthfulqa', str(tmp_path), table=SyntheticTable('truthfulqa', 5))
+    tokenizers = {}
+    for name, content in [('chars', b'one model'), ('words', b'another model')]:
+        with open(tmp_path / f'{name}.model', 'wb') as f:
+            f.write(content)
+        tokenizers[name] = tokenizer_id(str(tmp_path / f'{name}.model'))
+    counts = {
+        'chars': lambda dialog: sum(len(message['content']) for message in dialog),
+        'words': lambda dialog: sum(len(message['content'].split()) for message in dialog),
+    }
+
+    chars = TokenIndex.load_or_build(source, counts['chars'], str(tmp_path), tokenizers['chars'])
+    words = TokenIndex.load_or_build(source, counts['words'], str(tmp_path), tokenizers['words'])
+    assert list(words.lengths) != list(chars.lengths)
+    for name in ['chars', 'words']:
+        assert os.path.exists(TokenIndex.path(source, str(tmp_path), tokenizers[name]))
+
+    # the same tokenizer model, wherever it is, loads its own counts
+    os.rename(tmp_path / 'chars.model', tmp_path / 'moved.model')
+    unused = lambda dialog: pytest.fail("the index was built again")
+    loaded = TokenIndex.load_or_build(source, unused, str(tmp_path), tokenizer_id(str(tmp_path / 'moved.model')))
+    assert list(loaded.lengths) == list(chars.lengths)
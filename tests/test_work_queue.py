@@ -0,0 +1,81 @@
+import time
+import pytest
+
+pytest.importorskip('fire')
+from benchmark import SyntheticTable
+from fake_llama import FakeLlama
+from question_source import QuestionSource
+from result_store import SqliteResultStore
+from work_queue import WorkQueue, Heartbeat, worker_id
+import run_llama
+
+
+def test_claim_complete_and_release(tmp_path):
+    queue = WorkQueue(str(tmp_path), 'truthfulqa')
+    queue.fill(10, 4)
+    queue.fill(10, 4)
+    assert queue.counts() == {'pending': 3, 'leased': 0, 'expired': 0, 'done': 0}
+    assert queue.claim('a') == (0, 4)
+    assert queue.claim('b') == (4, 8)
+    assert queue.claim('a') == (8, 10)
+    assert queue.claim('b') is None
+
+    # only the owner of a lease ends it
+    queue.complete(0, 'b')
+    queue.complete(0, 'a')
+    queue.release(4, 'b')
+    assert queue.counts() == {'pending': 1, 'leased': 1, 'expired': 0, 'done': 1}
+    assert queue.claim('c') == (4, 8)
+    queue.close()
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    queue = WorkQueue(str(tmp_path), 'truthfulqa', lease_seconds=0.2)
+    queue.fill(8, 4)
+    assert queue.claim('dead') == (0, 4)
+    assert queue.claim('alive') == (4, 8)
+    assert queue.claim('alive') is None
+    time.sleep(0.3)
+    assert queue.counts()['expired'] == 2
+    assert queue.claim('alive') == (0, 4)
+
+    # the late worker no longer owns its range
+    queue.complete(0, 'dead')
+    (status, owner, attempts), = queue.conn.execute('SELECT status, owner, attempts FROM items WHERE start = 0')
+    assert (status, owner, attempts) == ('leased', 'alive', 2)
+    queue.close()
+
+
+def test_heartbeat_keeps_the_lease(tmp_path):
+    queue = WorkQueue(str(tmp_path), 'truthfulqa', lease_seconds=0.2)
+    queue.fill(4, 4)
+    assert queue.claim('alive') == (0, 4)
+    with Heartbeat(str(tmp_path), 'truthfulqa', 'alive', lease_seconds=0.2):
+        time.sleep(0.5)
+        assert queue.claim('other') is None
+    time.sleep(0.3)
+    assert queue.claim('other') == (0, 4)
+    queue.close()
+
+
+def test_worker_waits_for_leases_of_other_workers(tmp_path):
+    cache_dir = str(tmp_path)
+    queue = WorkQueue(cache_dir, 'truthfulqa', lease_seconds=0.5)
+    queue.fill(12, 4)
+    # a worker that died holding the first range
+    assert queue.claim('dead') == (0, 4)
+
+    run_llama.main(
+        None, None, dataset='truthfulqa', use_queue=True, chunk_size=4, lease_seconds=0.5, poll_seconds=0.05,
+        max_batch_size=6, cache_dir=cache_dir, generator=FakeLlama(max_batch_size=6),
+        source=QuestionSource('truthfulqa', cache_dir, table=SyntheticTable('truthfulqa', 12)),
+    )
+    # instead of exiting once the other ranges are done, it waited for the lease to expire
+    assert queue.counts() == {'pending': 0, 'leased': 0, 'expired': 0, 'done': 3}
+    (owner,), = queue.conn.execute('SELECT owner FROM items WHERE start = 0')
+    assert owner == worker_id()
+    queue.close()
+
+    store = SqliteResultStore(cache_dir, 'truthfulqa')
+    assert store.done_ids('res_w_ref') == set(range(12))
+    store.close()
@@ -0,0 +1,59 @@
+import os
+import json
+import pytest
+
+pytest.importorskip('fire')
+from benchmark import SyntheticTable
+from fake_llama import FakeLlama
+from question_source import QuestionSource
+from result_store import SqliteResultStore, STAGE_NAMES
+import worker_daemon
+
+
+class BrokenTable(SyntheticTable):
+    def select_columns(self, columns):
+        raise RuntimeError("unreadable split")
+
+
+def test_spool_round_trip(tmp_path):
+    cache_dir, spool_dir = str(tmp_path / 'cache'), str(tmp_path / 'spool')
+    sources = {
+        'truthfulqa': QuestionSource('truthfulqa', cache_dir, table=SyntheticTable('truthfulqa', 10)),
+        'broken': QuestionSource('truthfulqa', cache_dir, table=BrokenTable('truthfulqa', 10)),
+    }
+    first = worker_daemon.submit('truthfulqa', 0, 4, spool_dir=spool_dir)
+    second = worker_daemon.submit('truthfulqa', 4, 12, stages=['init_responses'], spool_dir=spool_dir)
+    broken = worker_daemon.submit('broken', 0, 4, spool_dir=spool_dir)
+    stop = worker_daemon.submit(stop=True, spool_dir=spool_dir)
+
+    # returns once it takes the stop job, the last one submitted
+    worker_daemon.serve(
+        generator=FakeLlama(max_batch_size=6), sources=sources, cache_dir=cache_dir, spool_dir=spool_dir,
+        poll_interval=0.01, generation_cache_gb=0.01, generation_cache_dir=str(tmp_path / 'generations'),
+    )
+
+    dirs = worker_daemon.spool_dirs(spool_dir)
+    assert os.listdir(dirs['incoming']) == [] and os.listdir(dirs['running']) == []
+    assert sorted(os.listdir(dirs['done'])) == sorted([first, second, stop])
+    assert os.listdir(dirs['failed']) == [broken]
+    with open(f"{dirs['done']}/{first}") as f:
+        assert json.load(f)['num_questions'] == 4
+    with open(f"{dirs['done']}/{second}") as f:
+        assert json.load(f)['num_questions'] == 6
+    with open(f"{dirs['failed']}/{broken}") as f:
+        assert 'unreadable split' in json.load(f)['error']
+
+    store = SqliteResultStore(cache_dir, 'truthfulqa')
+    for stage in STAGE_NAMES:
+        assert store.done_ids(stage) == (set(range(10)) if stage == 'init_responses' else set(range(4)))
+    store.close()
+
+
+def test_requeue_stale_jobs(tmp_path):
+    dirs = worker_daemon.spool_dirs(str(tmp_path))
+    name = worker_daemon.submit('truthfulqa', 0, 4, spool_dir=str(tmp_path))
+    # a daemon of this host that no longer runs
+    dead = worker_daemon.claim_job(dirs, f'{worker_daemon.socket.gethostname()}-999999999')
+    assert dead is not None and os.listdir(dirs['incoming']) == []
+    worker_daemon.requeue_stale_jobs(dirs)
+    assert os.listdir(dirs['incoming']) == [name] and os.listdir(dirs['running']) == []
@@ -0,0 +1,61 @@
+"""Tiny randomly initialised `Llama` models that run on the CPU, for the generation tests."""
+import torch
+from torch.overrides import TorchFunctionMode
+from llama import Llama
+from llama.model import ModelArgs, Transformer
+
+
+class ByteTokenizer:
+    """Byte-level stand-in for the sentencepiece `Tokenizer`, with the same interface."""
+
+    n_words = 259
+    bos_id = 1
+    eos_id = 2
+    pad_id = -1
+
+    def encode(self, s, bos, eos):
+        tokens = [b + 3 for b in s.encode('utf-8')]
+        return ([self.bos_id] if bos else []) + tokens + ([self.eos_id] if eos else [])
+
+    def decode(self, tokens):
+        return bytes([t - 3 for t in tokens if t >= 3]).decode('utf-8', errors='replace')
+
+
+class CPUOnly(TorchFunctionMode):
+    """Runs the CUDA-only parts of `llama` (`.cuda()` KV caches, `device="cuda"` tensors) on the CPU."""
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if func is torch.Tensor.cuda:
+            return args[0]
+        if kwargs.get('device') == 'cuda':
+            kwargs['device'] = 'cpu'
+        return func(*args, **kwargs)
+
+
+def tiny_llama(seed: int, max_seq_len: int = 256, max_batch_size: int = 4) -> Llama:
+    """A randomly initialised two-layer `Llama` on the CPU. Needs the `cpu_llama` fixture."""
+    torch.manual_seed(seed)
+    tokenizer = ByteTokenizer()
+    params = ModelArgs(
+        dim=64, n_layers=2, n_heads=4, n_kv_heads=2, vocab_size=tokenizer.n_words, multiple_of=32,
+        max_seq_len=max_seq_len, max_batch_size=max_batch_size,
+    )
+    model = Transformer(params)
+    # the fairscale layers of `llama` leave their weights uninitialised
+    with torch.no_grad():
+        for p in model.parameters():
+            if p.dim() > 1:
+                p.normal_(std=p.shape[-1] ** -0.5)
+    return Llama(model, tokenizer)
+
+
+DIALOGS = [
+    [{"role": "user", "content": "abc abc abc " * (i + 1) + f"q{i}"}]
+    for i in range(6)
+] + [[
+    {"role": "system", "content": "Answer briefly."},
+    {"role": "user", "content": "Name a river."},
+    {"role": "assistant", "content": "The Nile."},
+    {"role": "user", "content": "Another one?"},
+]]
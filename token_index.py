@@ -0,0 +1,88 @@
+import os
+from array import array
+import fire
+from pipeline import init_responses_dialogs
+from question_source import QuestionSource
+from generation_cache import file_digest
+
+
+def tokenizer_id(tokenizer_path):
+    """Identifies a tokenizer by the hash of its model file."""
+    return file_digest(tokenizer_path)[:16]
+
+
+class TokenIndex:
+    """
+    Token count of the first prompt (system prompt, context and question) of every question.
+
+    The counts are computed once with the Llama tokenizer and stored as a flat array of
+    uint32 in `{cache_dir}/{dataset}/token_lengths-{fingerprint}-{tokenizer}.bin`, 4 bytes per
+    question, where `tokenizer` is the `tokenizer_id` of the tokenizer that counted them.
+    """
+
+    def __init__(self, lengths: array):
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, q_idx):
+        return self.lengths[q_idx]
+
+    @staticmethod
+    def path(source: QuestionSource, cache_dir, tokenizer: str):
+        return f'{cache_dir}/{source.dataset}/token_lengths-{source.fingerprint}-{tokenizer}.bin'
+
+    @staticmethod
+    def build(source: QuestionSource, count_tokens, chunk_size: int = 1000):
+        lengths = array('I')
+        for start in range(0, len(source), chunk_size):
+            for item in source.items(start, start + chunk_size):
+                dialog = init_responses_dialogs(source.dataset, item, {})[0]
+                lengths.append(count_tokens(dialog))
+        return TokenIndex(lengths)
+
+    @staticmethod
+    def load_or_build(source: QuestionSource, count_tokens, cache_dir, tokenizer: str):
+        """Loads the index counted by `tokenizer` (see `tokenizer_id`), or builds it with `count_tokens`."""
+        path = TokenIndex.path(source, cache_dir, tokenizer)
+        if os.path.exists(path):
+            lengths = array('I')
+            with open(path, 'rb') as f:
+                lengths.frombytes(f.read())
+            if len(lengths) == len(source):
+                return TokenIndex(lengths)
+
+        index = TokenIndex.build(source, count_tokens)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            index.lengths.tofile(f)
+        os.rename(tmp_path, path)
+        return index
+
+
+def main(
+    dataset: str,
+    tokenizer_path: str = 'tokenizer.model',
+    cache_dir: str = '/newdisk/reflective_thinking',
+    max_seq_len: int = 4096,
+):
+    """Builds the token index of a dataset and prints the distribution of prompt lengths."""
+    from llama.tokenizer import Tokenizer
+    from generation import encode_dialog
+
+    tokenizer = Tokenizer(model_path=tokenizer_path)
+    source = QuestionSource(dataset, cache_dir)
+    index = TokenIndex.load_or_build(
+        source, lambda dialog: len(encode_dialog(tokenizer, dialog)), cache_dir, tokenizer_id(tokenizer_path)
+    )
+
+    lengths = sorted(index.lengths)
+    for q in [0.5, 0.9, 0.99, 1.0]:
+        print(f"p{int(q * 100)}: {lengths[min(int(q * len(lengths)), len(lengths) - 1)]} tokens")
+    print(f"{sum(length >= max_seq_len for length in lengths)}/{len(lengths)} prompts do not fit in {max_seq_len} tokens")
+
+
+if __name__ == "__main__":
+    fire.Fire(main)
@@ -0,0 +1,127 @@
+import os
+import time
+import socket
+import sqlite3
+import threading
+
+
+class WorkQueue:
+    """
+    Lease-based queue of question ranges shared by the workers of a run.
+
+    The queue lives in `{cache_dir}/{dataset}/queue.sqlite`. Each item is a range
+    `[start, end)` of q_idx. A worker claims an item by taking a lease on it, keeps the lease
+    alive with heartbeats while it works, and marks the item done at the end. Items whose
+    lease expired (the worker died or hung) go back to the queue and are claimed again.
+    Workers may run on several hosts sharing `cache_dir`, so the file keeps SQLite's rollback
+    journal rather than WAL, which needs every connection on the same host.
+
+    Args:
+        cache_dir (str): Root of the outputs.
+        dataset (str): Name of the dataset.
+        lease_seconds (float, optional): How long a lease lasts without heartbeat. Defaults to 600.
+    """
+
+    def __init__(self, cache_dir, dataset, lease_seconds: float = 600.0):
+        os.makedirs(f'{cache_dir}/{dataset}', exist_ok=True)
+        self.path = f'{cache_dir}/{dataset}/queue.sqlite'
+        self.lease_seconds = lease_seconds
+        self.conn = sqlite3.connect(self.path, timeout=60.0, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=DELETE')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS items ('
+            'start INTEGER PRIMARY KEY, end INTEGER NOT NULL, status TEXT NOT NULL, '
+            'owner TEXT, lease_expiry REAL, attempts INTEGER NOT NULL DEFAULT 0)'
+        )
+
+    def fill(self, num_questions: int, chunk_size: int):
+        """Adds the ranges covering `[0, num_questions)`; ranges already in the queue are kept."""
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO items (start, end, status) VALUES (?, ?, 'pending')",
+                [(start, min(start + chunk_size, num_questions)) for start in range(0, num_questions, chunk_size)],
+            )
+
+    def claim(self, owner: str):
+        """Leases the first available range to `owner`, returns (start, end) or None if there is none."""
+        now = time.time()
+        with self.conn:
+            self.conn.execute('BEGIN IMMEDIATE')
+            row = self.conn.execute(
+                "SELECT start, end FROM items WHERE status = 'pending' "
+                "OR (status = 'leased' AND lease_expiry < ?) ORDER BY start LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            self.conn.execute(
+                "UPDATE items SET status = 'leased', owner = ?, lease_expiry = ?, attempts = attempts + 1 WHERE start = ?",
+                (owner, now + self.lease_seconds, row[0]),
+            )
+        return row
+
+    def heartbeat(self, owner: str):
+        self.conn.execute(
+            "UPDATE items SET lease_expiry = ? WHERE status = 'leased' AND owner = ?",
+            (time.time() + self.lease_seconds, owner),
+        )
+
+    def complete(self, start: int, owner: str):
+        self.conn.execute(
+            "UPDATE items SET status = 'done', lease_expiry = NULL WHERE start = ? AND owner = ?",
+            (start, owner),
+        )
+
+    def release(self, start: int, owner: str):
+        self.conn.execute(
+            "UPDATE items SET status = 'pending', owner = NULL, lease_expiry = NULL WHERE start = ? AND owner = ?",
+            (start, owner),
+        )
+
+    def counts(self):
+        """Returns {'pending': n, 'leased': n, 'expired': n, 'done': n}."""
+        counts = {'pending': 0, 'leased': 0, 'expired': 0, 'done': 0}
+        rows = self.conn.execute(
+            "SELECT CASE WHEN status = 'leased' AND lease_expiry < ? THEN 'expired' ELSE status END, COUNT(*) "
+            "FROM items GROUP BY 1",
+            (time.time(),),
+        )
+        for status, count in rows:
+            counts[status] = count
+        return counts
+
+    def close(self):
+        self.conn.close()
+
+
+class Heartbeat:
+    """
+    Context manager renewing the leases of `owner` from a background thread, so that they
+    do not expire during a long generation.
+    """
+
+    def __init__(self, cache_dir, dataset, owner: str, lease_seconds: float = 600.0):
+        self.args = (cache_dir, dataset, lease_seconds)
+        self.owner = owner
+        self.interval = lease_seconds / 3
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        queue = WorkQueue(*self.args)
+        while not self.stopped.wait(self.interval):
+            queue.heartbeat(self.owner)
+        queue.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def worker_id():
+    return f'{socket.gethostname()}-{os.getpid()}'
@@ -0,0 +1,216 @@
+import os
+import json
+import time
+import socket
+import traceback
+from typing import List, Optional
+import fire
+from pipeline import load_stage_settings
+from question_source import QuestionSource
+from run_llama import build_generators, DatasetRunner
+
+
+CACHE_DIR = '/newdisk/reflective_thinking'
+
+
+def spool_dirs(spool_dir):
+    dirs = {name: f'{spool_dir}/{name}' for name in ['incoming', 'running', 'done', 'failed']}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+
+def write_json_atomic(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
+
+
+def submit(
+    dataset: str = None,
+    start: int = 0,
+    end: int = 20,
+    stages: Optional[List[str]] = None,
+    agreement_threshold: Optional[float] = None,
+    stop: bool = False,
+    spool_dir: str = f'{CACHE_DIR}/spool',
+):
+    """
+    Adds a job to the spool directory of the worker daemons.
+
+    Args:
+        dataset (str): Name of the dataset.
+        start (int): First q_idx of the job.
+        end (int): One past the last q_idx of the job.
+        stages (List[str], optional): Stages to run. Defaults to all of them.
+        agreement_threshold (float, optional): Skip the critiques and reflections of the questions whose
+            init responses agree this much, see `pipeline.StageDAG`. Disabled if None.
+        stop (bool): Submit a job that stops the daemon taking it instead.
+    """
+    dirs = spool_dirs(spool_dir)
+    job = {'stop': True} if stop else {
+        'dataset': dataset, 'start': start, 'end': end, 'stages': stages, 'agreement_threshold': agreement_threshold,
+    }
+    name = f'{time.time():.6f}-{os.getpid()}.json'
+    write_json_atomic(f"{dirs['incoming']}/{name}", job)
+    print(f"submitted {name}: {job}")
+    return name
+
+
+def claim_job(dirs, owner):
+    for name in sorted(os.listdir(dirs['incoming'])):
+        if not name.endswith('.json'):
+            continue
+        running_path = f"{dirs['running']}/{name}.{owner}"
+        try:
+            os.rename(f"{dirs['incoming']}/{name}", running_path)
+        except FileNotFoundError:
+            continue  # taken by another daemon
+        with open(running_path, 'r') as f:
+            return name, running_path, json.load(f)
+    return None
+
+
+def requeue_stale_jobs(dirs):
+    """Puts back the jobs left running by dead daemons of this host."""
+    host = socket.gethostname()
+    for name in os.listdir(dirs['running']):
+        job_name, owner = name.split('.json.')
+        owner_host, pid = owner.rsplit('-', 1)
+        if owner_host != host:
+            continue
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            os.rename(f"{dirs['running']}/{name}", f"{dirs['incoming']}/{job_name}.json")
+            print(f"requeued {job_name}.json left by {owner}")
+        except PermissionError:
+            pass
+
+
+def serve(
+    ckpt_dir: str = 'llama-2-7b-chat/',
+    tokenizer_path: str = 'tokenizer.model',
+    temperature: float = 0.9,
+    top_p: float = 0.8,
+    max_seq_len: int = 4096,
+    max_batch_size: int = 6,
+    max_gen_len: Optional[int] = None,
+    prefix_cache_gb: float = 0.0,
+    generation_cache_gb: float = 0.0,
+    generation_cache_dir: str = CACHE_DIR,
+    use_token_index: bool = False,
+    compute_speed: bool = False,
+    continuous_batching: bool = False,
+    stage_settings=None,
+    speculative: bool = False,
+    draft_ckpt_dir: Optional[str] = None,
+    num_draft: int = 4,
+    fake: bool = False,
+    poll_interval: float = 1.0,
+    cache_dir: str = CACHE_DIR,
+    spool_dir: str = f'{CACHE_DIR}/spool',
+    generator=None,
+    sources=None,
+):
+    """
+    Loads the generator once and runs the jobs submitted to the spool directory until a stop job.
+
+    A job is a json file `{"dataset": ..., "start": ..., "end": ..., "stages": [...], "agreement_threshold": ...}` in
+    `{spool_dir}/incoming`. It is claimed by renaming it into `running`, run through the
+    pipeline with the results written to the result store, and moved to `done` with a
+    summary (or to `failed` with the traceback). Several daemons can share a spool directory.
+
+    The generation options are those of `run_llama.main`, and the generators are built the same
+    way, see `run_llama.build_generators`.
+
+    Args:
+        fake (bool, optional): Use `FakeLlama` instead of loading the checkpoint. Defaults to False.
+        generator (optional): Generator to use instead of building one, for tests.
+        sources (Dict[str, QuestionSource], optional): Questions of each dataset to use instead of
+            loading the datasets, for tests.
+    """
+    stage_settings = load_stage_settings(stage_settings)
+    checkpoint = None
+    if generator is None and fake:
+        from fake_llama import FakeLlama
+        generator = FakeLlama.build(max_batch_size=max_batch_size)
+        checkpoint = 'fake'
+    generator, speculative_generator, prefix_cache, cache = build_generators(
+        ckpt_dir,
+        tokenizer_path,
+        max_seq_len,
+        max_batch_size,
+        prefix_cache_gb=prefix_cache_gb,
+        generation_cache_gb=generation_cache_gb,
+        generation_cache_dir=generation_cache_dir,
+        continuous_batching=continuous_batching,
+        speculative=speculative,
+        draft_ckpt_dir=draft_ckpt_dir,
+        num_draft=num_draft,
+        generator=generator,
+        checkpoint=checkpoint,
+    )
+
+    dirs = spool_dirs(spool_dir)
+    requeue_stale_jobs(dirs)
+    owner = f'{socket.gethostname()}-{os.getpid()}'
+    sources = dict(sources or {})
+    runners = {}
+    print(f"{owner}: waiting for jobs in {dirs['incoming']}")
+
+    while True:
+        claimed = claim_job(dirs, owner)
+        if claimed is None:
+            time.sleep(poll_interval)
+            continue
+        name, running_path, job = claimed
+
+        if job.get('stop'):
+            for runner in runners.values():
+                runner.close()
+            os.rename(running_path, f"{dirs['done']}/{name}")
+            print(f"{owner}: stopped by {name}")
+            return
+
+        start_time = time.time()
+        try:
+            dataset = job['dataset']
+            if dataset not in runners:
+                if dataset not in sources:
+                    sources[dataset] = QuestionSource(dataset, cache_dir)
+                runners[dataset] = DatasetRunner(
+                    generator, dataset, sources[dataset], cache_dir,
+                    compute_speed=compute_speed, use_token_index=use_token_index, tokenizer_path=tokenizer_path,
+                )
+            runner = runners[dataset]
+            num_questions, blocked = runner.run(
+                job['start'],
+                job['end'],
+                stage_names=job.get('stages'),
+                max_batch_size=max_batch_size,
+                max_gen_len=max_gen_len,
+                temperature=temperature,
+                top_p=top_p,
+                max_seq_len=max_seq_len,
+                cache=cache,
+                stage_settings=stage_settings,
+                speculative=speculative_generator,
+                agreement_threshold=job.get('agreement_threshold'),
+            )
+            runner.store.flush()
+            job['num_questions'] = num_questions
+            job['num_blocked'] = len(blocked)
+            job['seconds'] = time.time() - start_time
+            write_json_atomic(f"{dirs['done']}/{name}", job)
+        except Exception:
+            job['error'] = traceback.format_exc()
+            write_json_atomic(f"{dirs['failed']}/{name}", job)
+            print(job['error'])
+        os.remove(running_path)
+        print(f"{owner}: finished {name} in {time.time() - start_time:.1f}s")
+
+
+if __name__ == "__main__":
+    fire.Fire({'serve': serve, 'submit': submit})